@@ -5,14 +5,25 @@ For example: all entities which played 'quarterback' on a football team (corresp
 
 to run: 
 python3.6 fetch_with_rel_and_value.py --data $DATA --out_dir $OUT
+
+or, on a columnar copy of entity_rels (see simple_wikidata_db/columnar.py):
+python3.6 fetch_with_rel_and_value.py --columnar_dir $COLUMNAR_DATA
+
+or, with a (property, value) -> QIDs index of entity_rels (see simple_wikidata_db/rel_index.py), which answers without
+scanning the table but doesn't return claim IDs:
+python3.6 fetch_with_rel_and_value.py --index_dir $INDEX --data $DATA
 """
 
 import argparse
+import os
 from tqdm import tqdm
 from multiprocessing import Pool
 from functools import partial
 
-from fetching.utils import jsonl_generator, get_batch_files
+from fetching.utils import jsonl_generator, get_batch_files, get_shard_files, share_qids, attach_qids, contains_qids
+from simple_wikidata_db.columnar import load_claim_ids, load_columnar_table
+from simple_wikidata_db.utils import parse_id
+from simple_wikidata_db.rel_index import load_rel_index, lookup_qid_strings
 
 
 def get_arg_parser():
@@ -21,22 +32,92 @@ def get_arg_parser():
     parser.add_argument('--rel', type=str, default='P413', help='relationship')
     parser.add_argument('--entity', type=str, default='Q622747', help='entity value')
     parser.add_argument('--num_procs', type=int, default=10, help='Number of processes')
+    parser.add_argument('--columnar_dir', type=str, default=None,
+                        help='path to a columnar entity_rels table. If given, it is scanned instead of --data')
+    parser.add_argument('--index_dir', type=str, default=None,
+                        help='path to a (property, value) -> QIDs index of entity_rels. If it exists and can answer '
+                             'the query, it is used instead of scanning --data')
+    parser.add_argument('--qids_file', type=str, default=None,
+                        help='path to a file with one QID per line. If given, only rows of these QIDs are returned')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='number of shards --data was split into (preprocess_dump.py --num_shards). With '
+                             '--qids_file, only the files of the shards of these QIDs are scanned')
     return parser
 
 
+# sorted numbers of the QIDs to keep, shared with the pool workers by init_qids (None to keep all)
+qid_numbers = None
+
+
+def init_qids(shared_qids):
+    global qid_numbers
+    if shared_qids is not None:
+        qid_numbers = attach_qids(shared_qids)
+
+
+def load_qids(qids_file):
+    with open(qids_file, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
 def filtering_func(rel, entity, filename):
     filtered = []
     for item in jsonl_generator(filename):
         if item['property_id'] == rel and item['value'] == entity:
             filtered.append(item)
+    if qid_numbers is not None:
+        mask = contains_qids(qid_numbers, [item['qid'] for item in filtered])
+        filtered = [item for item, keep in zip(filtered, mask) if keep]
     return filtered
 
 
+def columnar_filtering(columnar_dir, rel, entity):
+    """ Returns the rows of the columnar table. It only has rows with P/Q IDs, so there are none for other IDs. """
+    property_num, value_num = parse_id(rel, 'P'), parse_id(entity, 'Q')
+    if property_num < 0 or value_num < 0:
+        return []
+    table = load_columnar_table(columnar_dir)
+    rows = ((table['property_id'] == property_num) & (table['value'] == value_num)).nonzero()[0]
+    claim_ids = load_claim_ids(columnar_dir, rows)
+    return [
+        {'claim_id': claim_id, 'qid': f"Q{table['qid'][row]}", 'property_id': rel, 'value': entity}
+        for row, claim_id in zip(rows, claim_ids)
+    ]
+
+
+def index_filtering(index_dir, rel, entity):
+    """ Returns the rows found in the index (without claim IDs), or None if there is no index or it can't answer """
+    if index_dir is None or not os.path.exists(os.path.join(index_dir, 'meta.json')):
+        return None
+    qids = lookup_qid_strings(load_rel_index(index_dir), rel, entity)
+    if qids is None:
+        return None
+    return [{'qid': qid, 'property_id': rel, 'value': entity} for qid in qids]
+
+
 def main():
     args = get_arg_parser().parse_args()
+    qids = load_qids(args.qids_file) if args.qids_file is not None else None
+
+    filtered = index_filtering(args.index_dir, args.rel, args.entity)
+    if filtered is None and args.columnar_dir is not None:
+        filtered = columnar_filtering(args.columnar_dir, args.rel, args.entity)
+    if filtered is not None:
+        if qids is not None:
+            qid_set = set(qids)
+            filtered = [item for item in filtered if item['qid'] in qid_set]
+        print(f"Extracted {len(filtered)} rows:")
+        for i, item in enumerate(filtered):
+            print(f"Row {i}: {item}")
+        return
 
-    table_files = get_batch_files(args.data)
-    pool = Pool(processes=args.num_procs)
+    if qids is not None:
+        table_files = get_shard_files(args.data, qids, args.num_shards)
+    else:
+        table_files = get_batch_files(args.data)
+    # the QIDs are published once to the workers, rather than pickled with every file
+    shm, shared_qids = share_qids(qids) if qids is not None else (None, None)
+    pool = Pool(processes=args.num_procs, initializer=init_qids, initargs=(shared_qids,))
     filtered = []
     for output in tqdm(
             pool.imap_unordered(
@@ -44,6 +125,11 @@ def main():
             total=len(table_files)
     ):
         filtered.extend(output)
+    pool.close()
+    pool.join()
+    if shm is not None:
+        shm.close()
+        shm.unlink()
 
     print(f"Extracted {len(filtered)} rows:")
     for i, item in enumerate(filtered):
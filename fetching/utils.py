@@ -4,10 +4,12 @@
 import os
 import ujson as json
 
+from simple_wikidata_db.utils import open_table_file, get_shard_files, share_qids, attach_qids, contains_qids
+
 
 def jsonl_generator(fname):
     """ Returns generator for jsonl file """
-    for line in open(fname, 'r'):
+    for line in open_table_file(fname):
         line = line.strip()
         if len(line) < 3:
             d = {}
@@ -23,4 +25,3 @@ def get_batch_files(fdir):
     filenames = [os.path.join(fdir, f) for f in filenames]
     print(f"Fetched {len(filenames)} files from {fdir}")
     return filenames
-
@@ -0,0 +1,144 @@
+"""On-disk cache of the valid QIDs and filtered triples of the search seeds
+"""
+
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+
+from graph import Triples
+
+from simple_wikidata_db.utils import parse_id
+
+# arrays of a part of the triples of an entry, in the order of the arguments of Triples
+PART_ARRAYS = ('qid', 'property_id', 'value')
+
+
+def data_snapshot(data_files):
+    """ Fingerprint of the data files (paths, sizes and modification times), which changes when a table is rewritten """
+    digest = hashlib.sha1()
+    for filename in data_files:
+        stat = os.stat(filename)
+        digest.update(f"{os.path.abspath(filename)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def normalize_chain(chain):
+    """ The (item, property) conditions of a chain in a canonical order, as the QIDs satisfying them don't depend on it """
+    return sorted({(str(item), str(prop)) for item, prop in chain})
+
+
+class SearchCache:
+    def __init__(self, cache_dir, max_size_mb, snapshot):
+        """
+        Keeps the valid QIDs and the filtered triples of chains of initial conditions, so that runs on the same data
+        skip the first pass and the filtering pass. An entry is a .npz file holding the valid QIDs and the arrays of
+        the triples (see Triples, the claim IDs are not kept) in parts, one per data file, so that entries are written
+        and read a part at a time. Entries are named after a hash of the data snapshot and the normalized chain: when
+        the data changes, the entries of the previous snapshot are no longer hit, and get evicted. Entries are evicted
+        least recently used first (by modification time, which is updated on every hit) once the cache exceeds
+        max_size_mb.
+        :param snapshot: fingerprint of the data files, see data_snapshot
+        """
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb * (1 << 20))
+        self.snapshot = snapshot
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_file(self, chain):
+        key = json.dumps({'snapshot': self.snapshot, 'chain': normalize_chain(chain)})
+        return os.path.join(self.cache_dir, f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.npz")
+
+    def get(self, chain):
+        """
+        Returns the (valid QIDs, parts) of a chain, where parts yields its filtered Triples a part at a time, or None
+        if it isn't cached
+        """
+        entry_file = self.entry_file(chain)
+        if not os.path.exists(entry_file):
+            return None
+        try:
+            entry = np.load(entry_file, allow_pickle=False)
+            valid_qids = {f"Q{qid}" for qid in entry['valid_qids'].tolist()}
+            num_parts = int(entry['num_parts'])
+            missing = {f"{name}_{part}" for part in range(num_parts) for name in PART_ARRAYS} - set(entry.files)
+            if missing:
+                raise KeyError(f"missing arrays {sorted(missing)}")
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            print(f"Ignoring unreadable cache entry {entry_file}: {e}")
+            os.remove(entry_file)
+            return None
+        os.utime(entry_file)
+
+        def parts():
+            with entry:
+                for part in range(num_parts):
+                    yield Triples(*(entry[f"{name}_{part}"] for name in PART_ARRAYS))
+        return valid_qids, parts()
+
+    def open_entry(self, chain, valid_qids):
+        """ Returns a CacheEntryWriter to which the filtered Triples of a chain are added a part at a time """
+        return CacheEntryWriter(self, self.entry_file(chain), valid_qids)
+
+    def put(self, chain, valid_qids, triples):
+        """ Saves the valid QIDs and the filtered Triples of a chain, then evicts entries over the size limit """
+        writer = self.open_entry(chain, valid_qids)
+        writer.add(triples)
+        writer.close()
+
+    def evict(self):
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.npz'):
+                stat = os.stat(os.path.join(self.cache_dir, filename))
+                entries.append((stat.st_mtime_ns, stat.st_size, filename))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            print(f"Evicting cache entry {filename}")
+            os.remove(os.path.join(self.cache_dir, filename))
+            total_size -= size
+
+
+class CacheEntryWriter:
+    def __init__(self, cache, entry_file, valid_qids):
+        """
+        Writes a cache entry to a temporary file, one array at a time. close moves it in place and evicts entries over
+        the size limit, so that an interrupted run leaves no partial entry behind. An entry which alone exceeds the size
+        limit would be evicted right away, so it is dropped as soon as its temporary file does.
+        """
+        self.cache = cache
+        self.entry_file = entry_file
+        self.tmp_file = f"{entry_file}.tmp"
+        self.zip = zipfile.ZipFile(self.tmp_file, 'w', allowZip64=True)
+        self.num_parts = 0
+        self.dropped = False
+        self.write_array('valid_qids', np.array(sorted(parse_id(qid, 'Q') for qid in valid_qids), dtype=np.int64))
+
+    def write_array(self, name, array):
+        with self.zip.open(f"{name}.npy", 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asarray(array), allow_pickle=False)
+
+    def add(self, triples):
+        """ Adds a part of the filtered Triples """
+        if self.dropped:
+            return
+        for name in PART_ARRAYS:
+            self.write_array(f"{name}_{self.num_parts}", getattr(triples, name))
+        self.num_parts += 1
+        if os.path.getsize(self.tmp_file) > self.cache.max_size:
+            print(f"Not caching {self.entry_file}, which is larger than the cache ({self.cache.max_size} bytes)")
+            self.zip.close()
+            os.remove(self.tmp_file)
+            self.dropped = True
+
+    def close(self):
+        if self.dropped:
+            return
+        self.write_array('num_parts', np.array(self.num_parts, dtype=np.int64))
+        self.zip.close()
+        os.replace(self.tmp_file, self.entry_file)
+        self.cache.evict()
@@ -1,4 +1,6 @@
 # python3 decoding.py --labels_dir /data/yury/wikidata/labels --properties_file /data/yury/wikidata/properties/en.json --input_json input.json --output_json output_decoded.json
+# or, with the properties table of the preprocessed dump:
+#  python3 decoding.py --labels_dir /data/yury/wikidata/labels --properties_dir /data/yury/wikidata/properties --input_json input.json
 import argparse
 import json
 import re
@@ -7,12 +9,18 @@ from multiprocessing import Pool
 from functools import partial
 from utils import jsonl_generator, get_batch_files
 
+from simple_wikidata_db.label_store import LabelStore
+
 def get_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--labels_dir', type=str, default='/data/yury/wikidata/labels', help='path to labels directory')
+    parser.add_argument('--label_store', type=str, default=None, help='path to a label store built from the labels table (see simple_wikidata_db/label_store.py). If given, labels are looked up in it instead of loading --labels_dir')
     parser.add_argument('--properties_file', type=str, default='/data/yury/wikidata/properties/en.json', help='path to properties file')
+    parser.add_argument('--properties_dir', type=str, default=None, help='path to the properties table written by simple_wikidata_db/preprocess_dump.py. If given, property labels are taken from it instead of --properties_file')
     parser.add_argument('--input_json', type=str, required=True, help='Path to input JSON file')
     parser.add_argument('--num_procs', type=int, default=40, help='Number of processes')
+    parser.add_argument('--stream', action='store_true', help='Decode the input chunk by chunk instead of loading it, keeping the layout of the input')
+    parser.add_argument('--chunk_size', type=int, default=1 << 24, help='Number of characters read at a time with --stream')
     return parser
 
 def load_labels_chunk(filename):
@@ -22,10 +30,35 @@ def load_labels_chunk(filename):
             labels[item['qid']] = item['label']
     return labels
 
+def load_labels(labels_dir, num_procs):
+    print("Loading labels...")
+    label_files = get_batch_files(labels_dir)
+    pool = Pool(processes=num_procs)
+    labels = {}
+    for chunk_labels in tqdm(
+        pool.imap_unordered(load_labels_chunk, label_files, chunksize=1),
+        total=len(label_files),
+        desc="Loading label files"
+    ):
+        labels.update(chunk_labels)
+    pool.close()
+    pool.join()
+    print(f"Loaded {len(labels)} labels")
+    return labels
+
 def load_properties(filename):
     with open(filename, 'r') as f:
         return json.load(f)
 
+def load_properties_table(properties_dir):
+    """ Returns the labels of the properties in the properties table, in the same format as load_properties """
+    properties = {}
+    for filename in sorted(get_batch_files(properties_dir)):
+        for item in jsonl_generator(filename):
+            if item.get('label') is not None:
+                properties[item['property_id']] = item['label']
+    return properties
+
 def decode_term(term, labels, properties):
     if term.startswith('Q'):
         return labels.get(term, term)
@@ -39,6 +72,48 @@ def decode_key(key, labels, properties):
     
     return re.sub(r'[PQ]\d+', replace_match, key)
 
+ID_PATTERN = re.compile(r'[PQ]\d+')
+# characters at the end of a chunk which may be the start of an ID continued in the next chunk
+TAIL_PATTERN = re.compile(r'[PQ\d]+$')
+
+def resolve_terms(terms, labels, properties):
+    """ Returns the decoded term of each ID of a batch, looking up the labels of all its QIDs at once """
+    qids = [term for term in terms if term.startswith('Q')]
+    if hasattr(labels, 'get_many'):
+        qid_labels = labels.get_many(qids)
+    else:
+        qid_labels = [labels.get(qid) for qid in qids]
+    decoded = {term: properties.get(term, term) for term in terms if term.startswith('P')}
+    decoded.update({qid: qid if label is None else label for qid, label in zip(qids, qid_labels)})
+    return decoded
+
+def stream_decode(input_file, output_file, labels, properties, chunk_size=1 << 24):
+    """
+    Decodes the IDs of a JSON file without parsing it: the text is read chunk by chunk, the IDs of each chunk which
+    haven't been seen yet are resolved in one batch, and the chunk is written with every ID replaced by its label
+    (escaped for a JSON string). As only IDs are replaced, the output keeps the layout of the input, and is the same
+    as decoding the parsed JSON, except that keys which decode to the same label are all kept.
+    """
+    # decoded IDs, escaped, so each distinct ID is resolved once
+    replacements = {}
+    tail = ''
+    with open(input_file, 'r') as infile, open(output_file, 'w') as outfile:
+        while True:
+            chunk = infile.read(chunk_size)
+            text = tail + chunk
+            tail = ''
+            if chunk:
+                match = TAIL_PATTERN.search(text)
+                if match is not None:
+                    text, tail = text[:match.start()], text[match.start():]
+            new_terms = set(ID_PATTERN.findall(text)).difference(replacements)
+            for term, decoded in resolve_terms(new_terms, labels, properties).items():
+                replacements[term] = json.dumps(decoded)[1:-1]
+            outfile.write(ID_PATTERN.sub(lambda match: replacements[match.group(0)], text))
+            if not chunk:
+                break
+    print(f"Decoded {len(replacements)} distinct IDs")
+
 def decode_json(data, labels, properties):
     if isinstance(data, dict):
         return {
@@ -55,28 +130,31 @@ def decode_json(data, labels, properties):
 def main():
     args = get_arg_parser().parse_args()
 
-    print("Loading labels...")
-    label_files = get_batch_files(args.labels_dir)
-    pool = Pool(processes=args.num_procs)
-    labels = {}
-    for chunk_labels in tqdm(
-        pool.imap_unordered(load_labels_chunk, label_files, chunksize=1),
-        total=len(label_files),
-        desc="Loading label files"
-    ):
-        labels.update(chunk_labels)
-    print(f"Loaded {len(labels)} labels")
+    if args.label_store is not None:
+        labels = LabelStore(args.label_store)
+        print(f"Using the store of {len(labels)} labels in {args.label_store}")
+    else:
+        labels = load_labels(args.labels_dir, args.num_procs)
 
     print("Loading properties...")
-    properties = load_properties(args.properties_file)
+    if args.properties_dir is not None:
+        properties = load_properties_table(args.properties_dir)
+    else:
+        properties = load_properties(args.properties_file)
     print(f"Loaded {len(properties)} properties")
 
+    output_file = args.input_json.replace('.json', '_decoded.json')
+    if args.stream:
+        print("Decoding input JSON...")
+        stream_decode(args.input_json, output_file, labels, properties, args.chunk_size)
+        print(f"Decoded JSON saved to {output_file}")
+        return
+
     print("Loading and decoding input JSON...")
     with open(args.input_json, 'r') as infile:
         input_data = json.load(infile)
 
     decoded_data = decode_json(input_data, labels, properties)
-    output_file = args.input_json.replace('.json', '_decoded.json')
     print("Saving decoded JSON...")
     with open(output_file, 'w') as outfile:
         json.dump(decoded_data, outfile, indent=2)
@@ -0,0 +1,238 @@
+"""In-memory graph of entity_rels triples for the constraint search
+"""
+
+import numpy as np
+
+from simple_wikidata_db.utils import parse_id
+
+# a (property_id, value) key is stored as one integer, property number * KEY_SHIFT + value number
+KEY_SHIFT = 1 << 40
+
+
+def csr_pointers(sorted_ids, size):
+    """ Returns the offsets of each id in an array sorted by id (size + 1 offsets) """
+    return np.concatenate([[0], np.cumsum(np.bincount(sorted_ids, minlength=size))]).astype(np.int64)
+
+
+def first_appearance_ids(values):
+    """
+    Numbers the distinct values of an array in the order they first appear. Returns the distinct values (sorted), the
+    number of each of them, and the number of each element of the array.
+    """
+    distinct, first_index, inverse = np.unique(values, return_index=True, return_inverse=True)
+    ids = np.empty(len(distinct), dtype=np.int64)
+    ids[np.argsort(first_index, kind='stable')] = np.arange(len(distinct))
+    return distinct, ids, ids[inverse.reshape(-1)]
+
+
+class Triples:
+    def __init__(self, qid, property_id, value, claim_id=None):
+        """
+        (qid, property_id, value) triples of entity_rels as parallel arrays of ID numbers (Q42 -> 42, P31 -> 31), which
+        take a few tens of bytes per triple instead of a dict of strings. The claim IDs are only kept if requested.
+        """
+        self.qid = np.asarray(qid, dtype=np.int64)
+        self.property_id = np.asarray(property_id, dtype=np.int32)
+        self.value = np.asarray(value, dtype=np.int64)
+        self.claim_id = claim_id
+
+    @classmethod
+    def from_rows(cls, rows, claim_ids=False):
+        """ Converts entity_rels rows. Rows whose IDs aren't Q/P numbers are skipped, as in the columnar tables. """
+        qid = np.array([parse_id(row.get('qid'), 'Q') for row in rows], dtype=np.int64)
+        property_id = np.array([parse_id(row.get('property_id'), 'P') for row in rows], dtype=np.int64)
+        value = np.array([parse_id(row.get('value'), 'Q') for row in rows], dtype=np.int64)
+        claim_id = [row.get('claim_id') for row in rows] if claim_ids else None
+        triples = cls(qid, property_id, value, claim_id)
+        return triples.select((qid >= 0) & (property_id >= 0) & (value >= 0))
+
+    @classmethod
+    def concatenate(cls, parts):
+        parts = list(parts)
+        claim_id = None
+        if parts and all(part.claim_id is not None for part in parts):
+            claim_id = [c for part in parts for c in part.claim_id]
+        return cls(
+            np.concatenate([part.qid for part in parts]) if parts else np.zeros(0, dtype=np.int64),
+            np.concatenate([part.property_id for part in parts]) if parts else np.zeros(0, dtype=np.int32),
+            np.concatenate([part.value for part in parts]) if parts else np.zeros(0, dtype=np.int64),
+            claim_id
+        )
+
+    def __len__(self):
+        return len(self.qid)
+
+    def select(self, mask):
+        """ Returns the triples set in a boolean mask, in the same order """
+        claim_id = None if self.claim_id is None else [c for c, keep in zip(self.claim_id, mask.tolist()) if keep]
+        return Triples(self.qid[mask], self.property_id[mask], self.value[mask], claim_id)
+
+
+def key_code(property_id, value):
+    """ Returns the code of a (property_id, value) key (e.g. ('P31', 'Q5')), or None if they aren't P/Q IDs """
+    property_num, value_num = parse_id(property_id, 'P'), parse_id(value, 'Q')
+    if property_num < 0 or value_num < 0:
+        return None
+    return property_num * KEY_SHIFT + value_num
+
+
+def key_code_strings(code):
+    """ Returns the (property_id, value) of a key code """
+    code = int(code)
+    return f"P{code // KEY_SHIFT}", f"Q{code % KEY_SHIFT}"
+
+
+class QidNumbering:
+    """
+    Numbering of the entities of a graph. Sets of entities are passed around as sorted arrays of these numbers.
+    Subclasses set sorted_qids, sorted_qid_ids and qids (e.g. with number_qids), and implement with_key.
+    """
+    def number_qids(self, qid):
+        """
+        Numbers the entities of an array of QID numbers, and returns the number of each element. Sets sorted_qids (the
+        distinct QID numbers, sorted), sorted_qid_ids (the number in the graph of each of them) and qids (the QID
+        number of each entity, by number in the graph).
+        """
+        self.sorted_qids, self.sorted_qid_ids, edge_qids = first_appearance_ids(qid)
+        self.qids = np.empty(len(self.sorted_qids), dtype=np.int64)
+        self.qids[self.sorted_qid_ids] = self.sorted_qids
+        return edge_qids
+
+    def qid_id(self, qid):
+        """ Returns the number of an entity (e.g. 'Q42') in the graph, or None if it has no triples """
+        position = np.searchsorted(self.sorted_qids, parse_id(qid, 'Q'))
+        if position == len(self.sorted_qids) or self.sorted_qids[position] != parse_id(qid, 'Q'):
+            return None
+        return int(self.sorted_qid_ids[position])
+
+    def qid_array(self, qids):
+        """ Returns the sorted numbers of the given QIDs, leaving out the ones without triples """
+        numbers = np.array([parse_id(qid, 'Q') for qid in qids], dtype=np.int64)
+        if len(self.sorted_qids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.sorted_qids, numbers), len(self.sorted_qids) - 1)
+        found = self.sorted_qids[positions] == numbers
+        return np.unique(self.sorted_qid_ids[positions[found]])
+
+    def qid_strings(self, qid_array):
+        return [f"Q{qid}" for qid in self.qids[qid_array].tolist()]
+
+    def qid_mask(self, qid_array):
+        mask = np.zeros(len(self.qids), dtype=bool)
+        mask[qid_array] = True
+        return mask
+
+    def with_key(self, property_id, value):
+        """ Returns the sorted numbers of the entities with a triple (property_id, value) """
+        raise NotImplementedError
+
+    def filter_chain(self, qid_array, chain):
+        """ Returns the entities of qid_array which have a triple (property, item) for every [item, property] of chain """
+        for item, property_id in chain:
+            qid_array = np.intersect1d(qid_array, self.with_key(property_id, item), assume_unique=True)
+            if len(qid_array) == 0:
+                break
+        return qid_array
+
+
+class TripleGraph(QidNumbering):
+    def __init__(self, triples):
+        """
+        Holds (qid, property_id, value) triples as compressed sparse row arrays in both directions: for each entity
+        the (property_id, value) keys of its triples, and for each key the entities having it. Entities and keys are
+        numbered in the order they first appear in triples, and sets of entities are passed around as sorted arrays of
+        these numbers, so filtering and counting are vectorized numpy operations. Duplicate triples (e.g. from two
+        claims with the same value) are kept, as they count twice in the property bank.
+        :param triples: entity_rels triples, see Triples
+        """
+        edge_qids = self.number_qids(triples.qid)
+        key_codes = triples.property_id.astype(np.int64) * KEY_SHIFT + triples.value
+        self.sorted_keys, self.sorted_key_ids, edge_keys = first_appearance_ids(key_codes)
+        # key code of each key, by its number in the graph
+        self.keys = np.empty(len(self.sorted_keys), dtype=np.int64)
+        self.keys[self.sorted_key_ids] = self.sorted_keys
+
+        # qid -> keys, with the position of each triple, so that the keys of a set of entities can be ordered as
+        # their triples are
+        order = np.argsort(edge_qids, kind='stable')
+        self.edge_qids = edge_qids[order]
+        self.qid_keys = edge_keys[order]
+        self.qid_edges = order
+        self.qid_ptr = csr_pointers(self.edge_qids, len(self.qids))
+        # key -> qids, in the order of the triples
+        order = np.argsort(edge_keys, kind='stable')
+        self.key_qids = edge_qids[order]
+        self.key_ptr = csr_pointers(edge_keys[order], len(self.keys))
+
+    def __len__(self):
+        """ Number of triples """
+        return len(self.edge_qids)
+
+    def key_id(self, property_id, value):
+        """ Returns the number of a (property_id, value) key in the graph, or None if no triple has it """
+        code = key_code(property_id, value)
+        if code is None:
+            return None
+        position = np.searchsorted(self.sorted_keys, code)
+        if position == len(self.sorted_keys) or self.sorted_keys[position] != code:
+            return None
+        return int(self.sorted_key_ids[position])
+
+    def key_strings(self, key):
+        """ Returns the (property_id, value) of a key by number, e.g. ('P31', 'Q5') """
+        return key_code_strings(self.keys[key])
+
+    def with_key(self, property_id, value):
+        """ Returns the sorted numbers of the entities with a triple (property_id, value) """
+        key = self.key_id(property_id, value)
+        if key is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(self.key_qids[self.key_ptr[key]:self.key_ptr[key + 1]])
+
+    def keys_of(self, qid):
+        """ Returns the (property_id, value) keys of the triples of an entity """
+        i = self.qid_id(qid)
+        if i is None:
+            return []
+        return [self.key_strings(key) for key in self.qid_keys[self.qid_ptr[i]:self.qid_ptr[i + 1]]]
+
+    def key_counts(self, qid_array):
+        """ Returns the number of triples of the given entities with each key, indexed by key number """
+        mask = self.qid_mask(qid_array)
+        return np.bincount(self.qid_keys[mask[self.edge_qids]], minlength=len(self.keys))
+
+    def key_members(self, key, mask):
+        """
+        Returns the QIDs (one per triple, in the order of the triples) of the entities with a key (by number) among
+        those set in mask
+        """
+        members = self.key_qids[self.key_ptr[key]:self.key_ptr[key + 1]]
+        return self.qid_strings(members[mask[members]])
+
+    def key_groups(self, qid_array, keep, min_count=1, max_members=None):
+        """
+        Groups the triples of the given entities by (property_id, value) key, for the keys accepted by
+        keep(property_id, value). Returns the rank of each property (its order of first appearance among the accepted
+        keys), and (property_id, value, count, QIDs) for the keys with at least min_count triples, in the order they
+        first appear in the triples of these entities. The QIDs (one per triple) are only listed for groups of at most
+        max_members triples.
+        """
+        mask = self.qid_mask(qid_array)
+        selected = mask[self.edge_qids]
+        keys = self.qid_keys[selected]
+        key_counts = np.bincount(keys, minlength=len(self.keys))
+        # keys of the selected triples, by first appearance among them
+        distinct, first_index = np.unique(keys[np.argsort(self.qid_edges[selected], kind='stable')], return_index=True)
+        property_ranks = {}
+        groups = []
+        for key in distinct[np.argsort(first_index, kind='stable')]:
+            prop, value = self.key_strings(key)
+            if not keep(prop, value):
+                continue
+            property_ranks.setdefault(prop, len(property_ranks))
+            count = int(key_counts[key])
+            if count < min_count:
+                continue
+            members = self.key_members(key, mask) if max_members is None or count <= max_members else None
+            groups.append((prop, value, count, members))
+        return property_ranks, groups
@@ -3,8 +3,11 @@ from tqdm import tqdm
 from multiprocessing import Pool
 from functools import partial
 from collections import Counter
+import numpy as np
 from utils import jsonl_generator, get_batch_files
 
+from simple_wikidata_db.columnar import load_columnar_table
+
 def get_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--data', type=str, default='/data/yury/wikidata/entity_rels', help='path to output directory')
@@ -13,6 +16,7 @@ def get_arg_parser():
     parser.add_argument('--qid_min', type=int, default=100, help='Minimum Qid number')
     parser.add_argument('--qid_max', type=int, default=1000, help='Maximum Qid number')
     parser.add_argument('--top_n', type=int, default=20, help='Number of top entities to display')
+    parser.add_argument('--columnar_dir', type=str, default=None, help='Path to a columnar entity_rels table. If given, it is scanned instead of --data')
     return parser
 
 def is_valid_qid(qid, qid_min, qid_max):
@@ -36,17 +40,27 @@ def filtering_func(args, filename):
         print(f"Error processing file {filename}: {e}")
     return filtered
 
+def columnar_counts(args):
+    table = load_columnar_table(args.columnar_dir)
+    values = table['value'][table['property_id'] == int(args.property[1:])]
+    values = values[(values >= args.qid_min) & (values <= args.qid_max)]
+    unique_values, counts = np.unique(values, return_counts=True)
+    return Counter({f"Q{value}": int(count) for value, count in zip(unique_values, counts)})
+
 def main():
     args = get_arg_parser().parse_args()
-    table_files = get_batch_files(args.data)
-    
-    with Pool(processes=args.num_procs) as pool:
-        results = Counter()
-        for partial_result in tqdm(
-            pool.imap_unordered(partial(filtering_func, args), table_files, chunksize=1),
-            total=len(table_files)
-        ):
-            results.update(partial_result)
+    if args.columnar_dir:
+        results = columnar_counts(args)
+    else:
+        table_files = get_batch_files(args.data)
+
+        with Pool(processes=args.num_procs) as pool:
+            results = Counter()
+            for partial_result in tqdm(
+                pool.imap_unordered(partial(filtering_func, args), table_files, chunksize=1),
+                total=len(table_files)
+            ):
+                results.update(partial_result)
 
     print(f"Top {args.top_n} entities by count (Qids range: {args.qid_min} - {args.qid_max}):")
     for entity, count in results.most_common(args.top_n):
@@ -5,20 +5,47 @@ from collections import defaultdict, Counter
 from functools import partial
 from multiprocessing import Pool
 from tqdm import tqdm
-from utils import jsonl_generator, get_batch_files
+from utils import jsonl_generator, get_batch_files, parse_id, qid_numbers, share_qids, attach_qids, contains_numbers
+from graph import Triples, TripleGraph
+from cache import SearchCache, data_snapshot
+from spill import GraphBuilder
+from results import JsonlResultWriter, convert_to_json_format, save_json_results
+from simple_wikidata_db.rel_index import load_rel_index, lookup_qid_strings
 import json
+import os
+import numpy as np
 import ast
+import heapq
+import itertools
+import resource
+import sys
+import time
 
 def get_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--data', type=str, default='/data/yury/wikidata/entity_rels', help='path to output directory')
-    parser.add_argument('--initial_conditions', type=str, required=True, help='Initial conditions as a string representation of a list of tuples, e.g., "[(\'Q6256\', \'P31\')]"')
+    parser.add_argument('--initial_conditions', type=str, required=False, help='Initial conditions as a string representation of a list of tuples, e.g., "[(\'Q6256\', \'P31\')]"')
     parser.add_argument('--num_procs', type=int, default=50, help='Number of processes')
     parser.add_argument('--max_depth', type=int, default=3, help='Maximum recursive depth')
     parser.add_argument('--min_group_size', type=int, default=20, help='Minimum group size to consider')
     parser.add_argument('--test', action='store_true', help='Run in test mode (process only first 50 files)')
     parser.add_argument('--blacklist', type=str, required=False, help='Path to JSON file containing blacklisted properties and items')
-    parser.add_argument('--output', type=str, required=True, help='Output JSON file path')
+    parser.add_argument('--output', type=str, required=False, help='Output JSON file path')
+    parser.add_argument('--batch', type=str, default=None, help='Path to a jsonl file of seeds to search with one shared scan of the data instead of --initial_conditions and --output, one {"initial_conditions": [{"item": ..., "property": ...}], "output": ...} per line')
+    parser.add_argument('--strategy', type=str, default='dfs', choices=['dfs', 'frontier', 'best_first'], help='dfs explores the chains depth first, one at a time. frontier expands all the chains of a depth in parallel (see --search_workers), in a deterministic order. best_first expands the best scored chain first (see --priority), until the budgets run out')
+    parser.add_argument('--search_workers', type=int, default=1, help='Number of processes expanding chains with --strategy frontier')
+    parser.add_argument('--priority', type=str, default='size', choices=['size', 'specificity'], help='Score of the chains with --strategy best_first: size expands the largest groups first, specificity the smallest ones')
+    parser.add_argument('--max_nodes', type=int, default=None, help='With --strategy best_first, stop after adding this many chains to the tree')
+    parser.add_argument('--time_budget', type=float, default=None, help='With --strategy best_first, stop after this many seconds')
+    parser.add_argument('--memory_budget', type=float, default=None, help='With --strategy best_first, stop once the resident memory of the process exceeds this many MB (the peak resident memory, loading included, on systems without /proc)')
+    parser.add_argument('--index_dir', type=str, default=None, help='Path to a (property, value) -> QIDs index of entity_rels (see simple_wikidata_db/rel_index.py). If present, the initial QIDs are looked up in it instead of scanning the data')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Directory caching the valid QIDs and filtered triples of the initial conditions, so that later runs on the same data skip scanning it')
+    parser.add_argument('--cache_size', type=float, default=1024, help='Size of the --cache_dir in MB, above which the least recently used entries are evicted. Seeds whose entry alone is larger are not cached')
+    parser.add_argument('--memory_limit', type=float, default=None, help='Memory ceiling in MB for the graph of a seed. Seeds with more triples are partitioned by property into files under --spill_dir, and grouped one partition at a time')
+    parser.add_argument('--spill_dir', type=str, default=None, help='Directory for the partitions of seeds over --memory_limit (the system temporary directory by default)')
+    parser.add_argument('--output_format', type=str, default='json', choices=['json', 'jsonl'], help='json writes the nested tree once the search is done. jsonl writes one line per chain as soon as it is searched, with the items as QID numbers (see results.py to convert it to json)')
+    parser.add_argument('--max_items', type=int, default=None, help='Write at most this many items per group')
+    parser.add_argument('--sample_items', action='store_true', help='With --max_items, write a random sample of the items of a group instead of the first ones')
     return parser
 
 def nested_dict():
@@ -43,61 +70,163 @@ def load_blacklist(blacklist_file):
         blacklist = json.load(f)
     return set(blacklist.get('properties', [])), set(blacklist.get('items', []))
 
-def find_qids(initial_conditions, filename, valid_qids):
-    qid_dict = {}
+# sorted numbers of the valid QIDs, shared with the filter_file workers by init_valid_qids
+valid_qid_numbers = None
+
+def init_valid_qids(shared_qids):
+    """ Pool initializer attaching the worker to the valid QIDs published with share_qids """
+    global valid_qid_numbers
+    valid_qid_numbers = attach_qids(shared_qids)
+
+def find_qids(initial_conditions, filename):
+    """ Returns the (qid, property, value) rows of a file which match any of the initial conditions """
+    conditions = {(prop, item) for item, prop in initial_conditions}
+    matches = []
     try:
         for entry in jsonl_generator(filename):
             if not isinstance(entry, dict):
                 print(f"Expected dict, but got {type(entry)}: {entry}")
                 continue
             
-            qid = entry.get('qid')
-            if valid_qids and qid not in valid_qids:
+            key = (entry.get('property_id'), entry.get('value'))
+            if key not in conditions:
                 continue
-            
-            prop = entry.get('property_id')
-            value = entry.get('value')
-            
-            if qid not in qid_dict:
-                qid_dict[qid] = set()
-            qid_dict[qid].add((prop, value))
+            matches.append((entry.get('qid'), key[0], key[1]))
     
     except Exception as e:
         print(f"Error processing file {filename}: {e}")
         return []
 
-    result_qids = set(qid_dict.keys())
-    for item, prop in initial_conditions:
-        result_qids &= {qid for qid, prop_values in qid_dict.items() if (prop, item) in prop_values}
-        if not result_qids:
-            return []
+    return matches
 
-    return [(qid, initial_conditions[-1][1], initial_conditions[-1][0]) for qid in result_qids]
+def intersect_conditions(initial_conditions, qid_sets):
+    """
+    Returns the QIDs which satisfy all the initial conditions, given the set of QIDs satisfying each one (keyed by
+    (property, item)). The smallest sets are intersected first, so the intermediate sets stay small.
+    """
+    condition_sets = sorted((qid_sets.get((prop, item), set()) for item, prop in initial_conditions), key=len)
+    result_qids = set(condition_sets[0])
+    for qids in condition_sets[1:]:
+        if not result_qids:
+            break
+        result_qids &= qids
+    return [(qid, initial_conditions[-1][1], initial_conditions[-1][0]) for qid in sorted(result_qids)]
 
-def filter_file(args):
-    filename, valid_qids = args
-    filtered_data = []
+def find_qids_in_index(initial_conditions, index_dir):
+    """ Same result as the first pass over all files, from the index. Returns None if the index can't answer. """
+    if index_dir is None or not os.path.exists(os.path.join(index_dir, 'meta.json')):
+        return None
+    index = load_rel_index(index_dir)
+    qid_sets = {}
+    for item, prop in initial_conditions:
+        qids = lookup_qid_strings(index, prop, item)
+        if qids is None:
+            return None
+        qid_sets[(prop, item)] = set(qids)
+    return intersect_conditions(initial_conditions, qid_sets)
+
+# number of rows checked against the valid QIDs at a time by filter_file
+FILTER_BATCH_SIZE = 1 << 16
+
+def select_valid_rows(rows, claim_ids=False):
+    """ Returns the triples of the rows whose QID is one of the valid QIDs shared with the pool """
+    qids = np.array([parse_id(row.get('qid'), 'Q') for row in rows], dtype=np.int64)
+    valid = contains_numbers(valid_qid_numbers, qids).tolist()
+    return Triples.from_rows([row for row, is_valid in zip(rows, valid) if is_valid], claim_ids)
+
+def filter_file(filename, claim_ids=False):
+    """
+    Returns the triples of a file whose QID is one of the valid QIDs shared with the pool. The rows are checked a batch
+    at a time as the file is read, so only the matching ones are kept and converted to triples.
+    """
+    parts = []
+    batch = []
     try:
         for entry in jsonl_generator(filename):
             if not isinstance(entry, dict):
                 continue
-            if entry.get('qid') in valid_qids:
-                filtered_data.append(entry)
+            batch.append(entry)
+            if len(batch) >= FILTER_BATCH_SIZE:
+                parts.append(select_valid_rows(batch, claim_ids))
+                batch = []
     except Exception as e:
         print(f"Error processing file {filename}: {e}")
-    return filtered_data
-
-def filter_data_files(data_files, valid_qids, num_procs):
-    pool = Pool(processes=num_procs)
-    filtered_results = list(tqdm(
-        pool.imap_unordered(filter_file, [(filename, valid_qids) for filename in data_files]),
-        total=len(data_files),
-        desc="Filtering data files"
-    ))
-    pool.close()
-    pool.join()
-
-    return [item for sublist in filtered_results for item in sublist]
+    parts.append(select_valid_rows(batch, claim_ids))
+    return Triples.concatenate(parts)
+
+def iter_filtered_files(data_files, valid_qids, num_procs, claim_ids=False):
+    """
+    Yields the triples of the valid QIDs of each file, in the order of the files, as each file is filtered. They are
+    kept as arrays of ID numbers (see Triples), without their claim IDs unless claim_ids is set.
+    """
+    # the valid QIDs are published once to the workers, rather than pickled with every file
+    shm, shared_qids = share_qids(valid_qids)
+    pool = Pool(processes=num_procs, initializer=init_valid_qids, initargs=(shared_qids,))
+    try:
+        yield from tqdm(
+            pool.imap(partial(filter_file, claim_ids=claim_ids), data_files),
+            total=len(data_files),
+            desc="Filtering data files"
+        )
+    finally:
+        pool.close()
+        pool.join()
+        shm.close()
+        shm.unlink()
+
+def filter_data_files(data_files, valid_qids, num_procs, claim_ids=False):
+    """ Returns the triples of the valid QIDs, in the order of the files (see iter_filtered_files) """
+    return Triples.concatenate(iter_filtered_files(data_files, valid_qids, num_procs, claim_ids))
+
+def load_seeds(batch_file):
+    """
+    Reads the seeds of a batch, one json object per line with the initial conditions (in the format of
+    --initial_conditions, as a string or a list) and the output file. Returns a list of (initial_conditions, output).
+    """
+    seeds = []
+    with open(batch_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            seed = json.loads(line)
+            conditions = seed['initial_conditions']
+            if isinstance(conditions, str):
+                conditions = ast.literal_eval(conditions)
+            seeds.append(([(condition['item'], condition['property']) for condition in conditions], seed['output']))
+    return seeds
+
+def find_seed_qids(seeds, data_files, num_procs, index_dir=None):
+    """
+    First pass of all the seeds of a batch: the seeds the index can't answer share a single scan of the data files for
+    the union of their conditions, which are then combined per seed. Returns the valid QIDs of each seed.
+    """
+    seed_triples = [find_qids_in_index(initial_conditions, index_dir) for initial_conditions, _ in seeds]
+    conditions = sorted({condition for (initial_conditions, _), triples in zip(seeds, seed_triples) if triples is None
+                         for condition in initial_conditions})
+    if conditions:
+        print(f"First pass: Collecting triples of {len(conditions)} conditions")
+        pool = Pool(processes=num_procs)
+        triple_results = list(tqdm(
+            pool.imap_unordered(partial(find_qids, conditions), data_files),
+            total=len(data_files),
+            desc="Finding initial QIDs"
+        ))
+        pool.close()
+        pool.join()
+        qid_sets = defaultdict(set)
+        for matches in triple_results:
+            for qid, prop, value in matches:
+                qid_sets[(prop, value)].add(qid)
+        seed_triples = [intersect_conditions(initial_conditions, qid_sets) if triples is None else triples
+                        for (initial_conditions, _), triples in zip(seeds, seed_triples)]
+    return [{triple[0] for triple in triples} for triples in seed_triples]
+
+def route_triples(triples, seed_numbers):
+    """
+    Splits filtered triples by seed, keeping their order. A triple goes to every seed having its QID.
+    :param seed_numbers: sorted QID numbers of each seed
+    """
+    return [triples.select(contains_numbers(numbers, triples.qid)) for numbers in seed_numbers]
 
 def property_item_counts(property_bank, seen_items={}):
     property_item_counts = {}
@@ -113,18 +242,17 @@ def filter_results_by_count(filtered_results, min_group_size=10, max_group_size=
             filtered_property_bank[p] = filtered_q_counts
     return filtered_property_bank
 
-def next_q_p(item, property_id, data_files, filtered_data, num_procs, initial_conditions=None, valid_qids=None, seen_properties=None, blacklisted_properties=None, seen_items=None, blacklisted_items=None, min_group_size=20):
-    seen_properties = seen_properties or set()
-    seen_items = seen_items or set()
-    blacklisted_properties = blacklisted_properties or set()
-    blacklisted_items = blacklisted_items or set()
-
-    if valid_qids is None:
+def find_valid_qids(initial_conditions, data_files, num_procs, index_dir=None):
+    """ First pass: returns the QIDs satisfying all the initial conditions """
+    all_triples = find_qids_in_index(initial_conditions, index_dir)
+    if all_triples is not None:
+        print("First pass: Looking up triples in the index")
+    else:
         print("First pass: Collecting triples")
         pool = Pool(processes=num_procs)
         triple_results = list(tqdm(
             pool.imap_unordered(
-                partial(find_qids, initial_conditions, valid_qids=None),
+                partial(find_qids, initial_conditions),
                 data_files
             ),
             total=len(data_files),
@@ -132,35 +260,68 @@ def next_q_p(item, property_id, data_files, filtered_data, num_procs, initial_co
         ))
         pool.close()
         pool.join()
-        
-        all_triples = [triple for sublist in triple_results for triple in sublist]
-        valid_qids = {triple[0] for triple in all_triples}
+
+        # the rows of an entity can be spread over several files, so the conditions are combined over all of them
+        qid_sets = defaultdict(set)
+        for matches in triple_results:
+            for qid, prop, value in matches:
+                qid_sets[(prop, value)].add(qid)
+        all_triples = intersect_conditions(initial_conditions, qid_sets)
+    return {triple[0] for triple in all_triples}
+
+def next_q_p(item, property_id, data_files, graph, num_procs, initial_conditions=None, valid_qids=None, seen_properties=None, blacklisted_properties=None, seen_items=None, blacklisted_items=None, min_group_size=20, max_group_size=None, index_dir=None):
+    seen_properties = seen_properties or set()
+    seen_items = seen_items or set()
+    blacklisted_properties = blacklisted_properties or set()
+    blacklisted_items = blacklisted_items or set()
+
+    if valid_qids is None:
+        valid_qids = find_valid_qids(initial_conditions, data_files, num_procs, index_dir)
         print(f"Found {len(valid_qids)} valid QIDs")
         
-        if filtered_data is None:
+        if graph is None:
             print("Filtering data files based on valid QIDs...")
             filtered_data = filter_data_files(data_files, valid_qids, num_procs)
+            graph = TripleGraph(filtered_data)
+            print(f"Loaded {len(graph)} triples of {len(graph.qids)} QIDs into the graph")
+        valid_qids = graph.qid_array(valid_qids)
     else:
         print(f"Using {len(valid_qids)} pre-existing valid QIDs")
     
+    filtered_results, item_groups = collect_properties(graph, valid_qids, seen_properties, blacklisted_properties, seen_items, blacklisted_items, min_group_size, max_group_size)
+    return filtered_results, valid_qids, item_groups, graph
+
+def collect_properties(graph, valid_qids, seen_properties, blacklisted_properties, seen_items, blacklisted_items, min_group_size=1, max_group_size=None):
+    """
+    Counts the (property, value) pairs of the valid QIDs which are neither seen nor blacklisted. Pairs with fewer than
+    min_group_size QIDs are left out, as no result or child chain can use them, and the QIDs of a pair are only listed
+    if there are at most max_group_size of them.
+    """
     print("Collecting properties and values...")
     property_bank = defaultdict(Counter)
     item_groups = defaultdict(lambda: defaultdict(list))
-    for entry in tqdm(filtered_data, desc="Processing filtered data"):
-        if (entry.get('qid') in valid_qids and
-            entry.get('property_id') not in seen_properties and
-            entry.get('property_id') not in blacklisted_properties and
-            entry.get('value') not in seen_items and
-            entry.get('value') not in blacklisted_items and
-            (entry.get('value'), entry.get('property_id')) not in seen_items):
-            property_bank[entry.get('property_id')][entry.get('value')] += 1
-            item_groups[entry.get('property_id')][entry.get('value')].append(entry.get('qid'))
+    # the conditions only depend on the (property, value) key, so they are checked once per key of the valid QIDs
+    def keep(prop, value):
+        return (prop not in seen_properties and
+                prop not in blacklisted_properties and
+                value not in seen_items and
+                value not in blacklisted_items and
+                (value, prop) not in seen_items)
+    property_ranks, groups = graph.key_groups(valid_qids, keep, min_group_size, max_group_size)
+    # the properties are added in the order of their first kept pair, even if it is too small, so that the search
+    # visits them in the same order as if small pairs were counted
+    for prop in sorted(property_ranks, key=property_ranks.get):
+        property_bank[prop]
+    for prop, value, count, members in tqdm(groups, desc="Processing filtered data"):
+        property_bank[prop][value] = count
+        if members is not None:
+            item_groups[prop][value] = members
     
     print("Filtering out seen and blacklisted items...")
     filtered_results = property_item_counts(property_bank, seen_items.union(blacklisted_items))
-    return filtered_results, valid_qids, item_groups, filtered_data
+    return filtered_results, item_groups
 
-def search_distributor(initial_conditions, data_files, num_procs, max_depth, min_group_size, max_group_size, blacklisted_items=None, blacklisted_properties=None, depth=0, seen_items=None, seen_properties=None, chain=None, valid_qids=None, filtered_data=None):
+def search_distributor(initial_conditions, data_files, num_procs, max_depth, min_group_size, max_group_size, blacklisted_items=None, blacklisted_properties=None, depth=0, seen_items=None, seen_properties=None, chain=None, valid_qids=None, graph=None, index_dir=None, writer=None):
     if depth >= max_depth:
         return None
 
@@ -196,14 +357,14 @@ def search_distributor(initial_conditions, data_files, num_procs, max_depth, min
     seen_properties.add(property_id)
 
     if depth == 0:
-        current_results, new_valid_qids, item_groups, filtered_data = next_q_p(item, property_id, data_files, filtered_data, num_procs, initial_conditions=initial_conditions, seen_properties=seen_properties, blacklisted_properties=blacklisted_properties, seen_items=seen_items, blacklisted_items=blacklisted_items, valid_qids=valid_qids)
+        current_results, new_valid_qids, item_groups, graph = next_q_p(item, property_id, data_files, graph, num_procs, initial_conditions=initial_conditions, seen_properties=seen_properties, blacklisted_properties=blacklisted_properties, seen_items=seen_items, blacklisted_items=blacklisted_items, valid_qids=valid_qids, min_group_size=min_group_size, max_group_size=max_group_size, index_dir=index_dir)
     else:
-        current_results, new_valid_qids, item_groups, filtered_data = next_q_p(item, property_id, data_files, filtered_data, num_procs, seen_properties=seen_properties, blacklisted_properties=blacklisted_properties, seen_items=seen_items, blacklisted_items=blacklisted_items, valid_qids=valid_qids)
+        current_results, new_valid_qids, item_groups, graph = next_q_p(item, property_id, data_files, graph, num_procs, seen_properties=seen_properties, blacklisted_properties=blacklisted_properties, seen_items=seen_items, blacklisted_items=blacklisted_items, valid_qids=valid_qids, min_group_size=min_group_size, max_group_size=max_group_size)
 
     if valid_qids is None:
         valid_qids = new_valid_qids
     else:
-        valid_qids = valid_qids.intersection(new_valid_qids)
+        valid_qids = np.intersect1d(valid_qids, new_valid_qids, assume_unique=True)
 
     in_range_results = filter_results_by_count(current_results, min_group_size, max_group_size)
     over_results = filter_results_by_count(current_results, min_group_size=min_group_size * 2)
@@ -218,6 +379,8 @@ def search_distributor(initial_conditions, data_files, num_procs, max_depth, min
         "item_groups": item_groups,
         "children": {}
     }
+    if writer is not None:
+        writer.write_node(result)
 
     for new_property, new_items in over_results.items():
         for new_item, count in new_items.items():
@@ -230,89 +393,372 @@ def search_distributor(initial_conditions, data_files, num_procs, max_depth, min
                 new_depth = depth + 1
                 
                 # Filter valid_qids to only those that satisfy the entire chain
-                chain_valid_qids = valid_qids
-                for chain_item, chain_property in chain + [[new_item, new_property]]:
-                    chain_valid_qids = {qid for qid in chain_valid_qids if any(
-                        entry.get('qid') == qid and entry.get('property_id') == chain_property and entry.get('value') == chain_item
-                        for entry in filtered_data
-                    )}
+                chain_valid_qids = graph.filter_chain(valid_qids, chain + [[new_item, new_property]])
                 
-                if not chain_valid_qids:
+                if len(chain_valid_qids) == 0:
                     continue  # Skip this branch if no QIDs satisfy the entire chain
                 
                 child_result = search_distributor((new_item, new_property), data_files, num_procs, max_depth, 
                                                   min_group_size, max_group_size, blacklisted_items, 
                                                   blacklisted_properties, depth=new_depth, seen_items=seen_items, 
                                                   seen_properties=seen_properties, chain=chain + [[new_item, new_property]],
-                                                  valid_qids=chain_valid_qids, filtered_data=filtered_data)
+                                                  valid_qids=chain_valid_qids, graph=graph, writer=writer)
                 if child_result:
                     result["children"][f"{new_property}, {new_item}"] = child_result
 
     return result
 
-def convert_to_json_format(result):
-    def format_chain(chain):
-        formatted_chain = []
-        for pair in chain:
-            if isinstance(pair, list) and len(pair) == 2:
-                formatted_chain.extend([f"[{pair[1]}]", f"[{pair[0]}]"])
-            elif isinstance(pair, str):
-                formatted_chain.append(f"[{pair}]")
-        return ", ".join(formatted_chain)
-
-    def process_node(node):
-        json_data = {}
-        chain = node.get('chain', [])
-        
-        path_string = format_chain(chain)
-        json_data[path_string] = {}
-        
-        for property_id, items in node['results'].items():
-            property_path = f"{path_string}, [{property_id}]"
-            json_data[path_string][property_path] = {}
-            
-            for item, count in items.items():
-                item_path = f"{property_path}, [{item}]"
-                json_data[path_string][property_path][item_path] = {
-                    "count": count,
-                    "items": node["item_groups"].get(property_id, {}).get(item, [])[:] # Limit to first 10 items
-                }
-        
-        for child_key, child_node in node['children'].items():
-            child_data = process_node(child_node)
-            json_data[path_string].update(child_data)
-        
-        return json_data
-    
-    return process_node(result)
+# state shared by the processes expanding chains with the frontier strategy, set by init_frontier_worker
+frontier_state = {}
+
+def init_frontier_worker(graph, blacklisted_items, blacklisted_properties, min_group_size, max_group_size, seen_items, seen_properties):
+    """
+    Pool initializer: the graph, the search parameters and the seen items/properties at the start of the depth are
+    sent once to each worker, not with every chain
+    """
+    frontier_state.update(graph=graph, blacklisted_items=blacklisted_items, blacklisted_properties=blacklisted_properties,
+                          min_group_size=min_group_size, max_group_size=max_group_size, seen_items=seen_items,
+                          seen_properties=seen_properties)
+
+def chain_candidates(graph, chain, valid_qids, over_results, seen_properties, blacklisted_items, blacklisted_properties):
+    """ Returns the (property, item, count, QIDs satisfying the chain) pairs which can extend a chain """
+    candidates = []
+    for new_property, new_items in over_results.items():
+        for new_item, count in new_items.items():
+            if (new_property in seen_properties or
+                new_item in blacklisted_items or
+                new_property in blacklisted_properties):
+                continue
+            chain_valid_qids = graph.filter_chain(valid_qids, chain + [[new_item, new_property]])
+            if len(chain_valid_qids) > 0:
+                candidates.append((new_property, new_item, count, chain_valid_qids))
+    return candidates
+
+def expand_chain(task):
+    """
+    Computes the results of a chain, and the candidates to extend it if expand is set, given the seen items and
+    properties at the start of its depth plus its own chain key and property. Runs in the frontier workers.
+    """
+    chain, valid_qids, chain_key, property_id, expand = task
+    seen_items = frontier_state['seen_items'] | {chain_key}
+    seen_properties = frontier_state['seen_properties'] | {property_id}
+    graph = frontier_state['graph']
+    blacklisted_items = frontier_state['blacklisted_items']
+    blacklisted_properties = frontier_state['blacklisted_properties']
+    current_results, item_groups = collect_properties(graph, valid_qids, seen_properties, blacklisted_properties, seen_items, blacklisted_items, frontier_state['min_group_size'], frontier_state['max_group_size'])
+    in_range_results = filter_results_by_count(current_results, frontier_state['min_group_size'], frontier_state['max_group_size'])
+    candidates = []
+    if expand:
+        over_results = filter_results_by_count(current_results, min_group_size=frontier_state['min_group_size'] * 2)
+        candidates = chain_candidates(graph, chain, valid_qids, over_results, seen_properties, blacklisted_items, blacklisted_properties)
+    # only the groups which make it to the output are sent back
+    item_groups = {p: {item: item_groups[p][item] for item in items} for p, items in in_range_results.items()}
+    return in_range_results, item_groups, candidates
+
+def search_root(initial_conditions, data_files, num_procs, min_group_size, max_group_size, blacklisted_items, blacklisted_properties, index_dir=None, graph=None, valid_qids=None):
+    """
+    Runs the first pass for the initial conditions, like the first call of search_distributor. Returns the root of
+    the tree, its results before the group size filter, its valid QIDs, the graph and the seen items and properties,
+    or None if the initial conditions are blacklisted. The first pass is skipped if the graph and the valid QIDs (as
+    graph numbers) are given.
+    """
+    seen_items = set()
+    seen_properties = set()
+    chain = []
+    for initial_item, initial_prop in initial_conditions:
+        seen_items.add((initial_item, initial_prop))
+        seen_properties.add(initial_prop)
+        chain.append([initial_item, initial_prop])
+    item, property_id = initial_conditions[-1]
+    chain_key = tuple((str(i), str(p)) for i, p in chain)
+    if chain_key in seen_items or item in blacklisted_items or property_id in blacklisted_properties:
+        return None
+    seen_items.add(chain_key)
+    seen_properties.add(property_id)
 
-def save_json_results(results, output_file):
-    with open(output_file, 'w') as f:
-        json.dump(results, f, indent=2)
+    current_results, valid_qids, item_groups, graph = next_q_p(item, property_id, data_files, graph, num_procs, initial_conditions=initial_conditions, valid_qids=valid_qids, seen_properties=seen_properties, blacklisted_properties=blacklisted_properties, seen_items=seen_items, blacklisted_items=blacklisted_items, min_group_size=min_group_size, max_group_size=max_group_size, index_dir=index_dir)
+    root = {
+        "chain": chain,
+        "results": filter_results_by_count(current_results, min_group_size, max_group_size),
+        "item_groups": item_groups,
+        "children": {}
+    }
+    return root, current_results, valid_qids, graph, seen_items, seen_properties
+
+def frontier_search(initial_conditions, data_files, num_procs, max_depth, min_group_size, max_group_size, blacklisted_items=None, blacklisted_properties=None, search_workers=1, index_dir=None, graph=None, valid_qids=None, writer=None):
+    """
+    Same search as search_distributor, but level by level: all the chains of a depth are expanded in parallel with
+    the seen items/properties of the start of the depth (plus their own chain and property), then their children are
+    merged into the tree (and into the seen sets) in the order of their parents and of the results. A property is still only explored once, by the first
+    chain which reaches it in breadth-first order, so the tree can differ from the depth-first one, but it doesn't
+    depend on the number of workers.
+    """
+    if max_depth <= 0:
+        return None
+    blacklisted_items = blacklisted_items or set()
+    blacklisted_properties = blacklisted_properties or set()
+    searched = search_root(initial_conditions, data_files, num_procs, min_group_size, max_group_size, blacklisted_items, blacklisted_properties, index_dir, graph, valid_qids)
+    if searched is None:
+        return None
+    root, current_results, valid_qids, graph, seen_items, seen_properties = searched
+    if writer is not None:
+        writer.write_node(root)
+    over_results = filter_results_by_count(current_results, min_group_size=min_group_size * 2)
+    candidates = [chain_candidates(graph, root["chain"], valid_qids, over_results, seen_properties, blacklisted_items, blacklisted_properties)]
+    frontier = [root]
+
+    depth = 1
+    while depth < max_depth and frontier:
+        # the chains of the depth are all expanded with the seen sets of its start, before its chains are merged in
+        depth_state = (graph, blacklisted_items, blacklisted_properties, min_group_size, max_group_size, set(seen_items), set(seen_properties))
+        # merge the children of the previous depth, in a deterministic order
+        next_frontier = []
+        tasks = []
+        for node, node_candidates in zip(frontier, candidates):
+            for new_property, new_item, count, chain_valid_qids in node_candidates:
+                new_chain = node["chain"] + [[new_item, new_property]]
+                new_chain_key = tuple((str(i), str(p)) for i, p in new_chain)
+                if new_chain_key in seen_items or new_property in seen_properties:
+                    continue
+                print(f"Adding to search: Property {new_property}, Item {new_item}, Count {count}")
+                seen_items.add(new_chain_key)
+                seen_properties.add(new_property)
+                child = {"chain": new_chain, "results": {}, "item_groups": {}, "children": {}}
+                node["children"][f"{new_property}, {new_item}"] = child
+                next_frontier.append(child)
+                tasks.append((new_chain, chain_valid_qids, new_chain_key, new_property, depth + 1 < max_depth))
+        print(f"Expanding {len(tasks)} chains at depth {depth}")
+        if search_workers > 1 and len(tasks) > 1:
+            # a pool per depth, whose workers get the seen sets of the depth once, in their initializer
+            pool = Pool(processes=search_workers, initializer=init_frontier_worker, initargs=depth_state)
+            expanded = pool.map(expand_chain, tasks, chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            init_frontier_worker(*depth_state)
+            expanded = [expand_chain(task) for task in tasks]
+        candidates = []
+        for node, (in_range_results, node_item_groups, node_candidates) in zip(next_frontier, expanded):
+            node["results"] = in_range_results
+            node["item_groups"] = node_item_groups
+            candidates.append(node_candidates)
+            if writer is not None:
+                writer.write_node(node)
+        frontier = next_frontier
+        depth += 1
+    return root
+
+def current_memory_mb():
+    """
+    Resident memory of the process, in MB. It is read from /proc where there is one, elsewhere (e.g. macOS) the peak
+    resident memory so far is used, which includes the memory of loading the data even once it is freed.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+    except (OSError, ValueError):
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, KB elsewhere
+        return max_rss / (1 << 20) if sys.platform == 'darwin' else max_rss / (1 << 10)
+
+def budget_exhausted(num_nodes, start_time, max_nodes=None, time_budget=None, memory_budget=None):
+    """ Returns why the search has to stop, or None if it is within its budgets """
+    if max_nodes is not None and num_nodes >= max_nodes:
+        return f"added {num_nodes} chains"
+    if time_budget is not None and time.time() - start_time >= time_budget:
+        return f"ran for {time.time() - start_time:.1f}s"
+    if memory_budget is not None:
+        memory_mb = current_memory_mb()
+        if memory_mb >= memory_budget:
+            return f"uses {memory_mb:.0f}MB"
+    return None
+
+def best_first_search(initial_conditions, data_files, num_procs, max_depth, min_group_size, max_group_size, blacklisted_items=None, blacklisted_properties=None, priority='size', max_nodes=None, time_budget=None, memory_budget=None, index_dir=None, graph=None, valid_qids=None, writer=None):
+    """
+    Same search as search_distributor, but the candidate chains of the whole tree are kept in a priority queue, and the
+    best one is expanded first: the largest group with priority='size', the smallest with 'specificity'. As in the
+    other strategies, a property is only explored once, by the first chain expanded with it. The search stops when
+    there is nothing left to expand or a budget runs out, and returns the tree built so far.
+    """
+    start_time = time.time()
+    if max_depth <= 0:
+        return None
+    blacklisted_items = blacklisted_items or set()
+    blacklisted_properties = blacklisted_properties or set()
+    searched = search_root(initial_conditions, data_files, num_procs, min_group_size, max_group_size, blacklisted_items, blacklisted_properties, index_dir, graph, valid_qids)
+    if searched is None:
+        return None
+    root, current_results, valid_qids, graph, seen_items, seen_properties = searched
+    if writer is not None:
+        writer.write_node(root)
+
+    queue = []
+    # breaks ties between equal scores in the order the candidates were found
+    sequence = itertools.count()
+    def push_candidates(node, node_results, node_valid_qids, depth):
+        # the children of a chain are only kept below max_depth, and the QIDs satisfying a child chain are only
+        # computed when it is expanded
+        if depth + 1 >= max_depth:
+            return
+        over_results = filter_results_by_count(node_results, min_group_size=min_group_size * 2)
+        for new_property, new_items in over_results.items():
+            for new_item, count in new_items.items():
+                if new_item in blacklisted_items or new_property in blacklisted_properties:
+                    continue
+                score = -count if priority == 'size' else count
+                heapq.heappush(queue, (score, next(sequence), node, node_valid_qids, new_property, new_item, count, depth + 1))
+
+    push_candidates(root, current_results, valid_qids, 0)
+    num_nodes = 0
+    while queue:
+        stop_reason = budget_exhausted(num_nodes, start_time, max_nodes, time_budget, memory_budget)
+        if stop_reason is not None:
+            print(f"Stopping the search with {len(queue)} chains left to expand: {stop_reason}")
+            break
+        _, _, node, node_valid_qids, new_property, new_item, count, depth = heapq.heappop(queue)
+        new_chain = node["chain"] + [[new_item, new_property]]
+        new_chain_key = tuple((str(i), str(p)) for i, p in new_chain)
+        if new_chain_key in seen_items or new_property in seen_properties:
+            continue
+        chain_valid_qids = graph.filter_chain(node_valid_qids, new_chain)
+        if len(chain_valid_qids) == 0:
+            continue
+        print(f"Adding to search: Property {new_property}, Item {new_item}, Count {count}")
+        seen_items.add(new_chain_key)
+        seen_properties.add(new_property)
+        child_results, child_item_groups = collect_properties(graph, chain_valid_qids, seen_properties, blacklisted_properties, seen_items, blacklisted_items, min_group_size, max_group_size)
+        child = {
+            "chain": new_chain,
+            "results": filter_results_by_count(child_results, min_group_size, max_group_size),
+            "item_groups": child_item_groups,
+            "children": {}
+        }
+        node["children"][f"{new_property}, {new_item}"] = child
+        if writer is not None:
+            writer.write_node(child)
+        num_nodes += 1
+        push_candidates(child, child_results, chain_valid_qids, depth)
+    return root
+
+def run_search(args, initial_conditions, data_files, blacklisted_items, blacklisted_properties, graph=None, valid_qids=None, writer=None):
+    """ Searches from the initial conditions with the strategy of args. The first pass is skipped if graph and valid_qids are given. """
+    if args.strategy == 'best_first':
+        return best_first_search(initial_conditions, data_files, args.num_procs, max_depth=args.max_depth,
+                                 min_group_size=args.min_group_size, max_group_size=args.min_group_size*2,
+                                 blacklisted_items=blacklisted_items, blacklisted_properties=blacklisted_properties,
+                                 priority=args.priority, max_nodes=args.max_nodes, time_budget=args.time_budget,
+                                 memory_budget=args.memory_budget, index_dir=args.index_dir, graph=graph,
+                                 valid_qids=valid_qids, writer=writer)
+    elif args.strategy == 'frontier':
+        return frontier_search(initial_conditions, data_files, args.num_procs, max_depth=args.max_depth,
+                               min_group_size=args.min_group_size, max_group_size=args.min_group_size*2,
+                               blacklisted_items=blacklisted_items, blacklisted_properties=blacklisted_properties,
+                               search_workers=args.search_workers, index_dir=args.index_dir, graph=graph,
+                               valid_qids=valid_qids, writer=writer)
+    return search_distributor(initial_conditions, data_files, args.num_procs, max_depth=args.max_depth,
+                              min_group_size=args.min_group_size, max_group_size=args.min_group_size*2,
+                              blacklisted_items=blacklisted_items, blacklisted_properties=blacklisted_properties,
+                              index_dir=args.index_dir, graph=graph, valid_qids=valid_qids, writer=writer)
+
+def search_and_save(args, initial_conditions, output_file, data_files, blacklisted_items, blacklisted_properties, graph=None, valid_qids=None):
+    """ Runs the search (see run_search) and writes its results to output_file in the format of args """
+    if args.output_format == 'jsonl':
+        writer = JsonlResultWriter(output_file, args.max_items, args.sample_items)
+        run_search(args, initial_conditions, data_files, blacklisted_items, blacklisted_properties, graph, valid_qids, writer)
+        writer.close()
+        print(f"Results of {writer.num_nodes} chains saved to {output_file}")
+        return
+    result = run_search(args, initial_conditions, data_files, blacklisted_items, blacklisted_properties, graph, valid_qids)
+    if result:
+        json_results = convert_to_json_format(result, args.max_items, args.sample_items)
+        save_json_results(json_results, output_file)
+        print(f"Results saved to {output_file}")
+    else:
+        print("No results found.")
+
+def load_seed_data(seeds, data_files, num_procs, index_dir=None, cache=None, memory_limit_mb=None, spill_dir=None):
+    """
+    Returns the valid QIDs of every seed, and a GraphBuilder holding its filtered triples (see spill.py). The seeds
+    which aren't in the cache share a single first pass and a single filtering pass over the data files, for the union
+    of their valid QIDs. The triples of each file are routed to the seeds (and written to the cache) as the file is
+    filtered, so the triples of a seed over memory_limit_mb go to disk without ever being held in memory together.
+    """
+    seed_qids = [None] * len(seeds)
+    builders = [GraphBuilder(memory_limit_mb, spill_dir) for _ in seeds]
+    missing = []
+    for seed, (initial_conditions, _) in enumerate(seeds):
+        cached = cache.get(initial_conditions) if cache is not None else None
+        if cached is None:
+            missing.append(seed)
+            continue
+        print(f"Loaded the valid QIDs and triples of {initial_conditions} from the cache")
+        seed_qids[seed], parts = cached
+        for triples in parts:
+            builders[seed].add(triples)
+    if not missing:
+        return seed_qids, builders
+
+    missing_qids = find_seed_qids([seeds[seed] for seed in missing], data_files, num_procs, index_dir)
+    all_qids = set().union(*missing_qids)
+    print(f"Found {len(all_qids)} valid QIDs for {len(missing)} seeds")
+    seed_numbers = [np.unique(qid_numbers(qids)) for qids in missing_qids]
+    writers = [cache.open_entry(seeds[seed][0], qids) if cache is not None else None
+               for seed, qids in zip(missing, missing_qids)]
+    print("Filtering data files based on valid QIDs...")
+    for file_triples in iter_filtered_files(data_files, all_qids, num_procs):
+        for seed, writer, triples in zip(missing, writers, route_triples(file_triples, seed_numbers)):
+            builders[seed].add(triples)
+            if writer is not None:
+                writer.add(triples)
+    for seed, qids, writer in zip(missing, missing_qids, writers):
+        seed_qids[seed] = qids
+        if writer is not None:
+            writer.close()
+    return seed_qids, builders
+
+def batch_search(args, seeds, data_files, blacklisted_items, blacklisted_properties, cache=None):
+    """
+    Runs the search of every seed from a single scan of the data files (see load_seed_data). Each seed is searched on a
+    graph of its own triples, so its output is the same as when it is run alone. Graphs over --memory_limit are
+    spilled to disk (see GraphBuilder).
+    """
+    seed_qids, builders = load_seed_data(seeds, data_files, args.num_procs, args.index_dir, cache, args.memory_limit,
+                                         args.spill_dir)
+    for seed, (initial_conditions, output_file) in enumerate(seeds):
+        print(f"Searching seed {seed + 1}/{len(seeds)}: {initial_conditions}")
+        graph = builders[seed].build()
+        # the triples of a seed are only needed until its graph is built
+        builders[seed] = None
+        print(f"Loaded {len(graph)} triples of {len(graph.qids)} QIDs into the graph")
+        search_and_save(args, initial_conditions, output_file, data_files, blacklisted_items, blacklisted_properties,
+                        graph=graph, valid_qids=graph.qid_array(seed_qids[seed]))
 
 def main():
     parser = get_arg_parser()
     args = parser.parse_args()
+    if args.batch is None and (args.initial_conditions is None or args.output is None):
+        parser.error("--initial_conditions and --output are required without --batch")
     blacklisted_properties, blacklisted_items = load_blacklist(args.blacklist) if args.blacklist else (set(), set())
 
-    data_files = get_batch_files(args.data)
+    # sorted, so that the rows (and the order in which the search visits properties) are the same from run to run
+    data_files = sorted(get_batch_files(args.data))
     if args.test:
         data_files = data_files[:50]
-    
+
+    cache = SearchCache(args.cache_dir, args.cache_size, data_snapshot(data_files)) if args.cache_dir else None
+
+    if args.batch is not None:
+        batch_search(args, load_seeds(args.batch), data_files, blacklisted_items, blacklisted_properties, cache)
+        return
+
     initial_conditions = ast.literal_eval(args.initial_conditions)
     # Convert the list of dictionaries to a list of tuples
     initial_conditions = [(condition['item'], condition['property']) for condition in initial_conditions]
-    
-    result = search_distributor(initial_conditions, data_files, args.num_procs, max_depth=args.max_depth, 
-                                min_group_size=args.min_group_size, max_group_size=args.min_group_size*2,
-                                blacklisted_items=blacklisted_items, blacklisted_properties=blacklisted_properties)
-    
-    if result:
-        json_results = convert_to_json_format(result)
-        save_json_results(json_results, args.output)
-        print(f"Results saved to {args.output}")
-    else:
-        print("No results found.")
+
+    if cache is not None or args.memory_limit is not None:
+        batch_search(args, [(initial_conditions, args.output)], data_files, blacklisted_items, blacklisted_properties, cache)
+        return
+    search_and_save(args, initial_conditions, args.output, data_files, blacklisted_items, blacklisted_properties)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
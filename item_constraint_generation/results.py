@@ -0,0 +1,141 @@
+# example (converts a jsonl output of recursive_search.py back to the nested JSON format):
+#  python3 item_constraint_generation/results.py --input out/out_instance_country.jsonl --output out/out_instance_country.json
+import argparse
+import json
+import random
+
+from simple_wikidata_db.utils import parse_id
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, required=True, help='Path to a jsonl output of recursive_search.py')
+    parser.add_argument('--output', type=str, required=True, help='Output JSON file path')
+    parser.add_argument('--max_items', type=int, default=None, help='Keep at most this many items per group')
+    parser.add_argument('--sample_items', action='store_true', help='With --max_items, keep a random sample of the items of a group instead of the first ones')
+    return parser
+
+def limit_items(items, max_items=None, sample_items=False, seed=''):
+    """
+    Returns at most max_items of a group's items: the first ones, or a random sample (in their original order) if
+    sample_items is set. The sample only depends on the items and the seed (e.g. the path of the group), so it is the
+    same from run to run.
+    """
+    if max_items is None or len(items) <= max_items:
+        return items
+    if not sample_items:
+        return items[:max_items]
+    positions = sorted(random.Random(seed).sample(range(len(items)), max_items))
+    return [items[position] for position in positions]
+
+def format_chain(chain):
+    formatted_chain = []
+    for pair in chain:
+        if isinstance(pair, list) and len(pair) == 2:
+            formatted_chain.extend([f"[{pair[1]}]", f"[{pair[0]}]"])
+        elif isinstance(pair, str):
+            formatted_chain.append(f"[{pair}]")
+    return ", ".join(formatted_chain)
+
+def convert_to_json_format(result, max_items=None, sample_items=False):
+    def process_node(node):
+        json_data = {}
+        chain = node.get('chain', [])
+
+        path_string = format_chain(chain)
+        json_data[path_string] = {}
+
+        for property_id, items in node['results'].items():
+            property_path = f"{path_string}, [{property_id}]"
+            json_data[path_string][property_path] = {}
+
+            for item, count in items.items():
+                item_path = f"{property_path}, [{item}]"
+                json_data[path_string][property_path][item_path] = {
+                    "count": count,
+                    "items": limit_items(node["item_groups"].get(property_id, {}).get(item, []), max_items,
+                                         sample_items, item_path)
+                }
+
+        for child_key, child_node in node['children'].items():
+            child_data = process_node(child_node)
+            json_data[path_string].update(child_data)
+
+        return json_data
+
+    return process_node(result)
+
+def save_json_results(results, output_file):
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent=2)
+
+class JsonlResultWriter:
+    def __init__(self, output_file, max_items=None, sample_items=False):
+        """
+        Writes the nodes of a search tree to a jsonl file as the search computes them, one line per node:
+        {"chain": [[item, property], ...], "results": {property: {item: {"count": count, "items": [QID numbers]}}}}
+        Once written, the item groups of a node are dropped from the tree, so only the counts stay in memory. The
+        nodes of a subtree come after its root, and siblings in the order of the tree, so load_jsonl_results can
+        rebuild it.
+        """
+        self.output_file = output_file
+        self.max_items = max_items
+        self.sample_items = sample_items
+        self.f = open(output_file, 'w')
+        self.num_nodes = 0
+
+    def write_node(self, node):
+        results = {}
+        for property_id, items in node['results'].items():
+            results[property_id] = {}
+            for item, count in items.items():
+                members = node['item_groups'].get(property_id, {}).get(item, [])
+                # sampled as in convert_to_json_format
+                item_path = f"{format_chain(node['chain'])}, [{property_id}], [{item}]"
+                members = limit_items(members, self.max_items, self.sample_items, item_path)
+                results[property_id][item] = {"count": count, "items": [parse_id(qid, 'Q') for qid in members]}
+        self.f.write(json.dumps({"chain": node['chain'], "results": results}, separators=(',', ':')) + '\n')
+        node['item_groups'] = {}
+        self.num_nodes += 1
+
+    def close(self):
+        self.f.close()
+
+def load_jsonl_results(input_file):
+    """ Rebuilds the search tree written by a JsonlResultWriter, or returns None if it has no nodes """
+    root = None
+    nodes = {}
+    with open(input_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            node = {
+                "chain": entry['chain'],
+                "results": {p: {item: group['count'] for item, group in items.items()}
+                            for p, items in entry['results'].items()},
+                "item_groups": {p: {item: [f"Q{qid}" for qid in group['items']] for item, group in items.items()}
+                                for p, items in entry['results'].items()},
+                "children": {}
+            }
+            chain = tuple(tuple(pair) for pair in node['chain'])
+            if root is None:
+                root = node
+            else:
+                parent = nodes[chain[:-1]]
+                item, property_id = node['chain'][-1]
+                parent['children'][f"{property_id}, {item}"] = node
+            nodes[chain] = node
+    return root
+
+def main():
+    args = get_arg_parser().parse_args()
+    result = load_jsonl_results(args.input)
+    if result is None:
+        print("No results found.")
+        return
+    save_json_results(convert_to_json_format(result, args.max_items, args.sample_items), args.output)
+    print(f"Results saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Disk-backed graph of entity_rels triples, for seeds whose graph doesn't fit in memory
+"""
+
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+from graph import KEY_SHIFT, QidNumbering, TripleGraph, Triples, key_code, key_code_strings
+
+from simple_wikidata_db.utils import parse_id
+
+# bytes taken by a triple in a TripleGraph and its construction, and in a partition of a SpilledGraph while the
+# partition is built or grouped
+GRAPH_BYTES_PER_TRIPLE = 72
+SPILLED_BYTES_PER_TRIPLE = 64
+# (qid, value, position) record of a triple in the file of its property, before the partitions are built
+RECORD_FIELDS = 3
+
+
+class SpilledGraph(QidNumbering):
+    def __init__(self, memory_limit_mb, spill_dir=None):
+        """
+        Same queries as TripleGraph, with the triples partitioned by property into temporary files instead of being
+        indexed in memory. Triples are added a file at a time with append, which writes each of them to the file of its
+        property, and finish then packs the properties into partitions. Each partition holds the triples of a range of
+        properties, sorted by key then position, and fits in half of memory_limit_mb, so the keys of a set of entities
+        are grouped one partition at a time. Only the numbering of the entities stays in memory: entities are numbered
+        in QID order, merging the QIDs of the appended triples in batches as they come. The files are removed when the
+        graph is garbage collected.
+        :param spill_dir: directory in which to create the partitions (the system temporary directory by default)
+        """
+        self.memory_limit_mb = memory_limit_mb
+        self.num_triples = 0
+        self.path = tempfile.mkdtemp(prefix='recursive_search_', dir=spill_dir)
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.path, True)
+        self.property_counts = np.zeros(0, dtype=np.int64)
+        self.sorted_qids = np.zeros(0, dtype=np.int64)
+        # distinct QIDs of the triples appended since the last merge into sorted_qids
+        self.pending_qids = []
+        self.num_pending = 0
+
+    def __getstate__(self):
+        # copies sent to other processes use the partitions of the original, which removes them
+        state = dict(self.__dict__)
+        del state['_cleanup']
+        return state
+
+    def __len__(self):
+        """ Number of triples """
+        return self.num_triples
+
+    def property_file(self, property_num):
+        return os.path.join(self.path, f"P{property_num}.bin")
+
+    def partition_file(self, partition, name):
+        return os.path.join(self.path, f"{partition}_{name}.npy")
+
+    def append(self, triples):
+        """ Writes triples (see Triples) to the files of their properties, after the triples appended before """
+        if len(triples) == 0:
+            return
+        records = np.empty((len(triples), RECORD_FIELDS), dtype=np.int64)
+        records[:, 0] = triples.qid
+        records[:, 1] = triples.value
+        records[:, 2] = np.arange(self.num_triples, self.num_triples + len(triples))
+        order = np.argsort(triples.property_id, kind='stable')
+        property_nums, starts, counts = np.unique(triples.property_id[order], return_index=True, return_counts=True)
+        for property_num, start, count in zip(property_nums.tolist(), starts.tolist(), counts.tolist()):
+            with open(self.property_file(property_num), 'ab') as f:
+                records[order[start:start + count]].tofile(f)
+        counts = np.bincount(triples.property_id)
+        if len(counts) > len(self.property_counts):
+            self.property_counts = np.pad(self.property_counts, (0, len(counts) - len(self.property_counts)))
+        self.property_counts[:len(counts)] += counts
+        self.num_triples += len(triples)
+
+        distinct = np.unique(triples.qid)
+        self.pending_qids.append(distinct)
+        self.num_pending += len(distinct)
+        # merging once the pending QIDs outnumber the merged ones bounds both the pending QIDs and the merging time
+        if self.num_pending > len(self.sorted_qids):
+            self.merge_qids()
+
+    def merge_qids(self):
+        self.sorted_qids = np.unique(np.concatenate([self.sorted_qids] + self.pending_qids))
+        self.pending_qids = []
+        self.num_pending = 0
+
+    def finish(self):
+        """ Builds the partitions from the files of the properties, and returns the graph """
+        self.merge_qids()
+        self.sorted_qid_ids = np.arange(len(self.sorted_qids), dtype=np.int64)
+        self.qids = self.sorted_qids
+
+        # properties are packed in increasing order into partitions of at most max_rows triples (a property with more
+        # triples gets a partition of its own). A partition takes up to half of the memory limit, leaving the rest to
+        # the groups built from it.
+        max_rows = max(1, int(self.memory_limit_mb * (1 << 20)) // (2 * SPILLED_BYTES_PER_TRIPLE))
+        partitions = []
+        rows = max_rows
+        for property_num in self.property_counts.nonzero()[0]:
+            if rows + self.property_counts[property_num] > max_rows:
+                partitions.append([])
+                rows = 0
+            partitions[-1].append(property_num)
+            rows += self.property_counts[property_num]
+        # partition of each property number, -1 if it has no triples
+        self.partition_of = np.full(len(self.property_counts), -1, dtype=np.int64)
+        for partition, property_nums in enumerate(partitions):
+            self.partition_of[property_nums] = partition
+            records = np.concatenate([
+                np.fromfile(self.property_file(property_num), dtype=np.int64).reshape(-1, RECORD_FIELDS)
+                for property_num in property_nums
+            ])
+            key_codes = np.repeat(np.array(property_nums, dtype=np.int64), self.property_counts[property_nums]) \
+                * KEY_SHIFT + records[:, 1]
+            # the records of a property are in position order, so sorting by key keeps each key in position order
+            order = np.argsort(key_codes, kind='stable')
+            np.save(self.partition_file(partition, 'key'), key_codes[order])
+            np.save(self.partition_file(partition, 'qid'), np.searchsorted(self.sorted_qids, records[order, 0]))
+            np.save(self.partition_file(partition, 'position'), records[order, 2])
+            for property_num in property_nums:
+                os.remove(self.property_file(property_num))
+        self.num_partitions = len(partitions)
+        print(f"Spilled {self.num_triples} triples to {self.num_partitions} partitions in {self.path}")
+        return self
+
+    def load_partition(self, partition):
+        """ Memory-maps the key, qid and position arrays of a partition """
+        return {
+            name: np.load(self.partition_file(partition, name), mmap_mode='r') for name in ('key', 'qid', 'position')
+        }
+
+    def with_key(self, property_id, value):
+        """ Returns the sorted numbers of the entities with a triple (property_id, value) """
+        code = key_code(property_id, value)
+        property_num = parse_id(property_id, 'P')
+        if code is None or property_num >= len(self.partition_of) or self.partition_of[property_num] < 0:
+            return np.zeros(0, dtype=np.int64)
+        arrays = self.load_partition(self.partition_of[property_num])
+        start, end = np.searchsorted(arrays['key'], [code, code + 1])
+        return np.unique(arrays['qid'][start:end])
+
+    def key_groups(self, qid_array, keep, min_count=1, max_members=None):
+        """ Same as TripleGraph.key_groups, grouping the triples of one partition at a time """
+        mask = self.qid_mask(qid_array)
+        property_ranks = {}
+        groups = []
+        for partition in range(self.num_partitions):
+            arrays = self.load_partition(partition)
+            selected = mask[arrays['qid']]
+            keys = arrays['key'][selected]
+            qids = arrays['qid'][selected]
+            positions = arrays['position'][selected]
+            codes, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+            for code, start, count in zip(codes.tolist(), starts.tolist(), counts.tolist()):
+                prop, value = key_code_strings(code)
+                if not keep(prop, value):
+                    continue
+                # the triples of a key are sorted by position, so the first one is where the key first appears
+                rank = int(positions[start])
+                property_ranks[prop] = min(property_ranks.get(prop, rank), rank)
+                if count < min_count:
+                    continue
+                members = self.qid_strings(qids[start:start + count]) \
+                    if max_members is None or count <= max_members else None
+                groups.append((rank, prop, value, count, members))
+        groups.sort(key=lambda group: group[0])
+        return property_ranks, [group[1:] for group in groups]
+
+
+class GraphBuilder:
+    def __init__(self, memory_limit_mb=None, spill_dir=None):
+        """
+        Collects the triples of a graph a file at a time. They are kept in memory until the TripleGraph built from them
+        would exceed memory_limit_mb (if given), after which they go to a SpilledGraph as they are added.
+        """
+        self.memory_limit_mb = memory_limit_mb
+        self.spill_dir = spill_dir
+        self.parts = []
+        self.num_triples = 0
+        self.spilled = None
+
+    def add(self, triples):
+        self.num_triples += len(triples)
+        if self.spilled is not None:
+            self.spilled.append(triples)
+            return
+        self.parts.append(triples)
+        if self.memory_limit_mb is not None and \
+                self.num_triples * GRAPH_BYTES_PER_TRIPLE > self.memory_limit_mb * (1 << 20):
+            self.spilled = SpilledGraph(self.memory_limit_mb, self.spill_dir)
+            for part in self.parts:
+                self.spilled.append(part)
+            self.parts = []
+
+    def build(self):
+        """ Returns a TripleGraph of the triples, or the SpilledGraph they went to """
+        if self.spilled is not None:
+            return self.spilled.finish()
+        return TripleGraph(Triples.concatenate(self.parts))
+
@@ -0,0 +1,41 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import recursive_search
+from graph import Triples, TripleGraph
+from recursive_search import best_first_search
+
+ROWS = [
+    {'qid': qid, 'property_id': 'P31', 'value': 'Q6256'} for qid in ['Q1', 'Q2', 'Q3', 'Q4']
+] + [
+    {'qid': 'Q1', 'property_id': 'P30', 'value': 'Q46'},
+    {'qid': 'Q2', 'property_id': 'P30', 'value': 'Q46'},
+    {'qid': 'Q3', 'property_id': 'P37', 'value': 'Q188'},
+    {'qid': 'Q4', 'property_id': 'P37', 'value': 'Q188'},
+]
+
+def search(**budgets):
+    graph = TripleGraph(Triples.from_rows(ROWS))
+    root = best_first_search([('Q6256', 'P31')], [], 1, max_depth=2, min_group_size=1, max_group_size=2, graph=graph,
+                             valid_qids=graph.qid_array(['Q1', 'Q2', 'Q3', 'Q4']), **budgets)
+    return list(root['children'])
+
+def test_search_stops_on_each_budget(monkeypatch):
+    assert search() == ['P30, Q46', 'P37, Q188']
+    assert search(max_nodes=1) == ['P30, Q46']
+    assert search(time_budget=0) == []
+    monkeypatch.setattr(recursive_search, 'current_memory_mb', lambda: 100)
+    assert search(memory_budget=200) == ['P30, Q46', 'P37, Q188']
+    assert search(memory_budget=50) == []
+
+def test_memory_budget_counts_the_current_memory():
+    before = recursive_search.current_memory_mb()
+    loaded = np.ones(1 << 25)
+    assert recursive_search.current_memory_mb() > before + 200
+    del loaded
+    # memory freed after loading no longer counts, unlike the peak
+    assert recursive_search.current_memory_mb() < before + 100
@@ -0,0 +1,67 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cache import SearchCache, data_snapshot
+from graph import Triples
+
+TRIPLES = Triples.from_rows([
+    {'qid': 'Q1', 'property_id': 'P31', 'value': 'Q6256', 'claim_id': 'Q1$1'},
+    {'qid': 'Q1', 'property_id': 'P37', 'value': 'Q150', 'claim_id': 'Q1$2'},
+    {'qid': 'Q2', 'property_id': 'P31', 'value': 'Q6256', 'claim_id': 'Q2$1'},
+])
+
+def test_round_trip(tmp_path):
+    cache = SearchCache(str(tmp_path / 'cache'), 1, 'snapshot')
+    assert cache.get([('Q6256', 'P31')]) is None
+    cache.put([('Q6256', 'P31')], {'Q1', 'Q2'}, TRIPLES)
+    valid_qids, parts = cache.get([('Q6256', 'P31'), ('Q6256', 'P31')])
+    triples, = list(parts)
+    assert valid_qids == {'Q1', 'Q2'}
+    assert triples.qid.tolist() == [1, 1, 2]
+    assert triples.property_id.tolist() == [31, 37, 31]
+    assert triples.value.tolist() == [6256, 150, 6256]
+    assert SearchCache(str(tmp_path / 'cache'), 1, 'other snapshot').get([('Q6256', 'P31')]) is None
+
+def test_entries_are_written_and_read_in_parts(tmp_path):
+    cache = SearchCache(str(tmp_path / 'cache'), 1, 'snapshot')
+    writer = cache.open_entry([('Q6256', 'P31')], {'Q1', 'Q2'})
+    for qid in (1, 3, 2):
+        writer.add(TRIPLES.select(TRIPLES.qid == qid))
+    assert cache.get([('Q6256', 'P31')]) is None
+    writer.close()
+    valid_qids, parts = cache.get([('Q6256', 'P31')])
+    assert [part.qid.tolist() for part in parts] == [[1, 1], [], [2]]
+
+def test_entries_larger_than_the_cache_are_dropped(tmp_path):
+    cache = SearchCache(str(tmp_path / 'cache'), 1, 'snapshot')
+    cache.put([('Q5', 'P31')], {'Q1'}, TRIPLES)
+    cache.max_size = os.path.getsize(cache.entry_file([('Q5', 'P31')])) + 1
+    big = Triples.concatenate([TRIPLES] * 100)
+    writer = cache.open_entry([('Q6256', 'P31')], {'Q1', 'Q2'})
+    writer.add(big)
+    assert writer.dropped and not os.path.exists(writer.tmp_file)
+    writer.add(big)
+    writer.close()
+    assert cache.get([('Q6256', 'P31')]) is None
+    # the entries already in the cache are kept
+    assert cache.get([('Q5', 'P31')]) is not None
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = SearchCache(str(tmp_path / 'cache'), 1, 'snapshot')
+    cache.put([('Q6256', 'P31')], {'Q1', 'Q2'}, TRIPLES)
+    cache.put([('Q5', 'P31')], {'Q1'}, TRIPLES.select(TRIPLES.qid == 1))
+    entry_size = os.path.getsize(cache.entry_file([('Q6256', 'P31')]))
+    os.utime(cache.entry_file([('Q6256', 'P31')]), ns=(0, 0))
+    cache.max_size = entry_size + 1
+    cache.evict()
+    assert cache.get([('Q6256', 'P31')]) is None
+    assert cache.get([('Q5', 'P31')]) is not None
+
+def test_snapshot_changes_with_the_data(tmp_path):
+    data_file = tmp_path / 'rels.jsonl'
+    data_file.write_text('{"qid": "Q1", "property_id": "P31", "value": "Q5"}\n')
+    snapshot = data_snapshot([str(data_file)])
+    data_file.write_text('{"qid": "Q1", "property_id": "P31", "value": "Q6256"}\n')
+    assert data_snapshot([str(data_file)]) != snapshot
@@ -0,0 +1,30 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from decoding import decode_json, stream_decode
+
+LABELS = {'Q5': 'human', 'Q6256': 'country', 'Q142': 'Françe "la belle"', 'Q1234567': 'back\\slash'}
+PROPERTIES = {'P31': 'instance of', 'P17': 'country', 'P1082': 'population – total'}
+DATA = {
+    "[['Q6256', 'P31']]": {
+        "['Q142', 'P17']": ['Q142', 'Q1234567', 'Q99999'],
+        "['Q5', 'P1082']": ['Q5 and P31', 'P1082'],
+    },
+    "[['Q1234567', 'P17']]": {"['Q7', 'P31']": ['Q12', 'P99', '2024', 'Q5']},
+}
+
+def decode(tmp_path, chunk_size):
+    input_file, output_file = tmp_path / 'input.json', tmp_path / f'output_{chunk_size}.json'
+    with open(input_file, 'w') as f:
+        json.dump(DATA, f, indent=2)
+    stream_decode(str(input_file), str(output_file), LABELS, PROPERTIES, chunk_size)
+    return output_file.read_text()
+
+def test_chunks_split_ids_like_the_whole_text(tmp_path):
+    whole = decode(tmp_path, 1 << 24)
+    assert json.loads(whole) == decode_json(DATA, LABELS, PROPERTIES)
+    for chunk_size in (3, 7):
+        assert decode(tmp_path, chunk_size) == whole
@@ -0,0 +1,29 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from graph import Triples, TripleGraph
+from recursive_search import frontier_search
+
+ROWS = [
+    {'qid': qid, 'property_id': 'P31', 'value': 'Q6256'} for qid in ['Q1', 'Q2', 'Q3', 'Q4']
+] + [
+    {'qid': 'Q1', 'property_id': 'P30', 'value': 'Q46'},
+    {'qid': 'Q2', 'property_id': 'P30', 'value': 'Q46'},
+    {'qid': 'Q3', 'property_id': 'P30', 'value': 'Q15'},
+    {'qid': 'Q4', 'property_id': 'P30', 'value': 'Q15'},
+    {'qid': 'Q1', 'property_id': 'P37', 'value': 'Q150'},
+    {'qid': 'Q2', 'property_id': 'P37', 'value': 'Q150'},
+    {'qid': 'Q3', 'property_id': 'P37', 'value': 'Q188'},
+    {'qid': 'Q4', 'property_id': 'P37', 'value': 'Q188'},
+]
+
+def test_siblings_do_not_hide_each_others_properties():
+    graph = TripleGraph(Triples.from_rows(ROWS))
+    root = frontier_search([('Q6256', 'P31')], [], 1, max_depth=2, min_group_size=1, max_group_size=2, graph=graph,
+                           valid_qids=graph.qid_array(['Q1', 'Q2', 'Q3', 'Q4']))
+    assert list(root['children']) == ['P30, Q46', 'P37, Q150']
+    # P37 is explored by a sibling at the same depth, which doesn't hide it from this chain
+    assert root['children']['P30, Q46']['results'] == {'P37': {'Q150': 2}}
+    assert root['children']['P37, Q150']['results'] == {'P30': {'Q46': 2}}
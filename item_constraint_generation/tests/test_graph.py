@@ -0,0 +1,106 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from graph import Triples, TripleGraph
+from spill import GraphBuilder, SpilledGraph
+
+ROWS = [
+    {'qid': 'Q1', 'property_id': 'P31', 'value': 'Q6256'},
+    {'qid': 'Q1', 'property_id': 'P37', 'value': 'Q150'},
+    {'qid': 'Q2', 'property_id': 'P31', 'value': 'Q6256'},
+    {'qid': 'Q2', 'property_id': 'P37', 'value': 'Q1321'},
+    {'qid': 'Q3', 'property_id': 'P31', 'value': 'Q5'},
+    {'qid': 'Q1', 'property_id': 'P37', 'value': 'Q150'},
+    {'qid': 'Q3', 'property_id': 'P37', 'value': 'Q150'},
+]
+
+def test_with_key():
+    graph = TripleGraph(Triples.from_rows(ROWS))
+    assert graph.qid_strings(graph.with_key('P31', 'Q6256')) == ['Q1', 'Q2']
+    assert graph.qid_strings(graph.with_key('P37', 'Q150')) == ['Q1', 'Q3']
+    assert len(graph.with_key('P31', 'Q515')) == 0
+
+def test_keys_of():
+    graph = TripleGraph(Triples.from_rows(ROWS))
+    assert sorted(graph.keys_of('Q1')) == [('P31', 'Q6256'), ('P37', 'Q150'), ('P37', 'Q150')]
+    assert graph.keys_of('Q4') == []
+
+def test_filter_chain():
+    graph = TripleGraph(Triples.from_rows(ROWS))
+    qids = graph.qid_array(['Q1', 'Q2', 'Q3'])
+    assert graph.qid_strings(graph.filter_chain(qids, [['Q6256', 'P31'], ['Q150', 'P37']])) == ['Q1']
+    assert len(graph.filter_chain(qids, [['Q5', 'P31'], ['Q1321', 'P37']])) == 0
+
+def test_key_counts_keep_duplicate_triples():
+    graph = TripleGraph(Triples.from_rows(ROWS))
+    qids = graph.qid_array(['Q1', 'Q2'])
+    counts = graph.key_counts(qids)
+    assert counts[graph.key_id('P37', 'Q150')] == 2
+    assert counts[graph.key_id('P31', 'Q5')] == 0
+    members = graph.key_members(graph.key_id('P37', 'Q150'), graph.qid_mask(qids))
+    assert members == ['Q1', 'Q1']
+    assert np.array_equal(graph.qid_array(['Q2', 'Q1', 'Q9']), graph.qid_array(['Q1', 'Q2']))
+
+def test_triples_skip_rows_without_numeric_ids():
+    triples = Triples.from_rows(ROWS + [{'qid': 'Q4', 'property_id': 'P31', 'value': 'L7'}], claim_ids=True)
+    assert len(triples) == len(ROWS)
+    assert triples.claim_id == [None] * len(ROWS)
+    assert triples.value.dtype == np.int64 and triples.property_id.dtype == np.int32
+
+def spill(rows, tmp_path):
+    """ Builds a SpilledGraph of the rows, added in two parts as from two files """
+    builder = GraphBuilder(memory_limit_mb=1e-5, spill_dir=str(tmp_path))
+    for part in (rows[:len(rows) // 2], rows[len(rows) // 2:]):
+        builder.add(Triples.from_rows(part))
+    return builder.build()
+
+def test_spilled_graph_groups_like_the_in_memory_graph(tmp_path):
+    graph = TripleGraph(Triples.from_rows(ROWS))
+    spilled = spill(ROWS, tmp_path)
+    assert isinstance(spilled, SpilledGraph) and spilled.num_partitions == 2
+    assert sorted(os.listdir(spilled.path)) == sorted(f"{p}_{name}.npy" for p in range(2) for name in ('key', 'qid', 'position'))
+    qids = graph.qid_array(['Q1', 'Q2', 'Q3'])
+    spilled_qids = spilled.qid_array(['Q1', 'Q2', 'Q3'])
+    assert spilled.qid_strings(spilled.filter_chain(spilled_qids, [['Q6256', 'P31']])) == \
+        graph.qid_strings(graph.filter_chain(qids, [['Q6256', 'P31']]))
+    keep = lambda prop, value: value != 'Q5'
+    for min_count, max_members in [(1, None), (2, 2), (3, None)]:
+        in_memory_ranks, in_memory_groups = graph.key_groups(qids, keep, min_count, max_members)
+        spilled_ranks, spilled_groups = spilled.key_groups(spilled_qids, keep, min_count, max_members)
+        assert sorted(spilled_ranks, key=spilled_ranks.get) == sorted(in_memory_ranks, key=in_memory_ranks.get)
+        assert spilled_groups == in_memory_groups
+
+def test_graph_builder_keeps_small_graphs_in_memory():
+    builder = GraphBuilder(memory_limit_mb=1)
+    builder.add(Triples.from_rows(ROWS))
+    assert isinstance(builder.build(), TripleGraph)
+
+def baseline_groups(rows, qids, keep):
+    """ Groups the rows of qids by key as the search did over the filtered rows: in the order of the rows """
+    groups = {}
+    for row in rows:
+        if row['qid'] in qids and keep(row['property_id'], row['value']):
+            groups.setdefault(row['property_id'], {}).setdefault(row['value'], []).append(row['qid'])
+    return [(prop, value, len(members), members) for prop, values in groups.items() for value, members in values.items()]
+
+def test_key_groups_follow_the_rows_of_the_entities(tmp_path):
+    rows = [
+        {'qid': 'Q1', 'property_id': 'P37', 'value': 'Q150'},
+        {'qid': 'Q2', 'property_id': 'P463', 'value': 'Q1065'},
+        {'qid': 'Q2', 'property_id': 'P31', 'value': 'Q6256'},
+        {'qid': 'Q3', 'property_id': 'P30', 'value': 'Q46'},
+        {'qid': 'Q2', 'property_id': 'P30', 'value': 'Q46'},
+        {'qid': 'Q2', 'property_id': 'P37', 'value': 'Q150'},
+        {'qid': 'Q3', 'property_id': 'P463', 'value': 'Q1065'},
+    ]
+    triples = Triples.from_rows(rows)
+    keep = lambda prop, value: True
+    for graph in (TripleGraph(triples), spill(rows, tmp_path)):
+        property_ranks, groups = graph.key_groups(graph.qid_array(['Q2', 'Q3']), keep)
+        expected = baseline_groups(rows, {'Q2', 'Q3'}, keep)
+        assert groups == expected
+        assert sorted(property_ranks, key=property_ranks.get) == ['P463', 'P31', 'P30', 'P37']
@@ -0,0 +1,38 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from results import JsonlResultWriter, convert_to_json_format, limit_items, load_jsonl_results
+
+def make_tree():
+    child = {
+        "chain": [['Q6256', 'P31'], ['Q46', 'P30']],
+        "results": {'P37': {'Q150': 2}},
+        "item_groups": {'P37': {'Q150': ['Q142', 'Q31'], 'Q188': ['Q183']}},
+        "children": {}
+    }
+    return {
+        "chain": [['Q6256', 'P31']],
+        "results": {'P30': {'Q46': 3, 'Q15': 2}},
+        "item_groups": {'P30': {'Q46': ['Q142', 'Q31', 'Q183'], 'Q15': ['Q1033', 'Q117']}},
+        "children": {'P30, Q46': child}
+    }
+
+def test_jsonl_round_trip(tmp_path):
+    output_file = str(tmp_path / 'out.jsonl')
+    writer = JsonlResultWriter(output_file)
+    root = make_tree()
+    writer.write_node(root)
+    writer.write_node(root['children']['P30, Q46'])
+    writer.close()
+    assert root['item_groups'] == {}
+    assert convert_to_json_format(load_jsonl_results(output_file)) == convert_to_json_format(make_tree())
+
+def test_limit_items():
+    items = [f"Q{i}" for i in range(10)]
+    assert limit_items(items) == items
+    assert limit_items(items, 3) == ['Q0', 'Q1', 'Q2']
+    sample = limit_items(items, 3, sample_items=True, seed='path')
+    assert len(sample) == 3 and sample == sorted(sample, key=items.index)
+    assert limit_items(items, 3, sample_items=True, seed='path') == sample
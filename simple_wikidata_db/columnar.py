@@ -0,0 +1,135 @@
+""" Columnar entity_rels
+
+This script converts the entity_rels table written by preprocess_dump.py into a columnar binary table, where the
+qid, property_id and value of every row are stored as integer arrays (Q42 -> 42, P31 -> 31) and the claim IDs in a
+side file. The arrays can be memory-mapped with numpy, so scans over the table need no parsing, and processes reading
+the same table share the page cache.
+
+Layout of the output directory:
+    meta.json                   number of rows and dtype of each column
+    qid.bin, value.bin          int64 arrays
+    property_id.bin             int32 array
+    claim_ids.bin               utf-8 claim IDs, concatenated
+    claim_id_offsets.bin        int64 array of num_rows + 1 offsets into claim_ids.bin
+
+Example command:
+
+python3 -m simple_wikidata_db.columnar \
+    --data data/processed/entity_rels \
+    --out_dir data/processed/entity_rels_columnar
+
+"""
+import argparse
+import json
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+from tqdm import tqdm
+
+from simple_wikidata_db.utils import jsonl_generator, get_batch_files, parse_id
+
+COLUMNS = {'qid': '<i8', 'property_id': '<i4', 'value': '<i8'}
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='data/processed/entity_rels', help='path to entity_rels table')
+    parser.add_argument('--out_dir', type=str, default='data/processed/entity_rels_columnar',
+                        help='path to output directory')
+    parser.add_argument('--num_procs', type=int, default=10, help='Number of processes')
+    return parser
+
+
+def convert_file(filename):
+    """ Converts one entity_rels file to columns. Rows whose IDs aren't Q/P numbers are skipped. """
+    qids, property_ids, values, claim_ids = [], [], [], []
+    num_skipped = 0
+    for item in jsonl_generator(filename):
+        if not item:
+            continue
+        qid = parse_id(item['qid'], 'Q')
+        property_id = parse_id(item['property_id'], 'P')
+        value = parse_id(item['value'], 'Q')
+        if qid < 0 or property_id < 0 or value < 0:
+            num_skipped += 1
+            continue
+        qids.append(qid)
+        property_ids.append(property_id)
+        values.append(value)
+        claim_ids.append(item['claim_id'].encode('utf-8'))
+    columns = {
+        'qid': np.array(qids, dtype=COLUMNS['qid']),
+        'property_id': np.array(property_ids, dtype=COLUMNS['property_id']),
+        'value': np.array(values, dtype=COLUMNS['value']),
+    }
+    return columns, claim_ids, num_skipped
+
+
+def build_columnar_table(data_files, out_dir: Path, num_procs: int):
+    out_dir.mkdir(parents=True, exist_ok=True)
+    column_files = {name: open(out_dir / f"{name}.bin", 'wb') for name in COLUMNS}
+    claim_ids_file = open(out_dir / "claim_ids.bin", 'wb')
+    offsets_file = open(out_dir / "claim_id_offsets.bin", 'wb')
+
+    num_rows = 0
+    num_skipped = 0
+    claim_ids_size = 0
+    np.zeros(1, dtype='<i8').tofile(offsets_file)
+    pool = Pool(processes=num_procs)
+    # imap keeps the rows in the order of data_files, so the table is the same from one build to the next
+    for columns, claim_ids, file_skipped in tqdm(pool.imap(convert_file, data_files, chunksize=1),
+                                                 total=len(data_files), desc="Converting files"):
+        for name, column in columns.items():
+            column.tofile(column_files[name])
+        offsets = claim_ids_size + np.cumsum([len(c) for c in claim_ids], dtype='<i8')
+        offsets.tofile(offsets_file)
+        claim_ids_file.write(b''.join(claim_ids))
+        if len(claim_ids) > 0:
+            claim_ids_size = int(offsets[-1])
+        num_rows += len(claim_ids)
+        num_skipped += file_skipped
+    pool.close()
+    pool.join()
+
+    for f in list(column_files.values()) + [claim_ids_file, offsets_file]:
+        f.close()
+    with open(out_dir / "meta.json", 'w') as f:
+        json.dump({'num_rows': num_rows, 'columns': COLUMNS}, f, indent=2)
+    print(f"Wrote {num_rows} rows to {out_dir} (skipped {num_skipped} rows with non Q/P IDs)")
+
+
+def load_columnar_table(table_dir) -> Dict[str, np.ndarray]:
+    """ Memory-maps the columns of a table written by build_columnar_table """
+    table_dir = Path(table_dir)
+    with open(table_dir / "meta.json", 'r') as f:
+        meta = json.load(f)
+    num_rows = meta['num_rows']
+    if num_rows == 0:
+        # empty files can't be memory-mapped
+        return {name: np.zeros(0, dtype=dtype) for name, dtype in meta['columns'].items()}
+    return {
+        name: np.memmap(table_dir / f"{name}.bin", dtype=dtype, mode='r', shape=(num_rows,))
+        for name, dtype in meta['columns'].items()
+    }
+
+
+def load_claim_ids(table_dir, rows) -> List[str]:
+    """ Returns the claim IDs of the given row indices of a table written by build_columnar_table """
+    if len(rows) == 0:
+        return []
+    table_dir = Path(table_dir)
+    offsets = np.memmap(table_dir / "claim_id_offsets.bin", dtype='<i8', mode='r')
+    claim_ids = np.memmap(table_dir / "claim_ids.bin", dtype=np.uint8, mode='r')
+    return [claim_ids[offsets[row]:offsets[row + 1]].tobytes().decode('utf-8') for row in rows]
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    data_files = sorted(get_batch_files(args.data))
+    build_columnar_table(data_files, Path(args.out_dir), args.num_procs)
+
+
+if __name__ == "__main__":
+    main()
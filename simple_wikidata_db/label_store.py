@@ -0,0 +1,148 @@
+""" Memory-mapped QID -> label store
+
+This script builds a persistent store of the labels table, so that looking up the label of an entity doesn't require
+loading the whole table into a dict. QID numbers are sorted into an int array, and the labels are concatenated in the
+same order into a UTF-8 blob, with an array of offsets into it. The arrays are memory-mapped when the store is loaded,
+so a lookup is a binary search plus a read of the label, and only the pages touched are read from disk.
+
+Layout of the output directory (QIDs are stored as integers, Q42 -> 42):
+    meta.json                   number of labels
+    qids.bin                    int64 array, the sorted QID numbers
+    offsets.bin                 int64 array of num_labels + 1 offsets into labels.bin
+    labels.bin                  UTF-8 labels, concatenated
+
+If an entity has several labels in the table, the one in the first file (by name) is kept.
+
+Example command:
+
+python3 -m simple_wikidata_db.label_store \
+    --data data/processed/labels \
+    --out_dir data/processed/labels_store
+
+"""
+import argparse
+import json
+from multiprocessing import Pool
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+from tqdm import tqdm
+
+from simple_wikidata_db.utils import get_batch_files, jsonl_generator, parse_id, qid_numbers
+
+STORE_COLUMNS = {'qids': '<i8', 'offsets': '<i8'}
+# number of labels copied to the blob at a time
+COPY_BATCH_SIZE = 1 << 20
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='data/processed/labels', help='path to labels table')
+    parser.add_argument('--out_dir', type=str, default='data/processed/labels_store', help='path to output directory')
+    parser.add_argument('--num_procs', type=int, default=10, help='Number of processes')
+    return parser
+
+
+def read_labels_file(filename):
+    """ Returns the QID numbers, the label lengths (in bytes) and the concatenated UTF-8 labels of a labels file """
+    qids, lengths, labels = [], [], []
+    for item in jsonl_generator(filename):
+        qid = parse_id(item.get('qid', ''), 'Q')
+        if qid < 0 or 'label' not in item:
+            continue
+        label = item['label'].encode('utf-8')
+        qids.append(qid)
+        lengths.append(len(label))
+        labels.append(label)
+    return np.array(qids, dtype='<i8'), np.array(lengths, dtype='<i8'), b''.join(labels)
+
+
+def build_label_store(data_files, out_dir: Path, num_procs: int):
+    qids, lengths, blobs = [], [], []
+    pool = Pool(processes=num_procs)
+    for file_qids, file_lengths, file_blob in tqdm(pool.imap(read_labels_file, data_files, chunksize=1),
+                                                   total=len(data_files), desc="Reading files"):
+        qids.append(file_qids)
+        lengths.append(file_lengths)
+        blobs.append(file_blob)
+    pool.close()
+    pool.join()
+    qids = np.concatenate(qids) if qids else np.zeros(0, dtype='<i8')
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype='<i8')
+    blob = np.frombuffer(b''.join(blobs), dtype=np.uint8)
+    del blobs
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype('<i8') if len(lengths) else lengths
+
+    # stable sort, so the first label of an entity comes first, then keep that one
+    order = np.argsort(qids, kind='stable')
+    distinct = np.ones(len(order), dtype=bool)
+    distinct[1:] = qids[order][1:] != qids[order][:-1]
+    order = order[distinct]
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    qids[order].astype('<i8').tofile(out_dir / "qids.bin")
+    np.concatenate([[0], np.cumsum(lengths[order])]).astype('<i8').tofile(out_dir / "offsets.bin")
+    with open(out_dir / "labels.bin", 'wb') as f:
+        for batch_start in range(0, len(order), COPY_BATCH_SIZE):
+            batch = order[batch_start:batch_start + COPY_BATCH_SIZE]
+            batch_lengths = lengths[batch]
+            # byte positions of the labels of the batch, in the order of the batch
+            label_starts = np.repeat(starts[batch] - np.concatenate([[0], np.cumsum(batch_lengths)[:-1]]),
+                                     batch_lengths)
+            f.write(blob[label_starts + np.arange(batch_lengths.sum())].tobytes())
+    with open(out_dir / "meta.json", 'w') as f:
+        json.dump({'num_labels': len(order), 'columns': STORE_COLUMNS}, f, indent=2)
+    print(f"Wrote {len(order)} labels to {out_dir}")
+
+
+class LabelStore:
+    def __init__(self, store_dir):
+        """ Memory-maps a store written by build_label_store. Labels are looked up like in a dict, with get. """
+        store_dir = Path(store_dir)
+        with open(store_dir / "meta.json", 'r') as f:
+            meta = json.load(f)
+        num_labels = meta['num_labels']
+        self.qids = np.memmap(store_dir / "qids.bin", dtype='<i8', mode='r', shape=(num_labels,)) \
+            if num_labels > 0 else np.zeros(0, dtype='<i8')
+        self.offsets = np.memmap(store_dir / "offsets.bin", dtype='<i8', mode='r', shape=(num_labels + 1,))
+        self.labels = np.memmap(store_dir / "labels.bin", dtype=np.uint8, mode='r') \
+            if self.offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.qids)
+
+    def get(self, qid: str, default=None) -> Optional[str]:
+        """ Returns the label of a QID (e.g. 'Q42'), or default if it has none """
+        number = parse_id(qid, 'Q')
+        if number < 0:
+            return default
+        position = np.searchsorted(self.qids, number)
+        if position == len(self.qids) or self.qids[position] != number:
+            return default
+        return self.labels[self.offsets[position]:self.offsets[position + 1]].tobytes().decode('utf-8')
+
+    def get_many(self, qids: List[str], default=None) -> List[Optional[str]]:
+        """ Returns the labels of a list of QIDs, with a single vectorized search """
+        numbers = qid_numbers(qids)
+        if len(self.qids) == 0:
+            return [default] * len(numbers)
+        positions = np.minimum(np.searchsorted(self.qids, numbers), len(self.qids) - 1)
+        found = (self.qids[positions] == numbers) & (numbers >= 0)
+        return [
+            self.labels[self.offsets[position]:self.offsets[position + 1]].tobytes().decode('utf-8') if is_found
+            else default
+            for position, is_found in zip(positions.tolist(), found.tolist())
+        ]
+
+    def __contains__(self, qid: str) -> bool:
+        return self.get(qid) is not None
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    build_label_store(sorted(get_batch_files(args.data)), Path(args.out_dir), args.num_procs)
+
+
+if __name__ == "__main__":
+    main()
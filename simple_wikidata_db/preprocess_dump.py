@@ -1,6 +1,6 @@
 """ Wikidata Dump Processor
 
-This script preprocesses the raw Wikidata dump (in JSON format) and sorts triples into 8 "tables": labels, descriptions, aliases, entity_rels, external_ids, entity_values, qualifiers, and wikipedia_links. See the README for more information on each table.
+This script preprocesses the raw Wikidata dump (in JSON format) and sorts triples into 9 "tables": labels, descriptions, aliases, entity_rels, external_ids, entity_values, qualifiers, wikipedia_links, and properties. See the README for more information on each table.
 
 Example command:
 
@@ -10,81 +10,140 @@ python3 preprocess_dump.py \
 
 """
 import argparse
+import json
 import multiprocessing
+import os
+import sys
 from multiprocessing import Queue, Process
 from pathlib import Path
+from typing import List
 import time
 
-from simple_wikidata_db.preprocess_utils.reader_process import count_lines, read_data
-from simple_wikidata_db.preprocess_utils.worker_process import process_data
-from simple_wikidata_db.preprocess_utils.writer_process import write_data
+from simple_wikidata_db.preprocess_utils.checkpoint import RESUME_ARGS, check_input_file, get_resume_seqs, \
+    input_file_info, is_complete, load_config, reset_checkpoints, save_json_atomic
+from simple_wikidata_db.preprocess_utils.reader_process import find_splits, get_input_size, read_data
+from simple_wikidata_db.preprocess_utils.worker_process import EntityFilter, process_data
+from simple_wikidata_db.preprocess_utils.writer_process import COMPRESSION_SUFFIXES, ROLL_BY, SHARDED_TABLES, \
+    TABLE_NAMES, assign_streams, get_streams, get_table_names, prepare_table_dirs, write_data
+from simple_wikidata_db.utils import get_batch_files, jsonl_generator
+
+# directory under out_dir holding the output of the pass finding the neighbours of a subset (see --neighbours)
+NEIGHBOURS_DIR = '_neighbours'
 
 
 def get_arg_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--input_file', type=str, required=True, help='path to gz wikidata json dump')
+    parser.add_argument('--input_file', type=str, required=True,
+                        help='path to wikidata json dump (.gz, .bz2, .zst or uncompressed), or - to read from stdin')
     parser.add_argument('--out_dir', type=str, required=True, help='path to output directory')
-    parser.add_argument('--language_id', type=str, default='en', help='language identifier')
+    parser.add_argument('--language_id', type=str, nargs='+', default=['en'],
+                        help='language identifier(s). With several languages, the labels, descriptions, aliases and '
+                             'wikipedia_links tables are written per language, e.g. labels_fr.')
+    parser.add_argument('--tables', type=str, nargs='+', default=TABLE_NAMES, choices=TABLE_NAMES,
+                        help='Tables to build. The parts of the dump only needed by other tables are skipped.')
+    parser.add_argument('--filter', type=str, nargs='*', default=[],
+                        help='Only keep the entities matching any of these claim predicates: PID=VALUE (e.g. P31=Q5) '
+                             'or PID (entities with any claim of property PID). Builds a subset of Wikidata.')
+    parser.add_argument('--neighbours', action='store_true',
+                        help='With --filter, also keep the entities which are values of the entity_rels of the '
+                             'matching entities. Takes an extra pass over the dump.')
     parser.add_argument('--processes', type=int, default=90, help="number of concurrent processes to spin off. ")
-    parser.add_argument('--batch_size', type=int, default=10000)
+    parser.add_argument('--num_readers', type=int, default=8,
+                        help='Number of processes decompressing the dump in parallel. Only used for uncompressed dumps '
+                             'and dumps made of several gzip members/bz2 streams/zstd frames.')
+    parser.add_argument('--num_writers', type=int, default=1,
+                        help='Number of writer processes. Each one owns the files of a subset of the tables/shards.')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='Number of shards to split the sharded tables into, by a hash of the entity QID.')
+    parser.add_argument('--sharded_tables', type=str, nargs='*', default=SHARDED_TABLES, choices=TABLE_NAMES,
+                        help='Tables to split into --num_shards shards.')
+    parser.add_argument('--batch_size', type=int, default=10000,
+                        help='Number of entities, rows or bytes (see --roll_by) to write to each file of a table.')
+    parser.add_argument('--roll_by', type=str, default='entities', choices=ROLL_BY,
+                        help='What --batch_size counts. bytes are counted after compression.')
+    parser.add_argument('--compression', type=str, default='none', choices=list(COMPRESSION_SUFFIXES),
+                        help='Compression of the table files.')
+    parser.add_argument('--chunk_size', type=int, default=500,
+                        help='Number of dump lines sent between the reader, worker and writer processes at a time.')
     parser.add_argument('--num_lines_read', type=int, default=-1,
                         help='Terminate after num_lines_read lines are read. Useful for debugging.')
-    parser.add_argument('--num_lines_in_dump', type=int, default=-1, help='Number of lines in dump. If -1, we will count the number of lines.')
+    parser.add_argument('--checkpoint_interval', type=float, default=600,
+                        help='Seconds between two checkpoints of the writers. Disabled if <= 0.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the run in out_dir from its last checkpoint, with the same arguments.')
     return parser
 
 
-def main():
-    start = time.time()
-    args = get_arg_parser().parse_args()
-    print(f"ARGS: {args}")
-
-    out_dir = Path(args.out_dir)
-    out_dir.mkdir(exist_ok=True, parents=True)
-
-    input_file = Path(args.input_file)
-    assert input_file.exists(), f"Input file {input_file} does not exist"
-
-
-    max_lines_to_read = args.num_lines_read
-    if args.num_lines_in_dump <= 0:
-        print("Counting lines")
-        total_num_lines = count_lines(input_file, max_lines_to_read)
-    else:
-        total_num_lines = args.num_lines_in_dump
-
+def run_pipeline(args, input_file, splits, out_dir: Path, tables, resume: bool,
+                 entity_filter: EntityFilter = None) -> int:
+    """
+    Runs the reader, worker and writer processes over the dump, writing the given tables to out_dir.
+    :return: number of lines read
+    """
     print("Starting processes")
-    maxsize = 10 * args.processes
+    # each queue item holds a whole chunk of lines, so keep fewer of them in flight
+    maxsize = 2 * args.processes
+
+    # with a single shard, file names stay the same as for tables which are not sharded
+    sharded_tables = args.sharded_tables if args.num_shards > 1 else []
+    table_names = get_table_names(tables, args.language_id)
+    streams = get_streams(args.num_shards, sharded_tables, table_names)
+    num_writers = max(1, min(args.num_writers, len(streams)))
+    stream_writers = assign_streams(streams, num_writers)
+    if resume:
+        if is_complete(out_dir, num_writers):
+            print(f"The run in {out_dir} is already complete")
+            return 0
+        resume_seqs = get_resume_seqs(out_dir, num_writers, len(splits))
+    else:
+        prepare_table_dirs(out_dir, table_names)
+        reset_checkpoints(out_dir, dict({arg: getattr(args, arg) for arg in RESUME_ARGS}, splits=splits,
+                                         **input_file_info(args.input_file)))
+        resume_seqs = [0] * len(splits)
 
     # Queues for inputs/outputs
-    output_queue = Queue(maxsize=maxsize)
+    output_queues = [Queue(maxsize=maxsize) for _ in range(num_writers)]
     work_queue = Queue(maxsize=maxsize)
 
     # Processes for reading/processing/writing
     num_lines_read = multiprocessing.Value("i", 0)
-    read_process = Process(
-        target=read_data,
-        args=(input_file, num_lines_read, max_lines_to_read, work_queue)
-    )
-
-    read_process.start()
-
-    write_process = Process(
-        target=write_data,
-        args=(out_dir, args.batch_size, total_num_lines, output_queue)
-    )
-    write_process.start()
+    # progress is tracked by how far into the (compressed) input file the readers are
+    bytes_read = multiprocessing.Value("q", 0)
+    read_processes = []
+    for split_id, (split_start, split_end) in enumerate(splits):
+        read_process = Process(
+            target=read_data,
+            args=(input_file, num_lines_read, args.num_lines_read, work_queue, args.chunk_size, split_start, split_end,
+                  bytes_read, split_id, resume_seqs[split_id])
+        )
+        read_process.start()
+        read_processes.append(read_process)
+
+    write_processes = []
+    for writer_id, output_queue in enumerate(output_queues):
+        writer_streams = [stream for stream in streams if stream_writers[stream] == writer_id]
+        write_process = Process(
+            target=write_data,
+            args=(out_dir, args.batch_size, writer_streams, sharded_tables, get_input_size(input_file), bytes_read,
+                  writer_id == 0, args.roll_by, args.compression, writer_id, args.checkpoint_interval, resume,
+                  output_queue)
+        )
+        write_process.start()
+        write_processes.append(write_process)
 
     work_processes = []
-    for _ in range(max(1, args.processes-2)):
+    for _ in range(max(1, args.processes - len(splits) - num_writers)):
         work_process = Process(
             target=process_data,
-            args=(args.language_id, work_queue, output_queue)
+            args=(args.language_id, work_queue, output_queues, stream_writers, args.num_shards, sharded_tables,
+                  args.compression, tables, entity_filter)
         )
         work_process.daemon = True
         work_process.start()
         work_processes.append(work_process)
 
-    read_process.join()
+    for read_process in read_processes:
+        read_process.join()
     print(f"Done! Read {num_lines_read.value} lines")
     # Cause all worker process to quit
     for work_process in work_processes:
@@ -92,10 +151,87 @@ def main():
     # Now join the work processes
     for work_process in work_processes:
         work_process.join()
-    output_queue.put(None)
-    write_process.join()
+    for output_queue in output_queues:
+        output_queue.put(None)
+    for write_process in write_processes:
+        write_process.join()
+
+    return num_lines_read.value
+
+
+def get_neighbours(args, input_file, splits, out_dir: Path) -> List[str]:
+    """
+    Returns the QIDs of the values of the entity_rels claims of the entities matching args.filter, by a first pass
+    over the dump which only writes their entity_rels rows (to out_dir/_neighbours). The QIDs are saved, so a resumed
+    run doesn't need to repeat this pass.
+    """
+    neighbours_dir = out_dir / NEIGHBOURS_DIR
+    neighbours_file = neighbours_dir / 'qids.json'
+    if args.resume and neighbours_file.exists():
+        with open(neighbours_file, 'r') as f:
+            return json.load(f)
+    print("Finding the neighbours of the entities matching the filter")
+    neighbours_dir.mkdir(parents=True, exist_ok=True)
+    run_pipeline(args, input_file, splits, neighbours_dir, ['entity_rels'], False, EntityFilter(args.filter))
+    neighbours = set()
+    for fname in get_batch_files(neighbours_dir / 'entity_rels'):
+        for item in jsonl_generator(fname):
+            neighbours.add(item['value'])
+    neighbours = sorted(neighbours)
+    save_json_atomic(neighbours, neighbours_file)
+    print(f"Found {len(neighbours)} neighbours")
+    return neighbours
+
 
-    print(f"Finished processing {num_lines_read.value} in {time.time() - start}s")
+def main():
+    start = time.time()
+    args = get_arg_parser().parse_args()
+    print(f"ARGS: {args}")
+
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+
+    if args.resume:
+        config = load_config(out_dir)
+        for arg in RESUME_ARGS:
+            # arguments added after the run was started have their default value
+            setattr(args, arg, config.get(arg, get_arg_parser().get_default(arg)))
+        print(f"Resuming run with {config}")
+        if isinstance(args.language_id, str):
+            # runs from before several languages could be extracted
+            args.language_id = [args.language_id]
+    if args.resume and args.input_file == '-':
+        raise ValueError("A run reading from stdin cannot be resumed.")
+    if args.neighbours and args.input_file == '-':
+        raise ValueError("--neighbours reads the dump twice, and cannot be used when reading from stdin.")
+
+    if args.input_file == '-':
+        # child processes get their stdin closed, so hand them a duplicate of the descriptor instead
+        input_file = os.dup(sys.stdin.fileno())
+    else:
+        input_file = Path(args.input_file)
+        assert input_file.exists(), f"Input file {input_file} does not exist"
+        if args.resume:
+            check_input_file(config, args.input_file)
+
+    if args.resume:
+        splits = [tuple(split) for split in config['splits']]
+    else:
+        # the line limit is only enforced per reader, so read from a single one when debugging
+        splits = find_splits(input_file, 1 if args.num_lines_read > 0 else args.num_readers)
+    print(f"Reading the dump with {len(splits)} reader(s)")
+
+    # keep the requested tables in the usual order, so streams are assigned to writers the same way every time
+    tables = [table_name for table_name in TABLE_NAMES if table_name in args.tables]
+    entity_filter = None
+    if args.filter:
+        neighbours = []
+        if args.neighbours:
+            neighbours = get_neighbours(args, input_file, splits, out_dir)
+        entity_filter = EntityFilter(args.filter, neighbours)
+    num_lines_read = run_pipeline(args, input_file, splits, out_dir, tables, args.resume, entity_filter)
+
+    print(f"Finished processing {num_lines_read} in {time.time() - start}s")
 
 
 if __name__ == "__main__":
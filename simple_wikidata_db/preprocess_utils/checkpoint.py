@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# directory under out_dir holding the run configuration and the writer checkpoints
+CHECKPOINT_DIR = '_checkpoints'
+
+# arguments which determine how the dump is split into chunks and how chunks are written to files. A resumed run
+# uses the values of the run it continues. The input file is given again, and checked against the one of the run (see
+# check_input_file).
+RESUME_ARGS = ['language_id', 'tables', 'filter', 'neighbours', 'chunk_size', 'num_readers',
+               'num_writers', 'num_shards', 'sharded_tables', 'batch_size', 'roll_by', 'compression']
+
+
+def get_checkpoint_dir(out_dir: Path) -> Path:
+    return out_dir / CHECKPOINT_DIR
+
+
+def save_json_atomic(data: Dict[str, Any], path: Path):
+    """ Writes a json file such that a crash leaves either the previous or the new version """
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def input_file_info(input_file: str) -> Dict[str, Any]:
+    """ Absolute path, size and modification time of the input file of a run, saved with its configuration """
+    if input_file == '-':
+        return {'input_file': input_file}
+    stat = os.stat(input_file)
+    return {'input_file': str(Path(input_file).resolve()), 'input_size': stat.st_size,
+            'input_mtime_ns': stat.st_mtime_ns}
+
+
+def check_input_file(config: Dict[str, Any], input_file: str):
+    """
+    Raises an error if input_file isn't the input file of the run being resumed: the splits of the run are byte ranges
+    of that file. The file may have been moved, so only its size and modification time are compared.
+    """
+    info = input_file_info(input_file)
+    for key in ('input_size', 'input_mtime_ns'):
+        if key in config and config[key] != info[key]:
+            raise ValueError(f"{input_file} is not the input file of the run being resumed ({config['input_file']}): "
+                             f"{key} is {info[key]} instead of {config[key]}.")
+    if info['input_file'] != config.get('input_file'):
+        print(f"Resuming the run of {config.get('input_file')} with {info['input_file']}")
+
+
+def reset_checkpoints(out_dir: Path, config: Dict[str, Any]):
+    """ Starts a new run: removes the checkpoints of a previous run and saves the configuration of this one """
+    checkpoint_dir = get_checkpoint_dir(out_dir)
+    if checkpoint_dir.exists():
+        shutil.rmtree(checkpoint_dir)
+    checkpoint_dir.mkdir(parents=True)
+    save_json_atomic(config, checkpoint_dir / 'config.json')
+
+
+def load_config(out_dir: Path) -> Dict[str, Any]:
+    config_file = get_checkpoint_dir(out_dir) / 'config.json'
+    if not config_file.exists():
+        raise ValueError(f"There is no run to resume in {out_dir} ({config_file} does not exist).")
+    with open(config_file, 'r') as f:
+        return json.load(f)
+
+
+def writer_checkpoint_file(out_dir: Path, writer_id: int) -> Path:
+    return get_checkpoint_dir(out_dir) / f'writer_{writer_id:d}.json'
+
+
+def save_writer_checkpoint(out_dir: Path, writer_id: int, checkpoint: Dict[str, Any]):
+    save_json_atomic(checkpoint, writer_checkpoint_file(out_dir, writer_id))
+
+
+def load_writer_checkpoint(out_dir: Path, writer_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Returns the last checkpoint of a writer, or None if it didn't save any. A checkpoint looks like
+    {'splits': {split_id: {'seq': next chunk to write}}, 'tables': {'table_name/shard': Table.get_state()},
+     'complete': whether the writer finished}
+    """
+    checkpoint_file = writer_checkpoint_file(out_dir, writer_id)
+    if not checkpoint_file.exists():
+        return None
+    with open(checkpoint_file, 'r') as f:
+        return json.load(f)
+
+
+def get_resume_seqs(out_dir: Path, num_writers: int, num_splits: int) -> List[int]:
+    """
+    Returns the chunk of each split from which the readers have to resume: the first chunk not yet written by all
+    writers. Writers which are further ahead skip the chunks they already wrote.
+    """
+    resume_seqs = [None] * num_splits
+    for writer_id in range(num_writers):
+        checkpoint = load_writer_checkpoint(out_dir, writer_id)
+        for split_id in range(num_splits):
+            seq = 0 if checkpoint is None else checkpoint['splits'].get(str(split_id), {'seq': 0})['seq']
+            resume_seqs[split_id] = seq if resume_seqs[split_id] is None else min(resume_seqs[split_id], seq)
+    return resume_seqs
+
+
+def is_complete(out_dir: Path, num_writers: int) -> bool:
+    for writer_id in range(num_writers):
+        checkpoint = load_writer_checkpoint(out_dir, writer_id)
+        if checkpoint is None or not checkpoint.get('complete', False):
+            return False
+    return True
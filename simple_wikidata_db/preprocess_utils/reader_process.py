@@ -1,51 +1,245 @@
 from multiprocessing import Queue, Value
 from pathlib import Path
-import gzip
+from typing import Iterator, List, Optional, Tuple, Union
 import bz2
+import os
+import re
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# bytes read from the input file at a time
+READ_SIZE = 1 << 20
+
+# magic bytes at the start of every gzip member, bz2 stream and zstd frame. A file made of several of these (e.g.
+# written by bgzip, pbzip2 or pzstd) can be decompressed in parallel, starting a reader at each member.
+MEMBER_MAGIC = {
+    'gz': re.compile(rb'\x1f\x8b\x08'),
+    'bz2': re.compile(rb'BZh[1-9]1AY&SY'),
+    'zst': re.compile(rb'\x28\xb5\x2f\xfd'),
+}
+
+SUFFIX_FORMATS = {'.gz': 'gz', '.bz2': 'bz2', '.zst': 'zst', '.zstd': 'zst'}
+
+
+def get_format(input_file: Path) -> str:
+    """ Returns the compression format of the input file ('gz', 'bz2', 'zst' or 'raw' for uncompressed json) """
+    return SUFFIX_FORMATS.get(input_file.suffix, 'raw')
+
+
+def _sniff_format(f) -> str:
+    """ Returns the compression format of a stream (e.g. stdin) from its magic bytes, without consuming them """
+    head = f.peek(16)
+    for fmt, magic in MEMBER_MAGIC.items():
+        if magic.match(head):
+            return fmt
+    return 'raw'
 
-def count_lines(input_file: Path, max_lines_to_read: int):
-    cnt = 0
-    if input_file.suffix == ".bz2":
-        f = bz2.open(input_file, "r")
-    elif input_file.suffix == ".gz":
-        f = gzip.open(input_file, "rb")
-    else:
-        raise ValueError(f"The file must be either .bz2 or .gz, but got {input_file.suffix}.")
-
-    for _ in f:
-        cnt += 1
-        if max_lines_to_read > 0 and cnt >= max_lines_to_read:
-            break
-    return cnt
 
-def read_data(input_file: Path, num_lines_read: Value, max_lines_to_read: int, work_queue: Queue):
+def _decompressor(fmt: str):
+    if fmt == 'gz':
+        return zlib.decompressobj(wbits=31)
+    elif fmt == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif fmt == 'zst':
+        if zstandard is None:
+            raise ImportError("Reading .zst dumps requires the zstandard package (pip install zstandard).")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unknown compression format {fmt}.")
+
+
+def _is_member_start(f, fmt: str, offset: int) -> bool:
+    """ Checks that a member/frame can be decompressed from offset, to rule out magic bytes inside compressed data """
+    f.seek(offset)
+    try:
+        _decompressor(fmt).decompress(f.read(1 << 16))
+    except (OSError, EOFError, ValueError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ()):
+        return False
+    return True
+
+
+def _next_member_start(f, fmt: str, offset: int, file_size: int) -> int:
+    """ Returns the offset of the first member/frame starting at or after offset, or file_size if there is none """
+    magic = MEMBER_MAGIC[fmt]
+    while offset < file_size:
+        f.seek(offset)
+        data = f.read(READ_SIZE + 16)
+        match = magic.search(data)
+        while match is not None and match.start() < READ_SIZE:
+            if _is_member_start(f, fmt, offset + match.start()):
+                return offset + match.start()
+            match = magic.search(data, match.start() + 1)
+        offset += READ_SIZE
+    return file_size
+
+
+def find_splits(input_file: Union[Path, int], num_readers: int) -> List[Tuple[int, int]]:
+    """
+    Splits the input file into at most num_readers byte ranges that can be read independently. Uncompressed files
+    are split anywhere, compressed files at member boundaries. Single member archives and stdin cannot be split.
+    :param input_file: Path to the input file, or an open file descriptor to read from (e.g. for stdin).
+    :param num_readers: Maximum number of splits.
+    :return: list of (start, end) byte offsets, end is -1 for the last split
     """
-    Reads the data from the input file and pushes it to the output queue.
-    :param input_file: Path to the input file.
+    if isinstance(input_file, int) or num_readers <= 1:
+        return [(0, -1)]
+    fmt = get_format(input_file)
+    file_size = os.path.getsize(input_file)
+    starts = [0]
+    with open(input_file, 'rb') as f:
+        for i in range(1, num_readers):
+            target = max(file_size * i // num_readers, starts[-1] + 1)
+            start = target if fmt == 'raw' else _next_member_start(f, fmt, target, file_size)
+            if start >= file_size:
+                break
+            starts.append(start)
+    return list(zip(starts, starts[1:] + [-1]))
+
+
+def _add_progress(bytes_read: Optional[Value], num_bytes: int):
+    if bytes_read is not None:
+        with bytes_read.get_lock():
+            bytes_read.value += num_bytes
+
+
+def _read_blocks(f, fmt: str, start: int, end: int, bytes_read: Optional[Value] = None) -> Iterator[Tuple[bytes, bool]]:
+    """
+    Yields decompressed blocks of the input, starting at byte offset start. The flag is True for blocks that come
+    from past the end of the split (bytes at/after end, or members starting at/after end for compressed input).
+    The number of (compressed) bytes consumed is added to bytes_read as the file is read.
+    """
+    if start > 0:
+        f.seek(start)
+    pos = start
+    if fmt == 'raw':
+        while True:
+            data = f.read(READ_SIZE if end < 0 or pos >= end else min(READ_SIZE, end - pos))
+            if not data:
+                return
+            _add_progress(bytes_read, len(data))
+            yield data, 0 <= end <= pos
+            pos += len(data)
+
+    decompressor = _decompressor(fmt)
+    member_start = start
+    while True:
+        data = f.read(READ_SIZE)
+        if not data:
+            return
+        pos += len(data)
+        _add_progress(bytes_read, len(data))
+        while data:
+            out = decompressor.decompress(data)
+            if out:
+                yield out, 0 <= end <= member_start
+            if not decompressor.eof:
+                break
+            # the next member starts right after this one
+            data = decompressor.unused_data
+            member_start = pos - len(data)
+            decompressor = _decompressor(fmt)
+
+
+def iter_lines(input_file: Union[Path, int], start: int = 0, end: int = -1,
+               bytes_read: Optional[Value] = None) -> Iterator[bytes]:
+    """
+    Yields the lines (without the newline) of the split [start, end) of the input file. A split owns the lines that
+    start after its first newline, up to and including the line that contains the first byte past its end. This way
+    the lines that cross split boundaries are read exactly once across all splits.
+    :param input_file: Path to the input file, or an open file descriptor to read from (e.g. for stdin).
+    :param start: Byte offset of the split in the (compressed) file.
+    :param end: Byte offset of the end of the split, or -1 to read to the end of the file.
+    :param bytes_read: Value to add the number of (compressed) bytes read to, for progress reporting.
+    """
+    with open(input_file, 'rb', closefd=not isinstance(input_file, int)) as f:
+        fmt = _sniff_format(f) if isinstance(input_file, int) else get_format(input_file)
+        skipping = start > 0
+        boundary = None  # decompressed position at which the data past the end of the split begins
+        pos = 0
+        line_start = 0
+        pending = []
+        for block, past_end in _read_blocks(f, fmt, start, end, bytes_read):
+            if past_end and boundary is None:
+                boundary = pos
+            offset = 0
+            while True:
+                if boundary is not None and line_start > boundary:
+                    return
+                newline = block.find(b'\n', offset)
+                if newline < 0:
+                    if offset < len(block):
+                        pending.append(block[offset:])
+                    break
+                if pending:
+                    pending.append(block[offset:newline])
+                    ln = b''.join(pending)
+                    pending = []
+                else:
+                    ln = block[offset:newline]
+                if skipping:
+                    skipping = False
+                else:
+                    yield ln
+                offset = newline + 1
+                line_start = pos + offset
+            pos += len(block)
+        if pending and not skipping and (boundary is None or line_start <= boundary):
+            yield b''.join(pending)
+
+
+def get_input_size(input_file: Union[Path, int]) -> int:
+    """ Returns the size of the input file in bytes, or -1 if it is unknown (stdin) """
+    if isinstance(input_file, int):
+        return -1
+    return os.path.getsize(input_file)
+
+
+def read_data(input_file: Union[Path, int], num_lines_read: Value, max_lines_to_read: int, work_queue: Queue,
+              chunk_size: int = 1, start: int = 0, end: int = -1, bytes_read: Optional[Value] = None,
+              split_id: int = 0, skip_chunks: int = 0):
+    """
+    Reads the data from a split of the input file and pushes it to the output queue in chunks of lines. Each chunk is
+    sent as (split_id, seq, lines), where seq numbers the chunks of the split.
+    :param input_file: Path to the input file, or an open file descriptor to read from (e.g. for stdin).
     :param num_lines_read: Value to store the number of lines in the input file.
     :param max_lines_to_read: Maximum number of lines to read from the input file (for testing).
     :param work_queue: Queue to push the data to.
+    :param chunk_size: Number of lines to send to a worker in a single queue item.
+    :param start: Byte offset of the split to read (see find_splits).
+    :param end: Byte offset of the end of the split to read, or -1 to read to the end of the file.
+    :param bytes_read: Value to add the number of (compressed) bytes read to, for progress reporting.
+    :param split_id: Index of the split, passed along with its chunks.
+    :param skip_chunks: Number of chunks at the start of the split to skip, when resuming a run.
     """
-    if input_file.suffix == ".bz2":
-        f = bz2.open(input_file, "r")
-    elif input_file.suffix == ".gz":
-        f = gzip.GzipFile(input_file, "r")
-    else:
-        raise ValueError(f"The file must be either .bz2 or .gz, but got {input_file.suffix}.")
-
     num_lines = 0
-    for ln in f:
-        if ln == b"[\n" or ln == b"]\n":
+    lines_to_skip = skip_chunks * chunk_size
+    seq = skip_chunks
+    chunk = []
+    for ln in iter_lines(input_file, start, end, bytes_read):
+        if ln == b"[" or ln == b"]" or len(ln) == 0:
             continue
-        if ln.endswith(b",\n"):  # all but the last element
-            obj = ln[:-2]
+        if lines_to_skip > 0:
+            lines_to_skip -= 1
+            continue
+        if ln.endswith(b","):  # all but the last element
+            obj = ln[:-1]
         else:
             obj = ln
         num_lines += 1
-        work_queue.put(obj)
+        chunk.append(obj)
+        if len(chunk) >= chunk_size:
+            work_queue.put((split_id, seq, chunk))
+            with num_lines_read.get_lock():
+                num_lines_read.value += len(chunk)
+            seq += 1
+            chunk = []
         if 0 < max_lines_to_read <= num_lines:
             break
-    num_lines_read.value = num_lines
-
-    f.close()
+    if chunk:
+        work_queue.put((split_id, seq, chunk))
+        with num_lines_read.get_lock():
+            num_lines_read.value += len(chunk)
     return
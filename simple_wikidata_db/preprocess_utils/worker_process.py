@@ -1,14 +1,32 @@
 from collections import defaultdict
 from multiprocessing import Queue
+from typing import Iterable, List
+import gzip
 
 # properties which encode some alias/name
 import ujson
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from simple_wikidata_db.preprocess_utils.writer_process import TABLE_NAMES, language_table_name, qid_shard
+
 ALIAS_PROPERTIES = {'P138', 'P734', 'P735', 'P742', 'P1448', 'P1449', 'P1477', 'P1533', 'P1549', 'P1559', 'P1560',
                     'P1635', 'P1705', 'P1782', 'P1785', 'P1786', 'P1787', 'P1810', 'P1813', 'P1814', 'P1888', 'P1950',
                     'P2358', 'P2359', 'PP2365', 'P2366', 'P2521', 'P2562', 'P2976', 'PP3321', 'P4239', 'P4284',
                     'P4970', 'P5056', 'P5278', 'PP6978', 'P7383'}
 
+# tables built from the claims of an entity (besides aliases, which also come from ALIAS_PROPERTIES claims)
+CLAIM_TABLES = {'entity_rels', 'external_ids', 'entity_values', 'qualifiers'}
+
+# property whose claims on a property are its property constraints
+CONSTRAINT_PROPERTY = 'P2302'
+
+# found in the dump line of a property entity, and not in those of items
+PROPERTY_MARKER = b'"type":"property"'
+
 # data types in wikidata dump which we ignore
 IGNORE = {'wikibase-lexeme', 'musical-notation', 'globe-coordinate', 'commonsMedia', 'geo-shape', 'wikibase-sense',
           'wikibase-property', 'math', 'tabular-data'}
@@ -40,95 +58,215 @@ def process_mainsnak(data, language_id):
     return None
 
 
-def process_json(obj, language_id="en"):
+def process_constraint_snak(data, language_id):
+    """ Same as process_mainsnak, but keeps property values, which constraint qualifiers refer to (e.g. P2306) """
+    if data['datatype'] == 'wikibase-property':
+        return data['datavalue']['value']['id']
+    return process_mainsnak(data, language_id)
+
+
+def process_property(obj, language_id="en"):
+    """
+    Returns the row of a property in the properties table: its label and aliases in language_id, its datatype, and its
+    property constraints (P2302 claims), each with the values of its qualifiers grouped by qualifier property.
+    """
+    constraints = []
+    for claim in obj['claims'].get(CONSTRAINT_PROPERTY, []):
+        if not claim['mainsnak']['snaktype'] == 'value':
+            continue
+        qualifiers = defaultdict(list)
+        for qualifier_property, qualifier_snaks in claim.get('qualifiers', {}).items():
+            for qualifier in qualifier_snaks:
+                if not qualifier['snaktype'] == 'value':
+                    continue
+                value = process_constraint_snak(qualifier, language_id)
+                if value is not None:
+                    qualifiers[qualifier_property].append(value)
+        constraints.append({
+            'claim_id': claim['id'],
+            'constraint': process_mainsnak(claim['mainsnak'], language_id),
+            'qualifiers': dict(qualifiers)
+        })
+    return {
+        'property_id': obj['id'],
+        'label': obj['labels'][language_id]['value'] if language_id in obj['labels'] else None,
+        'datatype': obj.get('datatype'),
+        'aliases': [alias['value'] for alias in obj['aliases'].get(language_id, [])],
+        'constraints': constraints
+    }
+
+
+class EntityFilter:
+    def __init__(self, predicates: Iterable[str] = (), qids: Iterable[str] = ()):
+        """
+        Selects the entities to keep when building a subset of Wikidata. An entity is kept if it matches any of the
+        predicates, or if its QID is in qids.
+        :param predicates: 'PID=VALUE' (e.g. P31=Q5) matches entities with a claim of property PID with that value,
+        'PID' (e.g. P625) entities with any claim of property PID.
+        :param qids: QIDs of entities to keep regardless of the predicates (e.g. the neighbours of the subset).
+        """
+        self.properties = set()
+        self.property_values = defaultdict(set)
+        for predicate in predicates:
+            property_id, _, value = predicate.partition('=')
+            if not property_id.startswith('P'):
+                raise ValueError(f"Invalid filter {predicate}, expected PID=VALUE or PID.")
+            if value:
+                self.property_values[property_id].add(value)
+            else:
+                self.properties.add(property_id)
+        self.qids = set(qids)
+        # if an entity matches a predicate, its line in the dump contains the (quoted) property ID
+        self.needles = [f'"{property_id}"'.encode('utf-8')
+                        for property_id in self.properties | set(self.property_values)]
+
+    def might_match(self, line: bytes) -> bool:
+        """ Cheap check on a raw dump line, False if the entity can't match (so the line doesn't need to be parsed) """
+        return len(self.qids) > 0 or any(needle in line for needle in self.needles)
+
+    def matches(self, obj, language_id="en") -> bool:
+        if obj['id'] in self.qids:
+            return True
+        claims = obj['claims']
+        if not self.properties.isdisjoint(claims):
+            return True
+        for property_id, values in self.property_values.items():
+            for claim in claims.get(property_id, []):
+                if claim['mainsnak']['snaktype'] == 'value' and \
+                        process_mainsnak(claim['mainsnak'], language_id) in values:
+                    return True
+        return False
+
+
+def process_json(obj, language_id="en", tables=TABLE_NAMES, entity_filter: EntityFilter = None):
+    """
+    Extracts the rows of an entity for each table. Only the tables listed in tables are built, and parts of the
+    entity which only feed other tables (e.g. the claims if only labels are requested) are not looked at.
+    language_id can be a list of languages, in which case the labels, descriptions, aliases and wikipedia links of each
+    language go to their own table (e.g. labels_fr, see language_table_name). Monolingual text values of claims and
+    qualifiers are only kept in the first language, so the other tables are the same as when extracting only that one.
+    With an entity_filter, entities which don't match it have no rows.
+    Properties only have a row in the properties table (in the first language, see process_property), which they get
+    regardless of the entity_filter, so that a subset has the metadata of all properties.
+    """
     out_data = defaultdict(list)
-    # skip properties
+    language_ids = [language_id] if isinstance(language_id, str) else list(language_id)
+    primary_language_id = language_ids[0]
     if obj['type'] == 'property':
-        return {}
+        if 'properties' not in tables:
+            return {}
+        return {'properties': [process_property(obj, primary_language_id)]}
     id = obj['id']  # The canonical ID of the entity.
-    # extract labels
-    if language_id in obj['labels']:
-        label = obj['labels'][language_id]['value']
-        out_data['labels'].append({
-            'qid': id,
-            'label': label
-        })
-        out_data['aliases'].append({
-            'qid': id,
-            'alias': label
-        })
-
-    # extract description
-    if language_id in obj['descriptions']:
-        description = obj['descriptions'][language_id]['value']
-        out_data['descriptions'].append({
-            'qid': id,
-            'description': description,
-        })
+    if entity_filter is not None and not entity_filter.matches(obj, primary_language_id):
+        return {}
+    for language_id in language_ids:
+        labels_table = language_table_name('labels', language_id, language_ids)
+        aliases_table = language_table_name('aliases', language_id, language_ids)
+        # extract labels
+        if language_id in obj['labels'] and ('labels' in tables or 'aliases' in tables):
+            label = obj['labels'][language_id]['value']
+            if 'labels' in tables:
+                out_data[labels_table].append({
+                    'qid': id,
+                    'label': label
+                })
+            if 'aliases' in tables:
+                out_data[aliases_table].append({
+                    'qid': id,
+                    'alias': label
+                })
 
-    # extract aliases
-    if language_id in obj['aliases']:
-        for alias in obj['aliases'][language_id]:
-            out_data['aliases'].append({
+        # extract description
+        if language_id in obj['descriptions'] and 'descriptions' in tables:
+            description = obj['descriptions'][language_id]['value']
+            out_data[language_table_name('descriptions', language_id, language_ids)].append({
                 'qid': id,
-                'alias': alias['value'],
+                'description': description,
             })
 
-    # extract english wikipedia sitelink -- we just add this to the external links table
-    if f'{language_id}wiki' in obj['sitelinks']:
-        sitelink = obj['sitelinks'][f'{language_id}wiki']['title']
-        out_data['wikipedia_links'].append({
-            'qid': id,
-            'wiki_title': sitelink
-        })
+        # extract aliases
+        if language_id in obj['aliases'] and 'aliases' in tables:
+            for alias in obj['aliases'][language_id]:
+                out_data[aliases_table].append({
+                    'qid': id,
+                    'alias': alias['value'],
+                })
+
+        # extract wikipedia sitelink -- we just add this to the external links table
+        if f'{language_id}wiki' in obj['sitelinks'] and 'wikipedia_links' in tables:
+            sitelink = obj['sitelinks'][f'{language_id}wiki']['title']
+            out_data[language_table_name('wikipedia_links', language_id, language_ids)].append({
+                'qid': id,
+                'wiki_title': sitelink
+            })
 
     # extract claims and qualifiers
-    for property_id in obj['claims']:
+    if not CLAIM_TABLES.isdisjoint(tables):
+        claim_properties = obj['claims']
+    elif 'aliases' in tables:
+        claim_properties = [property_id for property_id in obj['claims'] if property_id in ALIAS_PROPERTIES]
+    else:
+        claim_properties = []
+    for property_id in claim_properties:
         for claim in obj['claims'][property_id]:
             if not claim['mainsnak']['snaktype'] == 'value':
                 continue
             claim_id = claim['id']
             datatype = claim['mainsnak']['datatype']
-            value = process_mainsnak(claim['mainsnak'], language_id)
+            value = process_mainsnak(claim['mainsnak'], primary_language_id)
 
             if value is None:
+                # names in the other extracted languages are still aliases in that language
+                if datatype == 'monolingualtext' and property_id in ALIAS_PROPERTIES and 'aliases' in tables:
+                    text = claim['mainsnak']['datavalue']['value']
+                    if text['language'] in language_ids:
+                        out_data[language_table_name('aliases', text['language'], language_ids)].append({
+                            'qid': id,
+                            'alias': text['text'],
+                        })
                 continue
 
             if datatype == 'wikibase-item':
-                out_data['entity_rels'].append({
-                    'claim_id': claim_id,
-                    'qid': id,
-                    'property_id': property_id,
-                    'value': value
-                })
+                if 'entity_rels' in tables:
+                    out_data['entity_rels'].append({
+                        'claim_id': claim_id,
+                        'qid': id,
+                        'property_id': property_id,
+                        'value': value
+                    })
             elif datatype == 'external-id':
-                out_data['external_ids'].append({
-                    'claim_id': claim_id,
-                    'qid': id,
-                    'property_id': property_id,
-                    'value': value
-                })
+                if 'external_ids' in tables:
+                    out_data['external_ids'].append({
+                        'claim_id': claim_id,
+                        'qid': id,
+                        'property_id': property_id,
+                        'value': value
+                    })
             else:
-                out_data['entity_values'].append({
-                    'claim_id': claim_id,
-                    'qid': id,
-                    'property_id': property_id,
-                    'value': value
-                })
-                if property_id in ALIAS_PROPERTIES:
-                    out_data['aliases'].append({
+                if 'entity_values' in tables:
+                    out_data['entity_values'].append({
+                        'claim_id': claim_id,
                         'qid': id,
-                        'alias': value,
+                        'property_id': property_id,
+                        'value': value
                     })
+                if property_id in ALIAS_PROPERTIES and 'aliases' in tables:
+                    # other names (e.g. strings) are not tied to a language, and are aliases in all of them
+                    alias_language_ids = [primary_language_id] if datatype == 'monolingualtext' else language_ids
+                    for alias_language_id in alias_language_ids:
+                        out_data[language_table_name('aliases', alias_language_id, language_ids)].append({
+                            'qid': id,
+                            'alias': value,
+                        })
 
             # get qualifiers
-            if 'qualifiers' in claim:
+            if 'qualifiers' in claim and 'qualifiers' in tables:
                 for qualifier_property in claim['qualifiers']:
                     for qualifier in claim['qualifiers'][qualifier_property]:
                         if not qualifier['snaktype'] == 'value':
                             continue
                         qualifier_id = qualifier['hash']
-                        value = process_mainsnak(qualifier, language_id)
+                        value = process_mainsnak(qualifier, primary_language_id)
                         if value is None:
                             continue
                         out_data['qualifiers'].append({
@@ -141,12 +279,70 @@ def process_json(obj, language_id="en"):
     return dict(out_data)
 
 
-def process_data(language_id: str, work_queue: Queue, out_queue: Queue):
-    while True:
-        json_obj = work_queue.get()
-        if json_obj is None:
-            break
+def encode_rows(rows, compression='none') -> bytes:
+    """
+    Serializes table rows to utf-8 encoded jsonl. With compression, the rows are written as a single gzip member or
+    zstd frame; a file made of such blobs is still a valid gzip/zstd file.
+    """
+    data = ''.join([ujson.dumps(row, ensure_ascii=False) + '\n' for row in rows]).encode('utf-8')
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstd compression requires the zstandard package (pip install zstandard).")
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def process_batch(lines, language_id="en", num_shards=1, sharded_tables=(), compression='none', tables=TABLE_NAMES,
+                  entity_filter: EntityFilter = None):
+    """
+    Processes a chunk of raw dump lines and serializes the rows of all entities per table, so the writer only has to
+    append bytes to its files. Rows of sharded tables are split by a hash of the entity's QID.
+    :return: (number of lines in the chunk,
+              {(table_name, shard): [number of entities with rows, number of rows, (compressed) jsonl bytes]})
+    """
+    table_rows = {}
+    keep_properties = 'properties' in tables
+    for json_obj in lines:
         if len(json_obj) == 0:
             continue
-        out_queue.put(process_json(ujson.loads(json_obj), language_id))
+        if entity_filter is not None and not entity_filter.might_match(json_obj) and \
+                not (keep_properties and PROPERTY_MARKER in json_obj):
+            continue
+        obj = ujson.loads(json_obj)
+        for table_name, rows in process_json(obj, language_id, tables, entity_filter).items():
+            key = (table_name, qid_shard(obj['id'], num_shards) if table_name in sharded_tables else 0)
+            if key not in table_rows:
+                table_rows[key] = [0, []]
+            table_rows[key][0] += 1
+            table_rows[key][1].extend(rows)
+    batch = {
+        key: [num_entities, len(rows), encode_rows(rows, compression)]
+        for key, (num_entities, rows) in table_rows.items()
+    }
+    return len(lines), batch
+
+
+def process_data(language_id: str, work_queue: Queue, out_queues: List[Queue], stream_writers, num_shards=1,
+                 sharded_tables=(), compression='none', tables=TABLE_NAMES, entity_filter: EntityFilter = None):
+    """
+    Processes chunks of lines from the work queue, and sends each writer the tables/shards it owns, along with the
+    split and sequence number of the chunk.
+    :param stream_writers: index of the writer (in out_queues) owning each (table_name, shard), see assign_streams.
+    """
+    while True:
+        work = work_queue.get()
+        if work is None:
+            break
+        split_id, seq, lines = work
+        num_lines, batch = process_batch(lines, language_id, num_shards, sharded_tables, compression, tables,
+                                         entity_filter)
+        writer_batches = [{} for _ in out_queues]
+        for key, value in batch.items():
+            writer_batches[stream_writers[key]][key] = value
+        # every writer gets every chunk (even if it is empty), so that each one can write the chunks of a split in
+        # order, and keep count of the lines
+        for out_queue, writer_batch in zip(out_queues, writer_batches):
+            out_queue.put((split_id, seq, num_lines, writer_batch))
     return
@@ -1,74 +1,265 @@
+import os
 import shutil
-from multiprocessing import Queue
+import zlib
+from multiprocessing import Queue, Value
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
 import time
-import ujson
+
+from simple_wikidata_db.preprocess_utils.checkpoint import load_writer_checkpoint, save_writer_checkpoint
 
 TABLE_NAMES = [
-    'labels', 'descriptions', 'aliases', 'external_ids', 'entity_values', 'qualifiers', 'wikipedia_links', 'entity_rels'
+    'labels', 'descriptions', 'aliases', 'external_ids', 'entity_values', 'qualifiers', 'wikipedia_links', 'entity_rels',
+    'properties'
 ]
 
+# tables holding text in the extracted language. When several languages are extracted, each one gets its own table,
+# named e.g. labels_fr
+LANGUAGE_TABLES = ['labels', 'descriptions', 'aliases', 'wikipedia_links']
+
+# large tables which can be split into shards by a hash of the entity QID
+SHARDED_TABLES = ['entity_rels', 'qualifiers']
+
+# what Table.batch_size counts before a new file is started
+ROLL_BY = ['entities', 'rows', 'bytes']
+
+# file suffixes of the output compression formats
+COMPRESSION_SUFFIXES = {'none': '.jsonl', 'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+
+# number of dump lines between two progress reports
+REPORT_EVERY = 200000
+
+
+def qid_shard(qid: str, num_shards: int) -> int:
+    """ Returns the shard of a sharded table that holds the rows of an entity """
+    if num_shards <= 1:
+        return 0
+    return zlib.crc32(qid.encode('utf-8')) % num_shards
+
+
+def language_table_name(table_name: str, language_id: str, language_ids: List[str]) -> str:
+    """ Returns the name of the table holding the rows of a language table for one of the extracted languages """
+    if len(language_ids) > 1:
+        return f"{table_name}_{language_id}"
+    return table_name
+
+
+def get_table_names(tables=TABLE_NAMES, language_ids=('en',)) -> List[str]:
+    """ Returns the names of the output tables, with a table per language for the tables in LANGUAGE_TABLES """
+    table_names = []
+    for table_name in tables:
+        if table_name in LANGUAGE_TABLES:
+            table_names.extend(
+                language_table_name(table_name, language_id, language_ids) for language_id in language_ids
+            )
+        else:
+            table_names.append(table_name)
+    return table_names
+
+
+def get_streams(num_shards: int = 1, sharded_tables=(), tables=TABLE_NAMES) -> List[Tuple[str, int]]:
+    """ Returns the (table_name, shard) pairs of the output. Tables which are not sharded only have shard 0. """
+    return [
+        (table_name, shard) for table_name in tables
+        for shard in range(num_shards if table_name in sharded_tables else 1)
+    ]
+
+
+def assign_streams(streams: List[Tuple[str, int]], num_writers: int) -> Dict[Tuple[str, int], int]:
+    """ Deterministically assigns each (table_name, shard) pair to the writer process that owns its files """
+    return {stream: i % num_writers for i, stream in enumerate(streams)}
+
+
+def prepare_table_dirs(path: Path, table_names: List[str]):
+    """ (Re)creates an empty directory for each table. Done once up front, since tables can be shared by writers. """
+    for table_name in table_names:
+        table_dir = path / table_name
+        if table_dir.exists():
+            shutil.rmtree(table_dir)
+        table_dir.mkdir(parents=True, exist_ok=False)
+
 
 class Table:
-    def __init__(self, path: Path, batch_size: int, table_name: str):
+    def __init__(self, path: Path, batch_size: int, table_name: str, shard: int = None, roll_by: str = 'entities',
+                 compression: str = 'none'):
+        """
+        :param batch_size: Number of entities, rows or (compressed) bytes (depending on roll_by) written to a file
+        before starting the next one.
+        :param shard: Shard of the table written by this Table, or None if the table is not sharded.
+        :param compression: Compression of the rows passed to write ('none', 'gzip' or 'zstd').
+        """
         self.table_dir = path / table_name
-        if self.table_dir.exists():
-            shutil.rmtree(self.table_dir)
-        self.table_dir.mkdir(parents=True, exist_ok=False)
+        # files of sharded tables are named shard{shard}_{index}.jsonl, other tables {index}.jsonl
+        self.file_prefix = '' if shard is None else f"shard{shard:d}_"
+        self.file_suffix = COMPRESSION_SUFFIXES[compression]
+        self.roll_by = roll_by
 
         self.index = 0
         self.cur_num_lines = 0
         self.batch_size = batch_size
-        self.cur_file = self.table_dir / f"{self.index:d}.jsonl"
+        self.cur_file = self.get_file(self.index)
         self.cur_file_writer = None
 
-    def write(self, json_value: List[Dict[str, Any]]):
+    def get_file(self, index: int) -> Path:
+        return self.table_dir / f"{self.file_prefix}{index:d}{self.file_suffix}"
+
+    def write(self, rows: bytes, num_entities: int = 1, num_rows: int = 1):
+        """ Appends rows that were already serialized (and compressed) by a worker (see worker_process.encode_rows) """
         if self.cur_file_writer is None:
-            self.cur_file_writer = open(self.cur_file, 'w')
-        for json_obj in json_value:
-            self.cur_file_writer.write(ujson.dumps(json_obj, ensure_ascii=False) + '\n')
-        self.cur_num_lines += 1
+            # append, as the file may have been partially written before a run was resumed
+            self.cur_file_writer = open(self.cur_file, 'ab')
+        self.cur_file_writer.write(rows)
+        if self.roll_by == 'entities':
+            self.cur_num_lines += num_entities
+        elif self.roll_by == 'rows':
+            self.cur_num_lines += num_rows
+        else:
+            self.cur_num_lines += len(rows)
         if self.cur_num_lines >= self.batch_size:
             self.cur_file_writer.close()
             self.cur_num_lines = 0
             self.index += 1
-            self.cur_file = self.table_dir / f"{self.index:d}.jsonl"
+            self.cur_file = self.get_file(self.index)
             self.cur_file_writer = None
 
+    def flush(self):
+        """ Makes sure everything written so far is on disk """
+        if self.cur_file_writer is not None:
+            self.cur_file_writer.flush()
+            os.fsync(self.cur_file_writer.fileno())
+
+    def get_state(self) -> Dict[str, int]:
+        """ Returns the position of the table, to resume writing from it (see restore) """
+        if self.cur_file_writer is not None:
+            size = self.cur_file_writer.tell()
+        else:
+            size = self.cur_file.stat().st_size if self.cur_file.exists() else 0
+        return {'index': self.index, 'cur_num_lines': self.cur_num_lines, 'size': size}
+
+    def restore(self, state: Dict[str, int]):
+        """ Goes back to a position returned by get_state, removing whatever was written after it """
+        self.close()
+        self.index = state['index']
+        self.cur_num_lines = state['cur_num_lines']
+        self.cur_file = self.get_file(self.index)
+        if self.cur_file.exists():
+            os.truncate(self.cur_file, state['size'])
+        next_index = self.index + 1
+        while self.get_file(next_index).exists():
+            self.get_file(next_index).unlink()
+            next_index += 1
+
     def close(self):
-        self.cur_file_writer.close()
+        if self.cur_file_writer is not None:
+            self.cur_file_writer.close()
+            self.cur_file_writer = None
 
 
 class Writer:
-    def __init__(self, path: Path, batch_size: int, total_num_lines: int):
+    def __init__(self, path: Path, batch_size: int, streams: List[Tuple[str, int]], sharded_tables, total_bytes: int,
+                 bytes_read: Value, report_progress: bool = True, roll_by: str = 'entities', compression: str = 'none',
+                 writer_id: int = 0, checkpoint_interval: float = -1, resume: bool = False):
+        """
+        :param writer_id: Index of the writer, used to name its checkpoint.
+        :param checkpoint_interval: Seconds between two checkpoints. Disabled if <= 0, except for the final one.
+        :param resume: Whether to continue from the last checkpoint of this writer.
+        """
+        self.path = path
+        self.writer_id = writer_id
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = time.time()
+        # next chunk to write for each split, and chunks which arrived before it
+        self.next_seqs = {}
+        self.pending = {}
         self.cur_num_lines = 0
-        self.total_num_lines = total_num_lines
+        self.next_report = REPORT_EVERY if report_progress else -1
+        self.total_bytes = total_bytes
+        self.bytes_read = bytes_read
         self.start_time = time.time()
-        self.output_tables = {table_name: Table(path, batch_size, table_name) for table_name in TABLE_NAMES}
-
-    def write(self, json_object: Dict[str, Any]):
-        self.cur_num_lines += 1
-        for key, value in json_object.items():
-            if len(value) > 0:
-                self.output_tables[key].write(value)
-        if self.cur_num_lines % 200000 == 0:
-            time_elapsed = time.time() - self.start_time
-            estimated_time = time_elapsed * (self.total_num_lines - self.cur_num_lines) / (200000*3600)
-            print(f"{self.cur_num_lines}/{self.total_num_lines} lines written in {time_elapsed:.2f}s. "
-                  f"Estimated time to completion is {estimated_time:.2f} hours.")
-            self.start_time = time.time()
+        self.output_tables = {
+            (table_name, shard): Table(path, batch_size, table_name, shard if table_name in sharded_tables else None,
+                                       roll_by, compression)
+            for table_name, shard in streams
+        }
+        if resume:
+            self.restore()
+
+    def write(self, batch: Tuple[int, int, int, Dict[Tuple[str, int], List[Any]]]):
+        """
+        Writes the part of a chunk processed by a worker that this writer owns (see worker_process.process_data).
+        Chunks of a split are written in order, so that the files always hold a prefix of each split and a checkpoint
+        can be taken between any two chunks.
+        """
+        split_id, seq, num_lines, tables = batch
+        next_seq = self.next_seqs.get(split_id, 0)
+        if seq < next_seq:
+            # already written before the run was resumed
+            return
+        self.pending[(split_id, seq)] = (num_lines, tables)
+        while (split_id, next_seq) in self.pending:
+            self.write_chunk(*self.pending.pop((split_id, next_seq)))
+            next_seq += 1
+        self.next_seqs[split_id] = next_seq
+        if 0 < self.checkpoint_interval <= time.time() - self.last_checkpoint:
+            self.save_checkpoint()
+
+    def write_chunk(self, num_lines: int, tables: Dict[Tuple[str, int], List[Any]]):
+        self.cur_num_lines += num_lines
+        for key, (num_entities, num_rows, rows) in tables.items():
+            if num_rows > 0:
+                self.output_tables[key].write(rows, num_entities, num_rows)
+        if 0 < self.next_report <= self.cur_num_lines:
+            self.report_progress()
+            self.next_report += REPORT_EVERY
+
+    def report_progress(self):
+        """ Prints the progress, estimated from how far into the (compressed) input file the readers are """
+        time_elapsed = time.time() - self.start_time
+        bytes_read = self.bytes_read.value
+        if self.total_bytes <= 0 or bytes_read <= 0:
+            print(f"{self.cur_num_lines} lines written in {time_elapsed:.2f}s.")
+            return
+        fraction_read = min(1.0, bytes_read / self.total_bytes)
+        estimated_time = time_elapsed * (1 - fraction_read) / (fraction_read * 3600)
+        print(f"{self.cur_num_lines} lines written in {time_elapsed:.2f}s, {100 * fraction_read:.2f}% of the input "
+              f"read. Estimated time to completion is {estimated_time:.2f} hours.")
+
+    def save_checkpoint(self, complete: bool = False):
+        """ Records the next chunk of each split and the position of each table, once the tables are on disk """
+        for table in self.output_tables.values():
+            table.flush()
+        save_writer_checkpoint(self.path, self.writer_id, {
+            'splits': {str(split_id): {'seq': seq} for split_id, seq in self.next_seqs.items()},
+            'tables': {f"{table_name}/{shard}": table.get_state()
+                       for (table_name, shard), table in self.output_tables.items()},
+            'complete': complete,
+        })
+        self.last_checkpoint = time.time()
+
+    def restore(self):
+        """ Continues from the last checkpoint, truncating whatever the tables got after it """
+        checkpoint = load_writer_checkpoint(self.path, self.writer_id) or {'splits': {}, 'tables': {}}
+        self.next_seqs = {int(split_id): split['seq'] for split_id, split in checkpoint['splits'].items()}
+        for (table_name, shard), table in self.output_tables.items():
+            table.restore(checkpoint['tables'].get(f"{table_name}/{shard}", {'index': 0, 'cur_num_lines': 0, 'size': 0}))
+        print(f"Writer {self.writer_id} resuming from chunks {self.next_seqs}")
 
     def close(self):
+        if self.pending:
+            print(f"Writer {self.writer_id} did not receive all chunks, {len(self.pending)} chunks were not written.")
         for v in self.output_tables.values():
             v.close()
+        self.save_checkpoint(complete=not self.pending)
 
 
-def write_data(path: Path, batch_size: int, total_num_lines: int, outout_queue: Queue):
-    writer = Writer(path, batch_size, total_num_lines)
+def write_data(path: Path, batch_size: int, streams: List[Tuple[str, int]], sharded_tables, total_bytes: int,
+               bytes_read: Value, report_progress: bool, roll_by: str, compression: str, writer_id: int,
+               checkpoint_interval: float, resume: bool, outout_queue: Queue):
+    writer = Writer(path, batch_size, streams, sharded_tables, total_bytes, bytes_read, report_progress, roll_by,
+                    compression, writer_id, checkpoint_interval, resume)
     while True:
-        json_object = outout_queue.get()
-        if json_object is None:
+        batch = outout_queue.get()
+        if batch is None:
             break
-        writer.write(json_object)
+        writer.write(batch)
     writer.close()
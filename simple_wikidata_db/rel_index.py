@@ -0,0 +1,283 @@
+""" (property_id, value) -> QIDs index of entity_rels
+
+This script builds an inverted index over the entity_rels table, which answers "which entities have P31=Q6256"
+without scanning the table. Every (property_id, value) pair of the table is a key, and its posting list holds the
+sorted, distinct QIDs of the entities with that claim. The arrays are memory-mapped when the index is loaded, so a
+lookup is two binary searches plus a read of the posting list.
+
+Layout of the output directory (IDs are stored as integers, Q42 -> 42, P31 -> 31):
+    meta.json                   number of keys and postings
+    key_property_id.bin         int32 array, the property of each key
+    key_value.bin               int64 array, the value of each key (keys are sorted by property, then value)
+    key_offsets.bin             int64 array of num_keys + 1 offsets into qids.bin
+    qids.bin                    int64 array, the posting lists of all keys, concatenated
+
+The index is built from the entity_rels table, or from its columnar copy (see columnar.py) if one is given, which
+saves parsing the table again. Rows are sorted --run_size at a time into runs, which are written to a temporary
+directory under the output directory and then merged (in several passes if there are many), so the memory used depends on --run_size and not on the size of
+the table.
+
+Example command:
+
+python3 -m simple_wikidata_db.rel_index \
+    --data data/processed/entity_rels \
+    --out_dir data/processed/entity_rels_index
+
+"""
+import argparse
+import json
+import shutil
+import tempfile
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+from tqdm import tqdm
+
+from simple_wikidata_db.columnar import convert_file, load_columnar_table
+from simple_wikidata_db.utils import get_batch_files, parse_id
+
+KEY_COLUMNS = {'key_property_id': '<i4', 'key_value': '<i8', 'key_offsets': '<i8', 'qids': '<i8'}
+# columns of the sorted runs of postings written while building the index
+RUN_COLUMNS = {'property_id': '<i4', 'value': '<i8', 'qid': '<i8'}
+# number of rows sorted in memory at a time when building the index, which takes about 64 bytes per row
+RUN_SIZE = 1 << 24
+# number of runs merged at a time. With more runs, groups of runs are first merged into longer runs.
+MERGE_FAN_IN = 64
+# smallest number of postings read from a run at a time, as reading fewer makes merging slow
+MIN_BLOCK_SIZE = 1 << 12
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='data/processed/entity_rels', help='path to entity_rels table')
+    parser.add_argument('--columnar_dir', type=str, default=None,
+                        help='path to a columnar entity_rels table. If given, the index is built from it instead of '
+                             '--data')
+    parser.add_argument('--out_dir', type=str, default='data/processed/entity_rels_index',
+                        help='path to output directory')
+    parser.add_argument('--num_procs', type=int, default=10, help='Number of processes')
+    parser.add_argument('--run_size', type=int, default=RUN_SIZE,
+                        help='Number of rows sorted in memory at a time. The build takes about 64 bytes per row of a '
+                             'run, whatever the size of the table')
+    return parser
+
+
+def read_chunks(data_files, num_procs: int, run_size: int) -> Iterator[Dict[str, np.ndarray]]:
+    """ Reads the qid/property_id/value columns of entity_rels files, in chunks of the files of about run_size rows """
+    chunk, chunk_rows = [], 0
+    pool = Pool(processes=num_procs)
+    for file_columns, _, _ in tqdm(pool.imap(convert_file, data_files, chunksize=1), total=len(data_files),
+                                   desc="Reading files"):
+        chunk.append(file_columns)
+        chunk_rows += len(file_columns['qid'])
+        if chunk_rows >= run_size:
+            yield concatenate_columns(chunk)
+            chunk, chunk_rows = [], 0
+    pool.close()
+    pool.join()
+    if chunk:
+        yield concatenate_columns(chunk)
+
+
+def concatenate_columns(chunk: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    return {name: np.concatenate([columns[name] for columns in chunk]) for name in RUN_COLUMNS}
+
+
+def table_chunks(table: Dict[str, np.ndarray], run_size: int) -> Iterator[Dict[str, np.ndarray]]:
+    """ Splits a (memory-mapped) columnar table into chunks of run_size rows """
+    for start in range(0, len(table['qid']), run_size):
+        yield {name: np.asarray(table[name][start:start + run_size]) for name in RUN_COLUMNS}
+
+
+def sort_postings(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """ Sorts (property_id, value, qid) postings by property, then value, then QID, and removes duplicates """
+    qid = np.asarray(columns['qid'], dtype='<i8')
+    property_id = np.asarray(columns['property_id'], dtype='<i4')
+    value = np.asarray(columns['value'], dtype='<i8')
+    order = np.lexsort((qid, value, property_id))
+    qid, property_id, value = qid[order], property_id[order], value[order]
+    # an entity can have several claims with the same property and value, keep it once in the posting list
+    distinct = np.ones(len(qid), dtype=bool)
+    distinct[1:] = (qid[1:] != qid[:-1]) | (value[1:] != value[:-1]) | (property_id[1:] != property_id[:-1])
+    return {'property_id': property_id[distinct], 'value': value[distinct], 'qid': qid[distinct]}
+
+
+def count_up_to(postings: Dict[str, np.ndarray], bound) -> int:
+    """ Returns the number of sorted postings which are at most bound, a (property_id, value, qid) tuple """
+    property_id, value, qid = bound
+    start, end = np.searchsorted(postings['property_id'], [property_id, property_id + 1])
+    values = postings['value'][start:end]
+    value_start, value_end = start + np.searchsorted(values, [value, value + 1])
+    return int(value_start + np.searchsorted(postings['qid'][value_start:value_end], qid, side='right'))
+
+
+def read_run_block(run_dir: Path, run_id: int, start: int, block_size: int) -> Dict[str, np.ndarray]:
+    """ Reads block_size postings of a run from start (fewer at its end) """
+    return {
+        name: np.fromfile(run_dir / f"{run_id}_{name}.bin", dtype=dtype, count=block_size,
+                          offset=start * np.dtype(dtype).itemsize)
+        for name, dtype in RUN_COLUMNS.items()
+    }
+
+
+def write_run(run_dir: Path, run_id: int, blocks: Iterable[Dict[str, np.ndarray]]):
+    files = {name: open(run_dir / f"{run_id}_{name}.bin", 'wb') for name in RUN_COLUMNS}
+    for block in blocks:
+        for name, dtype in RUN_COLUMNS.items():
+            block[name].astype(dtype).tofile(files[name])
+    for f in files.values():
+        f.close()
+
+
+def remove_run(run_dir: Path, run_id: int):
+    for name in RUN_COLUMNS:
+        (run_dir / f"{run_id}_{name}.bin").unlink()
+
+
+def merge_runs(run_dir: Path, run_ids: List[int], block_size: int) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Yields the postings of sorted runs of run_dir in order and without duplicates, reading block_size postings of each
+    run at a time. The postings up to the smallest of the last postings read from each run are merged at every
+    step, as no run has a smaller posting left, which uses up the block of at least one run.
+    """
+    positions = [0] * len(run_ids)
+    blocks = [None] * len(run_ids)
+    last = None
+    while True:
+        for i, run_id in enumerate(run_ids):
+            if blocks[i] is None or len(blocks[i]['qid']) == 0:
+                blocks[i] = read_run_block(run_dir, run_id, positions[i], block_size)
+                positions[i] += len(blocks[i]['qid'])
+        active = [block for block in blocks if len(block['qid']) > 0]
+        if not active:
+            break
+        bound = min((int(block['property_id'][-1]), int(block['value'][-1]), int(block['qid'][-1]))
+                    for block in active)
+        parts = []
+        for i, block in enumerate(blocks):
+            count = count_up_to(block, bound) if len(block['qid']) > 0 else 0
+            parts.append({name: block[name][:count] for name in RUN_COLUMNS})
+            blocks[i] = {name: block[name][count:] for name in RUN_COLUMNS}
+        merged = sort_postings(concatenate_columns(parts))
+        if last is not None and len(merged['qid']) > 0 and \
+                (int(merged['property_id'][0]), int(merged['value'][0]), int(merged['qid'][0])) == last:
+            merged = {name: column[1:] for name, column in merged.items()}
+        if len(merged['qid']) > 0:
+            last = (int(merged['property_id'][-1]), int(merged['value'][-1]), int(merged['qid'][-1]))
+            yield merged
+
+
+def write_index(blocks: Iterator[Dict[str, np.ndarray]], out_dir: Path):
+    """ Writes the arrays of the index from sorted, distinct postings, a block at a time """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    files = {name: open(out_dir / f"{name}.bin", 'wb') for name in KEY_COLUMNS}
+    num_keys = 0
+    num_postings = 0
+    last_key = None
+    for block in blocks:
+        property_id, value, qid = block['property_id'], block['value'], block['qid']
+        key_starts = np.ones(len(qid), dtype=bool)
+        key_starts[1:] = (value[1:] != value[:-1]) | (property_id[1:] != property_id[:-1])
+        # the first posting of a block continues the last key of the previous block if they have the same key
+        key_starts[0] = (int(property_id[0]), int(value[0])) != last_key
+        key_starts = key_starts.nonzero()[0]
+        property_id[key_starts].astype(KEY_COLUMNS['key_property_id']).tofile(files['key_property_id'])
+        value[key_starts].astype(KEY_COLUMNS['key_value']).tofile(files['key_value'])
+        (num_postings + key_starts).astype(KEY_COLUMNS['key_offsets']).tofile(files['key_offsets'])
+        qid.astype(KEY_COLUMNS['qids']).tofile(files['qids'])
+        num_keys += len(key_starts)
+        num_postings += len(qid)
+        last_key = (int(property_id[-1]), int(value[-1]))
+    np.array([num_postings], dtype=KEY_COLUMNS['key_offsets']).tofile(files['key_offsets'])
+    for f in files.values():
+        f.close()
+    with open(out_dir / "meta.json", 'w') as f:
+        json.dump({'num_keys': num_keys, 'num_postings': num_postings, 'columns': KEY_COLUMNS}, f, indent=2)
+    print(f"Wrote an index of {num_keys} (property, value) keys and {num_postings} postings to {out_dir}")
+
+
+def build_rel_index(chunks: Iterable[Dict[str, np.ndarray]], out_dir: Path, run_size: int = RUN_SIZE):
+    """
+    Builds the index by an external sort, so that its memory use depends on run_size rather than on the size of the
+    table: each chunk of qid/property_id/value columns (of about run_size rows) is sorted into a run on disk, and the
+    runs are merged into the arrays of the index.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    run_dir = Path(tempfile.mkdtemp(prefix='_runs_', dir=out_dir))
+    try:
+        run_ids = []
+        for run_id, columns in enumerate(chunks):
+            write_run(run_dir, run_id, [sort_postings(columns)])
+            run_ids.append(run_id)
+        # the blocks of the runs merged together take about as much memory as a run
+        block_size = max(MIN_BLOCK_SIZE, run_size // max(1, min(len(run_ids), MERGE_FAN_IN)))
+        next_run_id = len(run_ids)
+        while len(run_ids) > MERGE_FAN_IN:
+            merged_ids = []
+            for start in range(0, len(run_ids), MERGE_FAN_IN):
+                group = run_ids[start:start + MERGE_FAN_IN]
+                write_run(run_dir, next_run_id, merge_runs(run_dir, group, block_size))
+                for run_id in group:
+                    remove_run(run_dir, run_id)
+                merged_ids.append(next_run_id)
+                next_run_id += 1
+            run_ids = merged_ids
+        write_index(merge_runs(run_dir, run_ids, block_size), out_dir)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def load_rel_index(index_dir) -> Dict[str, np.ndarray]:
+    """ Memory-maps the arrays of an index written by build_rel_index """
+    index_dir = Path(index_dir)
+    with open(index_dir / "meta.json", 'r') as f:
+        meta = json.load(f)
+    sizes = {
+        'key_property_id': meta['num_keys'], 'key_value': meta['num_keys'], 'key_offsets': meta['num_keys'] + 1,
+        'qids': meta['num_postings']
+    }
+    return {
+        name: np.memmap(index_dir / f"{name}.bin", dtype=dtype, mode='r', shape=(sizes[name],))
+        if sizes[name] > 0 else np.zeros(sizes[name], dtype=dtype)
+        for name, dtype in meta['columns'].items()
+    }
+
+
+def lookup_qids(index: Dict[str, np.ndarray], property_id: str, value: str) -> Optional[np.ndarray]:
+    """
+    Returns the sorted QID numbers of the entities with a claim (property_id, value), or None if the index can't
+    answer (the value isn't a QID).
+    """
+    property_num = parse_id(property_id, 'P')
+    value_num = parse_id(value, 'Q')
+    if property_num < 0 or value_num < 0:
+        return None
+    start = np.searchsorted(index['key_property_id'], property_num, side='left')
+    end = np.searchsorted(index['key_property_id'], property_num, side='right')
+    key = start + np.searchsorted(index['key_value'][start:end], value_num, side='left')
+    if key == end or index['key_value'][key] != value_num:
+        return np.zeros(0, dtype='<i8')
+    return np.asarray(index['qids'][index['key_offsets'][key]:index['key_offsets'][key + 1]])
+
+
+def lookup_qid_strings(index: Dict[str, np.ndarray], property_id: str, value: str) -> Optional[List[str]]:
+    """ Same as lookup_qids, with the QIDs as strings (e.g. 'Q42') """
+    qids = lookup_qids(index, property_id, value)
+    if qids is None:
+        return None
+    return [f"Q{qid}" for qid in qids.tolist()]
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    if args.columnar_dir is not None:
+        chunks = table_chunks(load_columnar_table(args.columnar_dir), args.run_size)
+    else:
+        chunks = read_chunks(sorted(get_batch_files(args.data)), args.num_procs, args.run_size)
+    build_rel_index(chunks, Path(args.out_dir), args.run_size)
+
+
+if __name__ == "__main__":
+    main()
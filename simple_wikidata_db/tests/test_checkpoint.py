@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+import sys
+from collections import Counter
+from multiprocessing import Value
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from simple_wikidata_db.preprocess_utils.checkpoint import check_input_file, get_resume_seqs, input_file_info, \
+    reset_checkpoints
+from simple_wikidata_db.preprocess_utils.worker_process import encode_rows
+from simple_wikidata_db.preprocess_utils.writer_process import Writer, prepare_table_dirs
+from simple_wikidata_db.utils import get_batch_files, jsonl_generator
+
+NUM_SPLITS = 2
+NUM_CHUNKS = 10
+
+
+def make_rows(split_id, seq):
+    return [{'qid': f"Q{split_id}{seq:02d}{i}", 'label': f"label {split_id} {seq} {i}"} for i in range(2)]
+
+
+def make_chunk(split_id, seq):
+    """ Chunk of two entities with a label each, as sent by a worker to the writer """
+    rows = make_rows(split_id, seq)
+    return split_id, seq, len(rows), {('labels', 0): [len(rows), len(rows), encode_rows(rows)]}
+
+
+def make_writer(path, resume):
+    # 3 rows per file, so that resuming has files to truncate and remove
+    return Writer(path, 3, [('labels', 0)], [], 0, Value('q', 0), report_progress=False, roll_by='rows',
+                  resume=resume)
+
+
+def start_run(path):
+    prepare_table_dirs(path, ['labels'])
+    reset_checkpoints(path, {})
+
+
+def crash(writer):
+    """ Stops a writer without a final checkpoint, leaving what it wrote since the last one on disk """
+    for table in writer.output_tables.values():
+        table.close()
+
+
+def resume_run(path):
+    resume_seqs = get_resume_seqs(path, 1, NUM_SPLITS)
+    writer = make_writer(path, resume=True)
+    for seq in range(NUM_CHUNKS):
+        for split_id in range(NUM_SPLITS):
+            if seq >= resume_seqs[split_id]:
+                writer.write(make_chunk(split_id, seq))
+    writer.close()
+    return resume_seqs
+
+
+def read_labels(path):
+    return Counter(json.dumps(row) for fname in get_batch_files(path / 'labels') for row in jsonl_generator(fname))
+
+
+def expected_labels():
+    return Counter(json.dumps(row) for split_id in range(NUM_SPLITS) for seq in range(NUM_CHUNKS)
+                   for row in make_rows(split_id, seq))
+
+
+def test_resume_after_checkpoint(tmp_path):
+    start_run(tmp_path)
+    writer = make_writer(tmp_path, resume=False)
+    for seq in range(4):
+        writer.write(make_chunk(0, seq))
+        writer.write(make_chunk(1, seq))
+    writer.write(make_chunk(0, 4))
+    writer.save_checkpoint()
+    # written after the checkpoint, so lost when the run is interrupted
+    for seq in range(5, 8):
+        writer.write(make_chunk(0, seq))
+    writer.write(make_chunk(1, 4))
+    crash(writer)
+
+    assert resume_run(tmp_path) == [5, 4]
+    assert read_labels(tmp_path) == expected_labels()
+
+
+def test_resume_without_checkpoint(tmp_path):
+    start_run(tmp_path)
+    writer = make_writer(tmp_path, resume=False)
+    for seq in range(4):
+        writer.write(make_chunk(0, seq))
+    crash(writer)
+    assert len(os.listdir(tmp_path / 'labels')) > 1
+
+    assert resume_run(tmp_path) == [0, 0]
+    assert read_labels(tmp_path) == expected_labels()
+
+
+def test_resume_from_a_moved_input_file(tmp_path):
+    dump = tmp_path / 'dump.json'
+    dump.write_text('[\n{"id": "Q1"}\n]\n')
+    config = input_file_info(os.path.relpath(dump))
+    assert config['input_file'] == str(dump)
+    moved = tmp_path / 'moved.json'
+    shutil.move(dump, moved)
+    check_input_file(config, str(moved))
+    with open(moved, 'a') as f:
+        f.write('\n')
+    with pytest.raises(ValueError):
+        check_input_file(config, str(moved))
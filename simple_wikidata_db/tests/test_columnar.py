@@ -0,0 +1,46 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from simple_wikidata_db.columnar import build_columnar_table, load_claim_ids, load_columnar_table
+
+FILES = [
+    [
+        {'claim_id': 'Q1$a', 'qid': 'Q1', 'property_id': 'P31', 'value': 'Q5'},
+        {'claim_id': 'Q1$b', 'qid': 'Q1', 'property_id': 'P5137', 'value': 'L7'},
+        {'claim_id': 'Q2$é', 'qid': 'Q2', 'property_id': 'P31', 'value': 'Q6256'},
+    ],
+    [
+        {'claim_id': 'Q3$a', 'qid': 'Q3', 'property_id': 'P1082', 'value': 'Q²'},
+        {'claim_id': 'Q3$b', 'qid': 'Q3', 'property_id': 'P30', 'value': 'Q46'},
+    ],
+    [],
+]
+
+
+def write_table(path):
+    path.mkdir()
+    for i, rows in enumerate(FILES):
+        with open(path / f"{i}.jsonl", 'w') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+    return [str(path / f"{i}.jsonl") for i in range(len(FILES))]
+
+
+def test_round_trip(tmp_path):
+    build_columnar_table(write_table(tmp_path / 'entity_rels'), tmp_path / 'columnar', 1)
+    table = load_columnar_table(tmp_path / 'columnar')
+    # the rows with a value which isn't a QID are skipped, the others keep the order of the files
+    assert table['qid'].tolist() == [1, 2, 3]
+    assert table['property_id'].tolist() == [31, 31, 30]
+    assert table['value'].tolist() == [5, 6256, 46]
+    assert load_claim_ids(tmp_path / 'columnar', [2, 0, 1]) == ['Q3$b', 'Q1$a', 'Q2$é']
+    assert load_claim_ids(tmp_path / 'columnar', []) == []
+
+
+def test_empty_table(tmp_path):
+    build_columnar_table([], tmp_path / 'columnar', 1)
+    table = load_columnar_table(tmp_path / 'columnar')
+    assert all(len(column) == 0 for column in table.values())
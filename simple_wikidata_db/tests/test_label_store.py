@@ -0,0 +1,53 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from simple_wikidata_db.label_store import LabelStore, build_label_store
+
+FILES = [
+    [
+        {'qid': 'Q42', 'label': 'Douglas Adams'},
+        {'qid': 'Q5', 'label': 'human'},
+        {'qid': 'L7', 'label': 'not an item'},
+    ],
+    [
+        {'qid': 'Q142', 'label': 'France "la belle" – ça'},
+        {'qid': 'Q5', 'label': 'a second label, dropped'},
+        {'qid': 'Q1'},
+        {'qid': 'Q3', 'label': ''},
+    ],
+]
+
+
+def write_table(path):
+    path.mkdir()
+    for i, rows in enumerate(FILES):
+        with open(path / f"{i}.jsonl", 'w') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+    return [str(path / f"{i}.jsonl") for i in range(len(FILES))]
+
+
+def test_round_trip(tmp_path):
+    build_label_store(write_table(tmp_path / 'labels'), tmp_path / 'store', 1)
+    store = LabelStore(tmp_path / 'store')
+    assert len(store) == 4
+    # the label in the first file is kept
+    assert store.get('Q5') == 'human'
+    assert store.get('Q142') == 'France "la belle" – ça'
+    assert store.get('Q3') == ''
+    assert store.get('Q1') is None and store.get('L7', 'L7') == 'L7'
+    assert 'Q42' in store and 'Q43' not in store
+    qids = ['Q142', 'Q43', 'Q42', 'P31', 'Q3', 'Q5', 'Q0', 'Q100000']
+    assert store.get_many(qids, default='?') == [store.get(qid, '?') for qid in qids]
+    assert store.get_many(qids) == ['France "la belle" – ça', None, 'Douglas Adams', None, '', 'human', None, None]
+
+
+def test_empty_store(tmp_path):
+    build_label_store([], tmp_path / 'store', 1)
+    store = LabelStore(tmp_path / 'store')
+    assert len(store) == 0
+    assert store.get('Q5') is None
+    assert store.get_many(['Q5', 'Q6'], default='?') == ['?', '?']
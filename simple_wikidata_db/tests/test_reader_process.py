@@ -0,0 +1,54 @@
+import bz2
+import gzip
+import os
+import sys
+from multiprocessing import Value
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from simple_wikidata_db.preprocess_utils.reader_process import find_splits, iter_lines
+
+LINES = [f'{{"type":"item","id":"Q{i}","labels":{{"en":"{"x" * (i % 37)}"}}}},'.encode('utf-8') for i in range(3000)]
+DUMP = b'[\n' + b'\n'.join(LINES) + b'\n]\n'
+
+
+def write_members(path, compress, member_size):
+    """ Writes the dump as independently compressed members, cut every member_size bytes (not at line ends) """
+    with open(path, 'wb') as f:
+        for start in range(0, len(DUMP), member_size):
+            f.write(compress(DUMP[start:start + member_size]))
+
+
+def read_splits(path, splits):
+    lines = []
+    for start, end in splits:
+        lines.extend(iter_lines(path, start, end))
+    return lines
+
+
+def test_raw_splits_at_every_offset(tmp_path):
+    path = tmp_path / 'dump.json'
+    dump = DUMP[:DUMP.index(b'\n', 400) + 1]
+    path.write_bytes(dump)
+    expected = dump.split(b'\n')[:-1]
+    for cut in range(1, len(dump)):
+        assert read_splits(path, [(0, cut), (cut, -1)]) == expected
+
+
+def test_member_splits(tmp_path):
+    expected = DUMP.split(b'\n')[:-1]
+    for suffix, compress in (('.gz', gzip.compress), ('.bz2', bz2.compress)):
+        path = tmp_path / f'dump.json{suffix}'
+        write_members(path, compress, 10007)
+        for num_readers in (1, 2, 3, 5, 8):
+            splits = find_splits(path, num_readers)
+            assert len(splits) == num_readers
+            assert read_splits(path, splits) == expected
+
+
+def test_progress_counts_compressed_bytes(tmp_path):
+    path = tmp_path / 'dump.json.gz'
+    write_members(path, gzip.compress, 10007)
+    bytes_read = Value('q', 0)
+    assert len(list(iter_lines(path, bytes_read=bytes_read))) == len(LINES) + 2
+    assert bytes_read.value == os.path.getsize(path)
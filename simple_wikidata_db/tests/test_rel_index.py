@@ -0,0 +1,49 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from simple_wikidata_db import rel_index
+from simple_wikidata_db.rel_index import build_rel_index, load_rel_index, lookup_qid_strings, lookup_qids, table_chunks
+
+QID = [9, 3, 3, 7, 3, 12, 9, 5, 1, 3, 7, 2, 3]
+PROPERTY_ID = [31, 31, 31, 31, 30, 31, 30, 17, 31, 31, 17, 31, 31]
+VALUE = [5, 5, 5, 6256, 46, 5, 46, 142, 5, 6256, 142, 5, 5]
+TABLE = {
+    'qid': np.array(QID, dtype='<i8'),
+    'property_id': np.array(PROPERTY_ID, dtype='<i4'),
+    'value': np.array(VALUE, dtype='<i8'),
+}
+
+
+def expected_postings():
+    postings = {}
+    for qid, property_id, value in zip(QID, PROPERTY_ID, VALUE):
+        postings.setdefault((property_id, value), set()).add(qid)
+    return {key: sorted(qids) for key, qids in postings.items()}
+
+
+def test_round_trip(tmp_path, monkeypatch):
+    # runs of 2 rows merged 2 at a time, so the runs are merged in several passes
+    monkeypatch.setattr(rel_index, 'MERGE_FAN_IN', 2)
+    monkeypatch.setattr(rel_index, 'MIN_BLOCK_SIZE', 1)
+    for run_size in (2, 5, len(QID)):
+        out_dir = tmp_path / f"index_{run_size}"
+        build_rel_index(table_chunks(TABLE, run_size), out_dir, run_size)
+        assert sorted(os.listdir(out_dir)) == sorted(['meta.json'] + [f"{name}.bin" for name in rel_index.KEY_COLUMNS])
+        index = load_rel_index(out_dir)
+        assert len(index['key_property_id']) == len(expected_postings())
+        for (property_id, value), qids in expected_postings().items():
+            assert lookup_qids(index, f"P{property_id}", f"Q{value}").tolist() == qids
+        assert lookup_qid_strings(index, 'P31', 'Q6256') == ['Q3', 'Q7']
+        assert load_rel_index(out_dir)['qids'].tolist().count(3) == 3
+        assert lookup_qids(index, 'P31', 'Q6').tolist() == []
+        assert lookup_qids(index, 'P99', 'Q5').tolist() == []
+        assert lookup_qids(index, 'P31', 'L7') is None
+
+
+def test_empty_index(tmp_path):
+    build_rel_index([], tmp_path / 'index')
+    assert lookup_qids(load_rel_index(tmp_path / 'index'), 'P31', 'Q5').tolist() == []
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from simple_wikidata_db.preprocess_utils.writer_process import qid_shard
+from simple_wikidata_db.utils import get_shard_files
+
+QIDS = ['Q1', 'Q5', 'Q42', 'Q64', 'Q142', 'Q6256']
+
+
+def test_shard_files_of_qids(tmp_path):
+    for shard in range(4):
+        for index in range(2):
+            (tmp_path / f"shard{shard}_{index}.jsonl").touch()
+    for qid in QIDS:
+        shard = qid_shard(qid, 4)
+        assert sorted(get_shard_files(tmp_path, [qid], 4)) == \
+            [os.path.join(tmp_path, f"shard{shard}_{index}.jsonl") for index in range(2)]
+    shards = {qid_shard(qid, 4) for qid in QIDS}
+    assert len(get_shard_files(tmp_path, QIDS, 4)) == 2 * len(shards)
+    assert get_shard_files(tmp_path, [], 4) == []
+    # an unsharded table is scanned whole
+    assert len(get_shard_files(tmp_path, ['Q1'], 1)) == 8
+
+
+def test_table_which_isnt_sharded(tmp_path):
+    (tmp_path / '0.jsonl').touch()
+    with pytest.raises(ValueError):
+        get_shard_files(tmp_path, ['Q1'], 4)
@@ -0,0 +1,174 @@
+import os
+import sys
+
+import pytest
+import ujson
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from simple_wikidata_db.preprocess_utils.worker_process import EntityFilter, process_batch, process_json
+from simple_wikidata_db.preprocess_utils.writer_process import LANGUAGE_TABLES, TABLE_NAMES
+
+
+def snak(datatype, value, snaktype='value'):
+    if snaktype != 'value':
+        return {'snaktype': snaktype, 'datatype': datatype}
+    return {'snaktype': 'value', 'datatype': datatype, 'datavalue': {'value': value}, 'hash': f"{datatype}-hash"}
+
+
+def item(value):
+    return snak('wikibase-item', {'id': value})
+
+
+def text(value, language):
+    return snak('monolingualtext', {'text': value, 'language': language})
+
+
+def entity():
+    """ An item with a row in every table, in the format of the dump """
+    return {
+        'type': 'item',
+        'id': 'Q42',
+        'labels': {'en': {'value': 'Douglas Adams'}, 'fr': {'value': 'Douglas Adams (fr)'}},
+        'descriptions': {'en': {'value': 'English writer'}, 'fr': {'value': 'écrivain anglais'}},
+        'aliases': {'en': [{'value': 'DNA'}], 'fr': [{'value': 'D. Adams'}]},
+        'sitelinks': {'enwiki': {'title': 'Douglas Adams'}, 'frwiki': {'title': 'Douglas Adams (écrivain)'}},
+        'claims': {
+            'P31': [
+                {'id': 'Q42$1', 'mainsnak': item('Q5'), 'qualifiers': {'P580': [snak('time', {'time': '+1952-03-11'})]}}
+            ],
+            'P40': [{'id': 'Q42$2', 'mainsnak': snak('wikibase-item', None, 'novalue')}],
+            'P214': [{'id': 'Q42$3', 'mainsnak': snak('external-id', '113230702')}],
+            'P1082': [{'id': 'Q42$4', 'mainsnak': snak('quantity', {'amount': '+1'})}],
+            'P1477': [
+                {'id': 'Q42$5', 'mainsnak': text('Douglas Noël Adams', 'en')},
+                {'id': 'Q42$6', 'mainsnak': text('Douglas N. Adams', 'fr')},
+            ],
+            'P1813': [{'id': 'Q42$7', 'mainsnak': snak('string', 'DA')}],
+        },
+    }
+
+
+def test_selected_tables_are_the_same_as_in_the_full_extraction():
+    full = process_json(entity())
+    assert sorted(full) == sorted(set(TABLE_NAMES) - {'properties'})
+    assert full['entity_rels'] == [{'claim_id': 'Q42$1', 'qid': 'Q42', 'property_id': 'P31', 'value': 'Q5'}]
+    assert [row['alias'] for row in full['aliases']] == ['Douglas Adams', 'DNA', 'Douglas Noël Adams', 'DA']
+    for table_name in TABLE_NAMES:
+        expected = {table_name: full[table_name]} if table_name in full else {}
+        assert process_json(entity(), tables=[table_name]) == expected
+    assert process_json(entity(), tables=['labels', 'entity_rels']) == \
+        {'labels': full['labels'], 'entity_rels': full['entity_rels']}
+
+
+def test_unselected_parts_of_the_entity_are_not_looked_at():
+    obj = entity()
+    # claims which would fail to parse, but only feed tables which aren't requested
+    obj['claims'] = {'P31': [{}]}
+    assert process_json(obj, tables=['labels', 'descriptions']) == {
+        'labels': [{'qid': 'Q42', 'label': 'Douglas Adams'}],
+        'descriptions': [{'qid': 'Q42', 'description': 'English writer'}],
+    }
+
+
+def test_each_language_gets_its_own_tables():
+    tables = process_json(entity(), ['en', 'fr'])
+    assert sorted(tables) == sorted(
+        [f"{table_name}_{language_id}" for table_name in LANGUAGE_TABLES for language_id in ('en', 'fr')] +
+        [table_name for table_name in TABLE_NAMES if table_name not in LANGUAGE_TABLES and table_name != 'properties']
+    )
+    # the tables of the first language, and the other tables, are the same as when extracting it alone
+    english = process_json(entity(), 'en')
+    for table_name, rows in english.items():
+        assert tables[f"{table_name}_en" if table_name in LANGUAGE_TABLES else table_name] == rows
+    assert tables['labels_fr'] == [{'qid': 'Q42', 'label': 'Douglas Adams (fr)'}]
+    assert tables['wikipedia_links_fr'] == [{'qid': 'Q42', 'wiki_title': 'Douglas Adams (écrivain)'}]
+    # names of a monolingual alias property are aliases in their own language, other names in all languages
+    assert [row['alias'] for row in tables['aliases_fr']] == \
+        ['Douglas Adams (fr)', 'D. Adams', 'Douglas N. Adams', 'DA']
+    # monolingual values are only kept in the first language
+    assert tables['entity_values'] == english['entity_values']
+
+
+def test_filter_on_raw_lines_and_entities():
+    line = ujson.dumps(entity()).encode('utf-8')
+    humans = EntityFilter(['P31=Q5'])
+    assert humans.might_match(line) and humans.matches(entity())
+    # the property is on the line, but not with that value
+    countries = EntityFilter(['P31=Q6256'])
+    assert countries.might_match(line) and not countries.matches(entity())
+    # a property without a value matches any claim of it, even without a value
+    assert EntityFilter(['P40']).matches(entity())
+    assert not EntityFilter(['P625']).might_match(line)
+    assert EntityFilter(['P625'], qids=['Q42']).might_match(line) and EntityFilter([], qids=['Q42']).matches(entity())
+    assert EntityFilter(['P1813=DA']).matches(entity())
+    with pytest.raises(ValueError):
+        EntityFilter(['Q5'])
+
+
+def test_entities_which_dont_match_the_filter_have_no_rows():
+    assert process_json(entity(), entity_filter=EntityFilter(['P31=Q6256'])) == {}
+    assert process_json(entity(), entity_filter=EntityFilter(['P31=Q5'])) == process_json(entity())
+    lines = [ujson.dumps(entity()).encode('utf-8'), b'']
+    assert process_batch(lines, entity_filter=EntityFilter(['P625'])) == (2, {})
+    num_lines, batch = process_batch(lines, tables=['labels'], entity_filter=EntityFilter(['P31']))
+    assert num_lines == 2 and list(batch) == [('labels', 0)] and batch[('labels', 0)][:2] == [1, 1]
+
+
+def constraint(claim_id, value, qualifiers=None, snaktype='value'):
+    claim = {'id': claim_id, 'mainsnak': snak('wikibase-item', {'id': value}, snaktype)}
+    if qualifiers is not None:
+        claim['qualifiers'] = qualifiers
+    return claim
+
+
+def property_entity():
+    """ A property with a value type constraint and a constraint without a value, in the format of the dump """
+    return {
+        'type': 'property',
+        'id': 'P40',
+        'datatype': 'wikibase-item',
+        'labels': {'en': {'value': 'child'}, 'fr': {'value': 'enfant'}},
+        'aliases': {'en': [{'value': 'son'}, {'value': 'daughter'}]},
+        'claims': {
+            'P31': [{'id': 'P40$0', 'mainsnak': item('Q18608871')}],
+            'P2302': [
+                constraint('P40$1', 'Q21510865', {
+                    'P2308': [item('Q5'), item('Q215627')],
+                    'P2309': [item('Q21503252')],
+                    'P2306': [snak('wikibase-property', {'id': 'P31'})],
+                    'P2316': [snak('wikibase-item', None, 'novalue')],
+                }),
+                constraint('P40$2', 'Q21503250'),
+                constraint('P40$3', None, snaktype='somevalue'),
+            ],
+        },
+    }
+
+
+def test_properties_have_a_row_with_their_constraints():
+    row = {
+        'property_id': 'P40',
+        'label': 'child',
+        'datatype': 'wikibase-item',
+        'aliases': ['son', 'daughter'],
+        'constraints': [
+            {
+                'claim_id': 'P40$1',
+                'constraint': 'Q21510865',
+                'qualifiers': {'P2308': ['Q5', 'Q215627'], 'P2309': ['Q21503252'], 'P2306': ['P31']},
+            },
+            {'claim_id': 'P40$2', 'constraint': 'Q21503250', 'qualifiers': {}},
+        ],
+    }
+    assert process_json(property_entity()) == {'properties': [row]}
+    assert process_json(property_entity(), ['fr', 'en']) == \
+        {'properties': [dict(row, label='enfant', aliases=[])]}
+    assert process_json(property_entity(), tables=['labels', 'entity_rels']) == {}
+    # properties are kept whatever the filter, so that a subset has the metadata of all properties
+    assert process_json(property_entity(), entity_filter=EntityFilter(['P31=Q6256'])) == {'properties': [row]}
+    lines = [ujson.dumps(property_entity()).encode('utf-8'), ujson.dumps(entity()).encode('utf-8')]
+    num_lines, batch = process_batch(lines, entity_filter=EntityFilter(['P625']))
+    assert num_lines == 2 and list(batch) == [('properties', 0)]
+    assert batch[('properties', 0)] == [1, 1, (ujson.dumps(row, ensure_ascii=False) + '\n').encode('utf-8')]
+    assert process_batch(lines, tables=['labels'], entity_filter=EntityFilter(['P625'])) == (2, {})
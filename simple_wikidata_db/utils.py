@@ -1,13 +1,36 @@
 """Assortment of useful utility functions
 """
 
+import gzip
+import io
 import os
 import ujson as json
 import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from simple_wikidata_db.preprocess_utils.writer_process import qid_shard
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def open_table_file(fname):
+    """ Opens a (possibly gzip or zstd compressed) table file for reading text """
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rt', encoding='utf-8')
+    elif fname.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("Reading .zst files requires the zstandard package (pip install zstandard).")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(fname, 'rb'), read_across_frames=True)
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return open(fname, 'r')
 
 def jsonl_generator(fname):
     """ Returns generator for jsonl file """
-    for line in open(fname, 'r'):
+    for line in open_table_file(fname):
         line = line.strip()
         if len(line) < 3:
             d = {}
@@ -21,7 +44,7 @@ def batch_line_generator(fname, batch_size):
     """ Returns generator for jsonl file with batched lines """
     res = []
     batch_id = 0
-    for line in open(fname, 'r'):
+    for line in open_table_file(fname):
         line = line.strip()
         if len(line) < 3:
             d = ''
@@ -50,6 +73,70 @@ def get_batch_files(fdir):
     print(f"Fetched {len(filenames)} files from {fdir}")
     return filenames
 
+def get_shard_files(fdir, qids, num_shards):
+    """
+    Returns paths to the files in fdir of the shards holding the rows of the given qids, for a table sharded with
+    preprocess_dump.py --num_shards (all files if the table isn't sharded)
+    """
+    if num_shards <= 1:
+        return get_batch_files(fdir)
+    shard_files = [f for f in os.listdir(fdir) if f.startswith('shard')]
+    if len(shard_files) == 0:
+        raise ValueError(f"{fdir} has no shard files, it wasn't written with --num_shards {num_shards}")
+    shards = {qid_shard(qid, num_shards) for qid in qids}
+    filenames = [f for f in shard_files if int(f[5:f.index('_')]) in shards]
+    filenames = [os.path.join(fdir, f) for f in filenames]
+    print(f"Fetched {len(filenames)} files of {len(shards)} shards from {fdir}")
+    return filenames
+
+def parse_id(entity_id, prefix):
+    """
+    Returns the number of a Wikidata ID (e.g. 42 for Q42 with prefix 'Q'), or -1 if it isn't a string made of the prefix
+    and ASCII digits
+    """
+    if isinstance(entity_id, str) and entity_id.startswith(prefix):
+        digits = entity_id[len(prefix):]
+        if digits.isascii() and digits.isdigit():
+            return int(digits)
+    return -1
+
+def qid_numbers(qids):
+    """ Returns the numbers of QIDs (Q42 -> 42) as an int64 array, with -1 for IDs which aren't QIDs """
+    return np.array([parse_id(qid, 'Q') for qid in qids], dtype=np.int64)
+
+def share_qids(qids):
+    """
+    Copies a set of QIDs into shared memory as a sorted array of their numbers, so that pool workers can attach to it
+    once (see attach_qids) instead of getting a pickled copy of the set with every task. Returns the SharedMemory
+    block, which the caller closes and unlinks when the workers are done, and the (name, size) to pass to attach_qids.
+    """
+    numbers = np.unique(qid_numbers(qids))
+    numbers = numbers[numbers >= 0]
+    shm = shared_memory.SharedMemory(create=True, size=max(1, numbers.nbytes))
+    np.ndarray(len(numbers), dtype=np.int64, buffer=shm.buf)[:] = numbers
+    return shm, (shm.name, len(numbers))
+
+_attached_qids = {}
+
+def attach_qids(shared_qids):
+    """ Returns the sorted QID numbers shared by share_qids, from their (name, size) """
+    name, size = shared_qids
+    if name not in _attached_qids:
+        # pool workers report to the resource tracker of the process which created the block, which unlinks it
+        _attached_qids[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(size, dtype=np.int64, buffer=_attached_qids[name].buf)
+
+def contains_qids(sorted_numbers, qids):
+    """ Returns a boolean mask of the QIDs whose number is in a sorted array of QID numbers """
+    return contains_numbers(sorted_numbers, qid_numbers(qids))
+
+def contains_numbers(sorted_numbers, numbers):
+    """ Returns a boolean mask of the numbers which are in a sorted array of numbers """
+    if len(sorted_numbers) == 0:
+        return np.zeros(len(numbers), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_numbers, numbers), len(sorted_numbers) - 1)
+    return sorted_numbers[positions] == numbers
+
 def create_dir(out_dir):
     """ Creates new directory if it doesn't already exist """
     if not os.path.exists(out_dir):